@@ -0,0 +1,112 @@
+"""Micro-benchmark of the pre- and postprocessing of the messages in `BaseChatModel.chat`.
+
+The model replies instantly, so the time is spent on converting, truncating and formatting the messages and on parsing
+the function calls in the responses:
+
+    python benchmark/message_benchmark.py --turns 20 --chunks 50
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Iterator, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qwen_agent.llm.schema import ASSISTANT, Message  # noqa: E402
+from qwen_agent.llm.text_base import BaseTextChatModel  # noqa: E402
+
+REPLY = 'The weather in Beijing is sunny, with a high of 25 degrees and a low of 15 degrees. ' * 4
+FNCALL_REPLY = 'Let me check the weather.\n✿FUNCTION✿: get_weather\n✿ARGS✿: {"location": "Beijing"}\n✿RESULT✿'
+FUNCTIONS = [{
+    'name': 'get_weather',
+    'description': 'Get the current weather in a given location',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'location': {
+                'type': 'string',
+                'description': 'The city and state, e.g. San Francisco, CA'
+            }
+        },
+        'required': ['location'],
+    },
+}]
+
+
+class InstantChatModel(BaseTextChatModel):
+
+    def __init__(self, reply: str, num_chunks: int):
+        super().__init__({'model': 'instant'})
+        self.reply = reply
+        self.num_chunks = num_chunks
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        step = max(len(self.reply) // self.num_chunks, 1)
+        for i in range(step, len(self.reply) + step, step):
+            yield [Message(ASSISTANT, self.reply[:i])]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, self.reply)]
+
+
+def build_history(num_turns: int) -> List[dict]:
+    messages = [{'role': 'system', 'content': 'You are a helpful assistant.'}]
+    for i in range(num_turns):
+        messages.append({
+            'role': 'user',
+            'content': [{
+                'text': f'What is the weather like in city {i}? Please answer in detail.'
+            }, {
+                'file': f'https://example.com/report_{i}.pdf'
+            }]
+        })
+        messages.append({
+            'role': 'assistant',
+            'content': '',
+            'function_call': {
+                'name': 'get_weather',
+                'arguments': f'{{"location": "city {i}"}}'
+            }
+        })
+        messages.append({'role': 'function', 'name': 'get_weather', 'content': f'Sunny, {20 + i % 10} degrees'})
+        messages.append({'role': 'assistant', 'content': REPLY})
+    messages.append({'role': 'user', 'content': 'And in Beijing?'})
+    return messages
+
+
+def timeit(fn, number: int) -> float:
+    fn()  # Warm up
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=20, help='The turns of the history')
+    parser.add_argument('--chunks', type=int, default=50, help='The chunks of a streamed response')
+    parser.add_argument('--number', type=int, default=50, help='The calls of each case')
+    args = parser.parse_args()
+
+    messages = build_history(args.turns)
+    message_objs = [Message(**m) for m in messages]
+    llm = InstantChatModel(REPLY, args.chunks)
+    fncall_llm = InstantChatModel(FNCALL_REPLY, args.chunks)
+    cases = {
+        'dict, no stream': lambda: llm.chat(messages, stream=False),
+        'Message, no stream': lambda: llm.chat(message_objs, stream=False),
+        'dict, stream': lambda: list(llm.chat(messages, stream=True)),
+        'dict, delta stream': lambda: list(llm.chat(messages, stream=True, delta_stream=True)),
+        'dict, functions, no stream': lambda: fncall_llm.chat(messages, functions=FUNCTIONS, stream=False),
+        'dict, functions, stream': lambda: list(fncall_llm.chat(messages, functions=FUNCTIONS, stream=True)),
+    }
+    print(f'{len(messages)} messages, {args.chunks} chunks per stream')
+    for name, fn in cases.items():
+        print(f'{name:<28} {timeit(fn, args.number) * 1000:8.2f} ms/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Micro-benchmark of the tokenizer calls made when a pdf is parsed and chunked.
+
+The legacy calls go through the token surface forms (`tokenize` + `convert_tokens_to_string`), and the current ones
+stay at the id level (`encode_batch` + `truncate_ids`). The pages of the pdf are repeated to simulate a large pdf:
+
+    python benchmark/tokenization_benchmark.py --pdf examples/resource/poem.pdf --repeat 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from qwen_agent.tools.doc_parser import DocParser  # noqa: E402
+from qwen_agent.tools.simple_doc_parser import parse_pdf  # noqa: E402
+from qwen_agent.utils.tokenization_qwen import tokenizer  # noqa: E402
+
+
+def legacy_count_paras(paras):
+    return [len(tokenizer.tokenize(para)) for para in paras]
+
+
+def count_paras(paras):
+    return [len(token_ids) for token_ids in tokenizer.encode_batch(paras)]
+
+
+def legacy_split_long_paras(paras, max_token):
+    res = []
+    for para in paras:
+        token_list = tokenizer.tokenize(para)
+        for si in range(0, len(token_list), max_token):
+            res.append(tokenizer.convert_tokens_to_string(token_list[si:si + max_token]))
+    return res
+
+
+def split_long_paras(paras, max_token):
+    res = []
+    for token_ids in tokenizer.encode_batch(paras):
+        for si in range(0, len(token_ids), max_token):
+            res.append(tokenizer.truncate_ids(token_ids, max_token=max_token, start_token=si))
+    return res
+
+
+def timeit(fn, *args, number=3):
+    best = float('inf')
+    for _ in range(number):
+        start = time.perf_counter()
+        res = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pdf', type=str, default='examples/resource/poem.pdf')
+    parser.add_argument('--repeat', type=int, default=50, help='The times to repeat the pages of the pdf')
+    parser.add_argument('--max-token', type=int, default=64, help='The tokens of each piece of a long paragraph')
+    args = parser.parse_args()
+
+    pages = parse_pdf(args.pdf) * args.repeat
+    paras = [para.get('text', para.get('table')) for page in pages for para in page['content']]
+    print(f'{len(pages)} pages, {len(paras)} paragraphs, {sum(len(x) for x in paras)} characters')
+
+    legacy_time, legacy_res = timeit(legacy_count_paras, paras)
+    new_time, new_res = timeit(count_paras, paras)
+    assert legacy_res == new_res
+    print(f'count:    {legacy_time:.3f}s -> {new_time:.3f}s ({legacy_time / new_time:.1f}x)')
+
+    para_tokens = iter(new_res)
+    legacy_time, legacy_res = timeit(legacy_split_long_paras, paras, args.max_token)
+    new_time, new_res = timeit(split_long_paras, paras, args.max_token)
+    assert legacy_res == new_res
+    print(f'truncate: {legacy_time:.3f}s -> {new_time:.3f}s ({legacy_time / new_time:.1f}x)')
+
+    doc = [{
+        'page_num': i,
+        'content': [{
+            **para, 'token': next(para_tokens)
+        } for para in page['content']]
+    } for i, page in enumerate(pages)]
+    chunk_time, chunks = timeit(lambda: list(DocParser().iter_chunks(doc, args.pdf)), number=1)
+    print(f'chunking: {chunk_time:.3f}s for {len(chunks)} chunks')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,13 @@ from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from qwen_agent.llm import get_chat_model
 from qwen_agent.llm.base import BaseChatModel
-from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, ContentItem, Message, Session, \
+from qwen_agent.llm.schema import CONTENT, DEFAULT_SYSTEM_MESSAGE, ROLE, SYSTEM, USER, ContentItem, Message, Session, \
     ToolResponse
 from qwen_agent.log import logger
 from qwen_agent.tools import TOOL_REGISTRY, BaseTool
-from qwen_agent.utils.utils import has_chinese_messages, merge_generate_cfgs
+from qwen_agent.utils.semantic_cache import SemanticCache, get_semantic_cache
+from qwen_agent.utils.utils import (extract_files_from_messages, extract_text_from_message, has_chinese_messages,
+                                    hash_sha256, merge_generate_cfgs)
 
 
 class Agent(ABC):
@@ -37,6 +39,8 @@ class Agent(ABC):
             system_message: The specified system message for LLM chat.
             name: The name of this agent.
             description: The description of this agent, which will be used for multi_agent.
+            semantic_cache: (Optional) The config of the semantic cache of the responses, see utils/semantic_cache.py.
+              It can also be enabled after initialization by setting `agent.semantic_cache`.
         """
         if isinstance(llm, dict):
             self.llm = get_chat_model(llm)
@@ -52,6 +56,7 @@ class Agent(ABC):
         self.system_message = system_message
         self.name = name
         self.description = description
+        self.semantic_cache: Optional[SemanticCache] = get_semantic_cache(kwargs.get('semantic_cache'))
 
     def run(self, messages: List[Union[Dict, Message]], sessions: Session = None,
             **kwargs) -> Union[Iterator[List[Message]], Iterator[List[Dict]]]:
@@ -86,6 +91,16 @@ class Agent(ABC):
             else:
                 kwargs['lang'] = 'en'
 
+        query, context = '', ''
+        if self.semantic_cache is not None:
+            query, context = self._get_semantic_cache_query(new_messages, **kwargs)
+            if query:
+                cached_rsp = self.semantic_cache.get(query, context=context)
+                if cached_rsp is not None:
+                    yield self._convert_messages_to_target_type(cached_rsp, _return_message_type)
+                    return
+
+        rsp = None
         for rsp in self._run(messages=new_messages, sessions=sessions, **kwargs):
             if isinstance(rsp, list):
                 for i in range(len(rsp)):
@@ -94,10 +109,45 @@ class Agent(ABC):
             else:
                 if not rsp.name and self.name:
                     rsp.name = self.name
-            if _return_message_type == 'message':
-                yield [Message(**x) if isinstance(x, dict) else x for x in rsp]
-            else:
-                yield [x.model_dump() if not isinstance(x, dict) else x for x in rsp]
+            yield self._convert_messages_to_target_type(rsp, _return_message_type)
+
+        # Only the complete response is cached
+        if query and isinstance(rsp, list):
+            self.semantic_cache.put(query, [Message(**x) if isinstance(x, dict) else x for x in rsp], context=context)
+
+    @staticmethod
+    def _convert_messages_to_target_type(messages: List[Union[Dict, Message]],
+                                         target_type: str) -> Union[List[Message], List[Dict]]:
+        if target_type == 'message':
+            return [Message(**x) if isinstance(x, dict) else x for x in messages]
+        else:
+            return [x.model_dump() if not isinstance(x, dict) else x for x in messages]
+
+    def _get_semantic_cache_query(self, messages: List[Message], **kwargs) -> Tuple[str, str]:
+        """Get the question and the context fingerprint to look up the semantic cache, and '' to bypass the cache.
+
+        By default, the question is the last user message, and the context is the agent, the system message, the files,
+        the language, the earlier turns and the external knowledge passed to the RAG agents. The knowledge retrieved
+        from the files depends only on the files and the question. Override it to include more context which the
+        response depends on.
+        """
+        if not messages or messages[-1].role != USER:
+            return '', ''
+        query = extract_text_from_message(messages[-1], add_upload_info=False)
+        history = json.dumps([msg.model_dump() for msg in messages[:-1]], ensure_ascii=False)
+        context = json.dumps(
+            {
+                'agent': type(self).__name__,
+                'name': self.name,
+                'system_message': self.system_message,
+                'files': extract_files_from_messages(messages, include_images=True),
+                'lang': kwargs.get('lang'),
+                'history': hash_sha256(history),
+                'knowledge': hash_sha256(json.dumps(kwargs.get('knowledge') or '', ensure_ascii=False, default=str)),
+            },
+            ensure_ascii=False,
+            sort_keys=True)
+        return query, context
 
     @abstractmethod
     def _run(self, messages: List[Message], sessions=None, lang: str = 'en', **kwargs) -> \
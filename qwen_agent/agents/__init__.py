@@ -1,23 +1,27 @@
 from qwen_agent.agent import Agent
 from qwen_agent.multi_agent_hub import MultiAgentHub
+from qwen_agent.utils.utils import lazy_module_attrs
 
-from .wealthy_consultant.skill_recognize import SkillRecognizer
-from .wealthy_consultant.wealthy_consultant import WealthyConsultant
-# from .wealthy_consultant.summarize import Summarizer
-from .wealthy_consultant.faq_agent import FAQAgent
-from .article_agent import ArticleAgent
-from .assistant import Assistant
-# DocQAAgent is the default solution for long document question answering.
-# The actual implementation of DocQAAgent may change with every release.
-from .doc_qa.basic_doc_qa import BasicDocQA as DocQAAgent
-from .fncall_agent import FnCallAgent
-from .group_chat import GroupChat
-from .group_chat_auto_router import GroupChatAutoRouter
-from .group_chat_creator import GroupChatCreator
-from .react_chat import ReActChat
-from .router import Router
-from .user_agent import UserAgent
-from .write_from_scratch import WriteFromScratch
+# The agents are imported on first access, since some of them depend on heavy packages: name -> (module, class)
+__getattr__, __dir__ = lazy_module_attrs(__name__, {
+    'SkillRecognizer': ('.wealthy_consultant.skill_recognize', 'SkillRecognizer'),
+    'WealthyConsultant': ('.wealthy_consultant.wealthy_consultant', 'WealthyConsultant'),
+    # 'Summarizer': ('.wealthy_consultant.summarize', 'Summarizer'),
+    'FAQAgent': ('.wealthy_consultant.faq_agent', 'FAQAgent'),
+    'ArticleAgent': ('.article_agent', 'ArticleAgent'),
+    'Assistant': ('.assistant', 'Assistant'),
+    # DocQAAgent is the default solution for long document question answering.
+    # The actual implementation of DocQAAgent may change with every release.
+    'DocQAAgent': ('.doc_qa.basic_doc_qa', 'BasicDocQA'),
+    'FnCallAgent': ('.fncall_agent', 'FnCallAgent'),
+    'GroupChat': ('.group_chat', 'GroupChat'),
+    'GroupChatAutoRouter': ('.group_chat_auto_router', 'GroupChatAutoRouter'),
+    'GroupChatCreator': ('.group_chat_creator', 'GroupChatCreator'),
+    'ReActChat': ('.react_chat', 'ReActChat'),
+    'Router': ('.router', 'Router'),
+    'UserAgent': ('.user_agent', 'UserAgent'),
+    'WriteFromScratch': ('.write_from_scratch', 'WriteFromScratch'),
+})
 
 __all__ = [
     'Agent',
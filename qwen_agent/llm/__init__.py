@@ -1,11 +1,17 @@
 from typing import Dict, Optional
 
 from qwen_agent.llm.base import LLM_REGISTRY
+from qwen_agent.utils.utils import lazy_module_attrs
 
 from .base import BaseChatModel, ModelServiceError
-from .oai import TextChatAtOAI
-from .qwen_dashscope import QwenChatAtDS
-from .qwenvl_dashscope import QwenVLChatAtDS
+
+# The models are imported on first access, since the clients of the model services take a while to import
+__getattr__, __dir__ = lazy_module_attrs(__name__, {
+    'LoadBalancedChatModel': '.balancer',
+    'QwenChatAtDS': '.qwen_dashscope',
+    'QwenVLChatAtDS': '.qwenvl_dashscope',
+    'TextChatAtOAI': '.oai',
+})
 
 
 def get_chat_model(cfg: Optional[Dict] = None) -> BaseChatModel:
@@ -23,13 +29,22 @@ def get_chat_model(cfg: Optional[Dict] = None) -> BaseChatModel:
             # (Optional) LLM hyper-parameters:
             'generate_cfg': {
                 'top_p': 0.8
-            }
+            },
+            # (Optional) Cache the responses of the same requests, only if temperature is 0 or a seed is given:
+            # 'response_cache': {'backend': 'memory', 'ttl': 3600},
+            # (Optional) Limit the requests and tokens per minute of the model in the process:
+            # 'rate_limit': {'requests_per_minute': 600, 'tokens_per_minute': 1000000},
+            # (Optional) Balance the requests among several model services, see llm/balancer.py:
+            # 'endpoints': [{'model_server': 'http://10.0.0.1:8000/v1'}, {'model_server': 'http://10.0.0.2:8000/v1'}],
           }
 
     Returns:
         LLM object.
     """
     cfg = cfg or {}
+    if 'endpoints' in cfg or isinstance(cfg.get('model_server'), list):
+        return LLM_REGISTRY['balanced'](cfg)
+
     if 'model_type' in cfg:
         model_type = cfg['model_type']
         if model_type in LLM_REGISTRY:
@@ -59,6 +74,7 @@ def get_chat_model(cfg: Optional[Dict] = None) -> BaseChatModel:
 
 __all__ = [
     'BaseChatModel',
+    'LoadBalancedChatModel',
     'QwenChatAtDS',
     'TextChatAtOAI',
     'QwenVLChatAtDS',
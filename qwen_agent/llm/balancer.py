@@ -0,0 +1,531 @@
+import asyncio
+import copy
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Literal, Optional, Union
+
+from qwen_agent.llm.base import (BaseChatModel, ModelServiceError, _aiter_list, _raise_or_delay, _raise_or_get_delay,
+                                 is_retryable_error, register_llm)
+from qwen_agent.llm.rate_limiter import PRIORITY_INTERACTIVE, RateLimiter, get_rate_limiter
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+
+DEFAULT_BALANCER_CFG = {
+    'policy': 'least_outstanding',  # Or 'ewma', i.e., the lowest EWMA latency weighted by the outstanding requests
+    'max_failures': 3,  # The number of consecutive failures to eject an endpoint
+    'ejection_time': 30.0,  # Seconds before an ejected endpoint is tried again
+    'ewma_alpha': 0.3,  # The weight of the latest latency in the EWMA latency
+}
+
+
+class Endpoint:
+    """A model server and its counters, which are updated passively by the requests sent to it."""
+
+    def __init__(self,
+                 name: str,
+                 llm: BaseChatModel,
+                 fallback: bool = False,
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.name = name
+        self.llm = llm
+        self.fallback = fallback  # A fallback endpoint is used only if no other endpoint is healthy
+        self.rate_limiter = rate_limiter  # Admit the requests before they are sent, instead of by the model
+        self.outstanding = 0
+        self.num_requests = 0
+        self.num_errors = 0
+        self.consecutive_failures = 0
+        self.ewma_latency: Optional[float] = None
+        self.ejected_until = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'name': self.name,
+            'fallback': self.fallback,
+            'healthy': self.is_healthy(time.time()),
+            'outstanding': self.outstanding,
+            'requests': self.num_requests,
+            'errors': self.num_errors,
+            'consecutive_failures': self.consecutive_failures,
+            'ewma_latency': self.ewma_latency,
+        }
+
+
+class _Request:
+    """The information of a request shared by its attempts on the endpoints."""
+
+    def __init__(self,
+                 cache_key: Optional[str] = None,
+                 return_message_type: str = '',
+                 num_input_tokens: int = 0,
+                 priority: int = PRIORITY_INTERACTIVE):
+        self.cache_key = cache_key
+        self.return_message_type = return_message_type
+        self.num_input_tokens = num_input_tokens
+        self.priority = priority
+
+
+class EndpointBalancer:
+    """Select the endpoint of each request, and eject the endpoints with consecutive failures for a while."""
+
+    def __init__(self,
+                 endpoints: List[Endpoint],
+                 policy: Literal['least_outstanding', 'ewma'] = 'least_outstanding',
+                 max_failures: int = 3,
+                 ejection_time: float = 30.0,
+                 ewma_alpha: float = 0.3):
+        if not endpoints:
+            raise ValueError('At least one endpoint is required.')
+        if policy not in ('least_outstanding', 'ewma'):
+            raise ValueError(f'Unknown balancing policy: {policy}')
+        self.endpoints = endpoints
+        self.policy = policy
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+
+    def acquire(self, exclude: Optional[List[Endpoint]] = None) -> Optional[Endpoint]:
+        """Select an endpoint not in exclude and count an outstanding request on it, or None if all are excluded."""
+        exclude = exclude or []
+        now = time.time()
+        with self._lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            if not candidates:
+                return None
+            healthy = [ep for ep in candidates if ep.is_healthy(now)]
+            if healthy:
+                primary = [ep for ep in healthy if not ep.fallback]
+                endpoint = min(primary or healthy, key=self._load)
+            else:
+                # All are ejected, so try the one to be back the soonest
+                endpoint = min(candidates, key=lambda ep: ep.ejected_until)
+            endpoint.outstanding += 1
+            endpoint.num_requests += 1
+        return endpoint
+
+    def release(self, endpoint: Endpoint, latency: Optional[float] = None, error: Optional[Exception] = None):
+        """Update the counters after a request, where the latency is None if the request is cancelled."""
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is not None:
+                endpoint.num_errors += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.max_failures:
+                    endpoint.ejected_until = time.time() + self.ejection_time
+                    logger.warning(f'Eject the model server {endpoint.name} for {self.ejection_time}s '
+                                   f'after {endpoint.consecutive_failures} consecutive failures: {error}')
+            elif latency is not None:
+                endpoint.consecutive_failures = 0
+                endpoint.ejected_until = 0.0
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency += self.ewma_alpha * (latency - endpoint.ewma_latency)
+
+    def _load(self, endpoint: Endpoint) -> tuple:
+        # The ties are broken by the number of requests, so that the idle endpoints are used in turn
+        if self.policy == 'ewma':
+            # An endpoint without latency yet is tried first
+            return ((endpoint.ewma_latency or 0.0) * (endpoint.outstanding + 1), endpoint.num_requests)
+        return (endpoint.outstanding, endpoint.num_requests)
+
+    @property
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [ep.stats for ep in self.endpoints]
+
+
+@register_llm('balanced')
+class LoadBalancedChatModel(BaseChatModel):
+    """Dispatch the requests to several model servers, and fail over a failed request to another one.
+
+    A failed request is sent to the other endpoints in turn, and then to all of them again after a backoff delay,
+    up to `max_retries` times. The delta streams are not failed over, since part of the response has been consumed.
+    The latency of a streaming request is the time to the first response. If hedging is configured, the duplicate of a
+    slow non-streaming request is sent to another endpoint.
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        """Initialize the model.
+
+        Args:
+            cfg: The LLM config with the endpoints, such as:
+              {
+                'model': 'Qwen2-72B-Instruct',
+                'endpoints': [
+                  {'model_server': 'http://10.0.0.1:8000/v1'},
+                  {'model_server': 'http://10.0.0.2:8000/v1'},
+                  {'name': 'dashscope', 'model': 'qwen-max', 'model_server': 'dashscope', 'fallback': True},
+                ],
+                'balancer': {'policy': 'ewma', 'max_failures': 3, 'ejection_time': 30},
+              }
+              where each endpoint overrides the shared config, and the endpoints can also be given by a list of
+              model servers, e.g., 'model_server': ['http://10.0.0.1:8000/v1', 'http://10.0.0.2:8000/v1'].
+              A shared 'rate_limit' limits each endpoint separately, since the limiters are keyed by the model server.
+              A request is admitted by the limiter of its endpoint before it is sent, and the duplicate of a hedged
+              request is only sent if the limiter of its endpoint admits it at once.
+        """
+        from qwen_agent.llm import get_chat_model
+
+        cfg = copy.deepcopy(cfg or {})
+        model_servers = cfg.pop('model_server') if isinstance(cfg.get('model_server'), list) else []
+        endpoint_cfgs = cfg.pop('endpoints', None) or [{'model_server': server} for server in model_servers]
+        balancer_cfg = {**DEFAULT_BALANCER_CFG, **cfg.pop('balancer', {})}
+        if cfg.get('model_type') == 'balanced':
+            cfg.pop('model_type')
+        rate_limit_cfg = cfg.pop('rate_limit', None)
+        super().__init__(cfg)
+
+        endpoints = []
+        # The requests are hedged by sending the duplicates to another endpoint, instead of by the endpoints. The
+        # responses are cached once for all the endpoints, so that a response from any endpoint is reused and a
+        # failover does not look up the cache again.
+        shared_cfg = {k: v for k, v in cfg.items() if k not in ('hedging', 'response_cache')}
+        for endpoint_cfg in endpoint_cfgs:
+            endpoint_cfg = {**shared_cfg, **endpoint_cfg}
+            endpoint_cfg.pop('response_cache', None)
+            name = endpoint_cfg.pop('name', None)
+            fallback = endpoint_cfg.pop('fallback', False)
+            endpoint_rate_limit_cfg = endpoint_cfg.pop('rate_limit', rate_limit_cfg)
+            # The failed requests are sent to another endpoint, instead of being retried by the endpoint itself
+            endpoint_cfg['generate_cfg'] = {**endpoint_cfg.get('generate_cfg', {}), 'max_retries': 0}
+            llm = get_chat_model(endpoint_cfg)
+            name = name or f'{llm.model}@{endpoint_cfg.get("model_server", "dashscope")}'
+            rate_limiter = None
+            if endpoint_rate_limit_cfg:
+                rate_limiter = get_rate_limiter(llm.model,
+                                                endpoint_rate_limit_cfg,
+                                                model_server=endpoint_cfg.get('model_server'))
+            endpoints.append(Endpoint(name=name, llm=llm, fallback=fallback, rate_limiter=rate_limiter))
+        self.balancer = EndpointBalancer(endpoints, **balancer_cfg)
+
+    @property
+    def endpoint_stats(self) -> List[dict]:
+        """The per-endpoint counters, such as the outstanding requests, the errors and the EWMA latency."""
+        return self.balancer.stats
+
+    def chat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]] = None,
+        stream: bool = True,
+        delta_stream: bool = False,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> Union[List[Message], List[Dict], Iterator[List[Message]], Iterator[List[Dict]]]:
+        kwargs = dict(messages=messages,
+                      functions=functions,
+                      stream=stream,
+                      delta_stream=delta_stream,
+                      extra_generate_cfg=extra_generate_cfg)
+        request = self._prepare_request(messages, functions, extra_generate_cfg)
+        if request.cache_key:
+            output = self.response_cache.get(request.cache_key)
+            if output is not None:
+                if stream:
+                    return self._convert_messages_iterator_to_target_type(iter([output]), request.return_message_type)
+                return self._convert_messages_to_target_type(output, request.return_message_type)
+
+        if stream:
+            output = self._chat_stream_with_failover(request, failover=not delta_stream, **kwargs)
+            if request.cache_key and not delta_stream:
+                output = self._cache_messages_iterator(output, cache_key=request.cache_key)
+            return output
+
+        output = self._chat_no_stream_with_failover(request, **kwargs)
+        if request.cache_key:
+            self.response_cache.put(request.cache_key, output)
+        return output
+
+    def _chat_no_stream_with_failover(self, request: _Request, **kwargs) -> List[Union[Message, Dict]]:
+        # A hedged request and its duplicate select the endpoints in two threads
+        tried, tried_lock = [], threading.Lock()
+
+        def _acquire_admitted(block: bool) -> Optional[Endpoint]:
+            with tried_lock:
+                endpoint = self._acquire(tried)
+            try:
+                is_admitted = self._admit(endpoint, request, block=block)
+            except BaseException:
+                self.balancer.release(endpoint)
+                raise
+            if is_admitted:
+                return endpoint
+            with tried_lock:
+                tried.remove(endpoint)
+            self.balancer.release(endpoint)
+            return None
+
+        def _call_endpoint(endpoint: Endpoint):
+            start = time.time()
+            try:
+                output = endpoint.llm.chat(**kwargs)
+            except ModelServiceError as e:
+                self._release_error(endpoint, e)
+                raise
+            except BaseException:
+                self.balancer.release(endpoint)
+                raise
+            self.balancer.release(endpoint, latency=time.time() - start)
+            return output
+
+        num_retries, delay = 0, 1.0
+        while True:
+            try:
+                # The time waiting to be admitted is neither hedged nor counted in the latency
+                endpoint = _acquire_admitted(block=True)
+                if not self.hedging:
+                    return _call_endpoint(endpoint)
+                # The admitted endpoints are taken by the request and its duplicate, whichever comes first
+                admitted = [endpoint]
+
+                def _admit_hedge() -> bool:
+                    hedge_endpoint = _acquire_admitted(block=False)
+                    if hedge_endpoint is not None:
+                        with tried_lock:
+                            admitted.append(hedge_endpoint)
+                    return hedge_endpoint is not None
+
+                def _call_admitted_endpoint():
+                    with tried_lock:
+                        admitted_endpoint = admitted.pop(0)
+                    return _call_endpoint(admitted_endpoint)
+
+                return self.hedging.run(_call_admitted_endpoint, admit_hedge=_admit_hedge)
+            except ModelServiceError as e:
+                if not is_retryable_error(e):
+                    raise
+                with tried_lock:
+                    all_tried = len(tried) >= len(self.balancer.endpoints)
+                if all_tried:
+                    num_retries, delay = _raise_or_delay(e, num_retries, delay, max_retries=self.max_retries)
+
+    def _chat_stream_with_failover(self, request: _Request, failover: bool,
+                                   **kwargs) -> Iterator[List[Union[Message, Dict]]]:
+        num_retries, delay, tried = 0, 1.0, []
+        while True:
+            endpoint = self._acquire(tried)
+            try:
+                self._admit(endpoint, request)
+                start, latency = time.time(), None
+                for rsp in endpoint.llm.chat(**kwargs):
+                    if latency is None:
+                        latency = time.time() - start
+                    yield rsp
+            except ModelServiceError as e:
+                self._release_error(endpoint, e)
+                if not failover:
+                    raise
+                if len(tried) >= len(self.balancer.endpoints):
+                    num_retries, delay = _raise_or_delay(e, num_retries, delay, max_retries=self.max_retries)
+                continue
+            except BaseException:
+                # E.g., the stream is closed by the caller
+                self.balancer.release(endpoint)
+                raise
+            self.balancer.release(endpoint, latency=(time.time() - start) if latency is None else latency)
+            return
+
+    async def achat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]] = None,
+        stream: bool = True,
+        delta_stream: bool = False,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> Union[List[Message], List[Dict], AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        kwargs = dict(messages=messages,
+                      functions=functions,
+                      stream=stream,
+                      delta_stream=delta_stream,
+                      extra_generate_cfg=extra_generate_cfg)
+        request = self._prepare_request(messages, functions, extra_generate_cfg)
+        if request.cache_key:
+            output = self.response_cache.get(request.cache_key)
+            if output is not None:
+                if stream:
+                    return self._aconvert_messages_iterator_to_target_type(_aiter_list([output]),
+                                                                           request.return_message_type)
+                return self._convert_messages_to_target_type(output, request.return_message_type)
+
+        if stream:
+            output = self._achat_stream_with_failover(request, failover=not delta_stream, **kwargs)
+            if request.cache_key and not delta_stream:
+                output = self._acache_messages_iterator(output, cache_key=request.cache_key)
+            return output
+
+        output = await self._achat_no_stream_with_failover(request, **kwargs)
+        if request.cache_key:
+            self.response_cache.put(request.cache_key, output)
+        return output
+
+    async def _achat_no_stream_with_failover(self, request: _Request, **kwargs) -> List[Union[Message, Dict]]:
+        tried = []
+
+        async def _acquire_admitted() -> Endpoint:
+            endpoint = self._acquire(tried)
+            try:
+                await self._aadmit(endpoint, request)
+            except BaseException:
+                self.balancer.release(endpoint)
+                raise
+            return endpoint
+
+        def _admit_hedge() -> bool:
+            endpoint = self._acquire(tried)
+            if self._admit(endpoint, request, block=False):
+                admitted.append(endpoint)
+                return True
+            tried.remove(endpoint)
+            self.balancer.release(endpoint)
+            return False
+
+        async def _call_admitted_endpoint():
+            endpoint = admitted.pop(0)
+            start = time.time()
+            try:
+                output = await endpoint.llm.achat(**kwargs)
+            except ModelServiceError as e:
+                self._release_error(endpoint, e)
+                raise
+            except BaseException:
+                self.balancer.release(endpoint)
+                raise
+            self.balancer.release(endpoint, latency=time.time() - start)
+            return output
+
+        num_retries, delay = 0, 1.0
+        while True:
+            try:
+                # The time waiting to be admitted is neither hedged nor counted in the latency
+                admitted = [await _acquire_admitted()]
+                if self.hedging:
+                    return await self.hedging.arun(_call_admitted_endpoint, admit_hedge=_admit_hedge)
+                return await _call_admitted_endpoint()
+            except ModelServiceError as e:
+                if not is_retryable_error(e):
+                    raise
+                if len(tried) >= len(self.balancer.endpoints):
+                    num_retries, delay = _raise_or_get_delay(e, num_retries, delay, max_retries=self.max_retries)
+                    await asyncio.sleep(delay)
+
+    async def _achat_stream_with_failover(self, request: _Request, failover: bool,
+                                          **kwargs) -> AsyncIterator[List[Union[Message, Dict]]]:
+        num_retries, delay, tried = 0, 1.0, []
+        while True:
+            endpoint = self._acquire(tried)
+            try:
+                await self._aadmit(endpoint, request)
+                start, latency = time.time(), None
+                async for rsp in await endpoint.llm.achat(**kwargs):
+                    if latency is None:
+                        latency = time.time() - start
+                    yield rsp
+            except ModelServiceError as e:
+                self._release_error(endpoint, e)
+                if not failover:
+                    raise
+                if len(tried) >= len(self.balancer.endpoints):
+                    num_retries, delay = _raise_or_get_delay(e, num_retries, delay, max_retries=self.max_retries)
+                    await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.balancer.release(endpoint)
+                raise
+            self.balancer.release(endpoint, latency=(time.time() - start) if latency is None else latency)
+            return
+
+    def _prepare_request(self, messages: List[Union[Message, Dict]], functions: Optional[List[Dict]],
+                         extra_generate_cfg: Optional[Dict]) -> _Request:
+        """Get the key of the request in the response cache and the estimated tokens to admit the request.
+
+        The messages are only preprocessed here if the response cache or the rate limiters are configured.
+        """
+        if self.response_cache is None and not any(ep.rate_limiter for ep in self.balancer.endpoints):
+            return _Request()
+        messages, functions, generate_cfg, lang, return_message_type, num_input_tokens = self._prepare_chat(
+            messages, functions=functions, extra_generate_cfg=extra_generate_cfg)
+        priority = generate_cfg.pop('priority', PRIORITY_INTERACTIVE)
+        cache_key = self._get_response_cache_key(messages, functions=functions, generate_cfg=generate_cfg, lang=lang)
+        return _Request(cache_key=cache_key,
+                        return_message_type=return_message_type,
+                        num_input_tokens=num_input_tokens,
+                        priority=priority)
+
+    @staticmethod
+    def _admit(endpoint: Endpoint, request: _Request, block: bool = True) -> bool:
+        """Admit the request by the rate limiter of the endpoint, or return False if it is not admitted at once."""
+        if endpoint.rate_limiter is None:
+            return True
+        if block:
+            endpoint.rate_limiter.acquire(tokens=request.num_input_tokens, priority=request.priority)
+            return True
+        return endpoint.rate_limiter.try_acquire(tokens=request.num_input_tokens)
+
+    @staticmethod
+    async def _aadmit(endpoint: Endpoint, request: _Request):
+        if endpoint.rate_limiter is not None:
+            await endpoint.rate_limiter.aacquire(tokens=request.num_input_tokens, priority=request.priority)
+
+    def _acquire(self, tried: List[Endpoint]) -> Endpoint:
+        """Select an endpoint not tried yet, or start a new round if all are tried, and add it to the tried ones."""
+        if len(tried) >= len(self.balancer.endpoints):
+            tried.clear()
+        endpoint = self.balancer.acquire(exclude=tried)
+        tried.append(endpoint)
+        return endpoint
+
+    def _release_error(self, endpoint: Endpoint, e: ModelServiceError):
+        if is_retryable_error(e):
+            self.balancer.release(endpoint, error=e)
+            logger.warning(f'The request to the model server {endpoint.name} failed: {e}')
+        else:
+            # Caused by the request itself rather than the endpoint, so it is neither counted nor failed over
+            self.balancer.release(endpoint)
+            raise e
+
+    # The requests are dispatched to the models of the endpoints in chat and achat, while the calls of the model
+    # service hooks, e.g., by a subclass, are delegated to the model of an endpoint selected in the same way
+    def _chat_with_functions(self, *args, **kwargs):
+        return self._call_endpoint_hook('_chat_with_functions', *args, **kwargs)
+
+    def _chat_stream(self, *args, **kwargs):
+        return self._call_endpoint_hook('_chat_stream', *args, **kwargs)
+
+    def _chat_no_stream(self, *args, **kwargs):
+        return self._call_endpoint_hook('_chat_no_stream', *args, **kwargs)
+
+    def _call_endpoint_hook(self, hook: str, *args, **kwargs) -> Union[List[Message], Iterator[List[Message]]]:
+        endpoint = self._acquire([])
+        start = time.time()
+        try:
+            output = getattr(endpoint.llm, hook)(*args, **kwargs)
+        except ModelServiceError as e:
+            self._release_error(endpoint, e)
+            raise
+        except BaseException:
+            self.balancer.release(endpoint)
+            raise
+        if isinstance(output, list):
+            self.balancer.release(endpoint, latency=time.time() - start)
+            return output
+        return self._release_after_stream(endpoint, output, start=start)
+
+    def _release_after_stream(self, endpoint: Endpoint, output: Iterator[List[Message]],
+                              start: float) -> Iterator[List[Message]]:
+        latency = None
+        try:
+            for rsp in output:
+                if latency is None:
+                    latency = time.time() - start
+                yield rsp
+        except ModelServiceError as e:
+            self._release_error(endpoint, e)
+            raise
+        except BaseException:
+            self.balancer.release(endpoint)
+            raise
+        self.balancer.release(endpoint, latency=(time.time() - start) if latency is None else latency)
@@ -1,21 +1,38 @@
+import asyncio
 import copy
 import random
 import time
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
-
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Literal, Optional, Tuple, Union
+
+from qwen_agent.llm.compact import CompactMessage, to_compact_message, to_pydantic_message
+from qwen_agent.llm.hedging import HedgingPolicy, get_hedging_policy
+from qwen_agent.llm.rate_limiter import PRIORITY_INTERACTIVE, RateLimiter, get_rate_limiter
+from qwen_agent.llm.response_cache import (BaseResponseCache, get_response_cache, get_response_cache_key,
+                                           is_deterministic)
 from qwen_agent.llm.schema import DEFAULT_SYSTEM_MESSAGE, SYSTEM, USER, Message
+from qwen_agent.llm.stop_words import StopWordsStream, get_stop_words_matcher
+from qwen_agent.log import logger
 from qwen_agent.settings import DEFAULT_MAX_INPUT_TOKENS
-from qwen_agent.utils.tokenization_qwen import tokenizer
-from qwen_agent.utils.utils import (extract_text_from_message, format_as_multimodal_message, has_chinese_messages,
-                                    merge_generate_cfgs, print_traceback)
+from qwen_agent.utils.tokenization_qwen import count_tokens_cached
+from qwen_agent.utils.utils import (LazyRegistry, extract_text_from_message, format_as_multimodal_message,
+                                    has_chinese_messages, merge_generate_cfgs, print_traceback)
 
-LLM_REGISTRY = {}
+# The built-in models are imported on first use, since the clients of the model services take a while to import
+LLM_REGISTRY = LazyRegistry({
+    'balanced': 'qwen_agent.llm.balancer',
+    'oai': 'qwen_agent.llm.oai',
+    'qwen_dashscope': 'qwen_agent.llm.qwen_dashscope',
+    'qwenvl_dashscope': 'qwen_agent.llm.qwenvl_dashscope',
+})
 
 
 def register_llm(model_type):
 
     def decorator(cls):
+        if LLM_REGISTRY.is_builtin(model_type, cls) and LLM_REGISTRY.is_registered(model_type):
+            return cls  # The built-in model has been overwritten before its module is imported
         LLM_REGISTRY[model_type] = cls
         return cls
 
@@ -47,6 +64,25 @@ class BaseChatModel(ABC):
         self.max_retries = generate_cfg.pop('max_retries', 0)
         self.generate_cfg = generate_cfg
 
+        # The opt-in cache of the responses, see llm/response_cache.py for the config
+        response_cache_cfg = cfg.get('response_cache')
+        self.response_cache: Optional[BaseResponseCache] = None
+        if response_cache_cfg:
+            self.response_cache = get_response_cache(response_cache_cfg)
+
+        # The opt-in process-wide limiter of the requests and tokens per minute of the model on the model server, e.g.:
+        #   'rate_limit': {'requests_per_minute': 600, 'tokens_per_minute': 1000000}
+        # The requests with a smaller generate_cfg['priority'] are admitted first, see llm/rate_limiter.py.
+        rate_limit_cfg = cfg.get('rate_limit')
+        self.rate_limiter: Optional[RateLimiter] = None
+        if rate_limit_cfg:
+            self.rate_limiter = get_rate_limiter(self.model, rate_limit_cfg, model_server=cfg.get('model_server'))
+
+        # The opt-in hedging of the non-streaming requests, such as:
+        #   'hedging': {'percentile': 95, 'max_extra_load': 0.1}
+        # see llm/hedging.py for the config
+        self.hedging: Optional[HedgingPolicy] = get_hedging_policy(cfg.get('hedging'))
+
     def chat(
         self,
         messages: List[Union[Message, Dict]],
@@ -70,44 +106,119 @@ class BaseChatModel(ABC):
             the generated message list response by llm.
         """
 
-        generate_cfg = merge_generate_cfgs(base_generate_cfg=self.generate_cfg, new_generate_cfg=extra_generate_cfg)
-        if 'lang' in generate_cfg:
-            lang: Literal['en', 'zh'] = generate_cfg.pop('lang')
-        else:
-            lang: Literal['en', 'zh'] = 'zh' if has_chinese_messages(messages) else 'en'
-
-        messages = copy.deepcopy(messages)
-
-        _return_message_type = 'dict'
-        new_messages = []
-        for msg in messages:
-            if isinstance(msg, dict):
-                new_messages.append(Message(**msg))
+        messages, functions, generate_cfg, lang, _return_message_type, num_input_tokens = self._prepare_chat(
+            messages, functions=functions, extra_generate_cfg=extra_generate_cfg)
+        fncall_mode = bool(functions)
+        priority = generate_cfg.pop('priority', PRIORITY_INTERACTIVE)
+
+        cache_key = self._get_response_cache_key(messages, functions=functions, generate_cfg=generate_cfg, lang=lang)
+        if cache_key:
+            output = self.response_cache.get(cache_key)
+            if output is not None:
+                if stream:
+                    # Replay the cached response as a stream of one complete response
+                    return self._convert_messages_iterator_to_target_type(iter([output]), _return_message_type)
+                return self._convert_messages_to_target_type(output, _return_message_type)
+
+        def _admit():
+            if self.rate_limiter:
+                # Every retry is admitted again, so that the retries of all the threads do not flood the service
+                self.rate_limiter.acquire(tokens=num_input_tokens, priority=priority)
+
+        def _admit_hedge() -> bool:
+            return self.rate_limiter is None or self.rate_limiter.try_acquire(tokens=num_input_tokens)
+
+        def _send_request():
+            if fncall_mode:
+                return self._chat_with_functions(
+                    messages=[to_pydantic_message(msg) for msg in messages],
+                    functions=functions,
+                    stream=stream,
+                    delta_stream=delta_stream,
+                    generate_cfg=generate_cfg,
+                    lang=lang,
+                )
             else:
-                new_messages.append(msg)
-                _return_message_type = 'message'
-        messages = new_messages
+                return self._chat(
+                    messages,
+                    stream=stream,
+                    delta_stream=delta_stream,
+                    generate_cfg=generate_cfg,
+                )
 
-        if messages[0].role != SYSTEM:
-            messages = [Message(role=SYSTEM, content=DEFAULT_SYSTEM_MESSAGE)] + messages
+        def _call_model_service():
+            _admit()
+            return _send_request()
 
-        # Not precise. It's hard to estimate tokens related with function calling and multimodal items.
-        messages = _truncate_input_messages_roughly(
-            messages=messages,
-            max_tokens=generate_cfg.pop('max_input_tokens', DEFAULT_MAX_INPUT_TOKENS),
-        )
+        def _call_model_service_hedged():
+            # The time waiting to be admitted is not counted in the hedging delay
+            _admit()
+            return self.hedging.run(_send_request, admit_hedge=_admit_hedge)
 
-        messages = self._preprocess_messages(messages, lang=lang)
+        if stream and delta_stream:
+            # No retry for delta streaming
+            output = _call_model_service()
+        elif stream and (not delta_stream):
+            output = retry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
+        elif self.hedging:
+            # Each attempt is hedged if it is slow
+            output = retry_model_service(_call_model_service_hedged, max_retries=self.max_retries)
+        else:
+            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
 
-        if functions:
-            fncall_mode = True
+        if isinstance(output, list):
+            output = self._postprocess_messages(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+            if cache_key:
+                self.response_cache.put(cache_key, output)
+            return self._convert_messages_to_target_type(output, _return_message_type)
         else:
-            fncall_mode = False
+            output = self._postprocess_messages_iterator(output,
+                                                         fncall_mode=fncall_mode,
+                                                         generate_cfg=generate_cfg,
+                                                         delta_stream=delta_stream)
+            if cache_key and not delta_stream:
+                output = self._cache_messages_iterator(output, cache_key=cache_key)
+            return self._convert_messages_iterator_to_target_type(output, _return_message_type)
 
-        def _call_model_service():
+    async def achat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]] = None,
+        stream: bool = True,
+        delta_stream: bool = False,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> Union[List[Message], List[Dict], AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        """The async version of `chat`, with the same arguments.
+
+        Returns:
+            The generated message list if stream=False, otherwise an async iterator of the message lists, such as:
+              async for rsp in await llm.achat(messages, stream=True): ...
+        """
+        messages, functions, generate_cfg, lang, _return_message_type, num_input_tokens = self._prepare_chat(
+            messages, functions=functions, extra_generate_cfg=extra_generate_cfg)
+        fncall_mode = bool(functions)
+        priority = generate_cfg.pop('priority', PRIORITY_INTERACTIVE)
+
+        cache_key = self._get_response_cache_key(messages, functions=functions, generate_cfg=generate_cfg, lang=lang)
+        if cache_key:
+            output = self.response_cache.get(cache_key)
+            if output is not None:
+                if stream:
+                    return self._aconvert_messages_iterator_to_target_type(_aiter_list([output]),
+                                                                           _return_message_type)
+                return self._convert_messages_to_target_type(output, _return_message_type)
+
+        async def _admit():
+            if self.rate_limiter:
+                await self.rate_limiter.aacquire(tokens=num_input_tokens, priority=priority)
+
+        def _admit_hedge() -> bool:
+            return self.rate_limiter is None or self.rate_limiter.try_acquire(tokens=num_input_tokens)
+
+        async def _send_request():
             if fncall_mode:
-                return self._chat_with_functions(
-                    messages=messages,
+                return await self._achat_with_functions(
+                    messages=[to_pydantic_message(msg) for msg in messages],
                     functions=functions,
                     stream=stream,
                     delta_stream=delta_stream,
@@ -115,27 +226,166 @@ class BaseChatModel(ABC):
                     lang=lang,
                 )
             else:
-                return self._chat(
+                return await self._achat(
                     messages,
                     stream=stream,
                     delta_stream=delta_stream,
                     generate_cfg=generate_cfg,
                 )
 
+        async def _call_model_service():
+            await _admit()
+            return await _send_request()
+
+        async def _call_model_service_hedged():
+            await _admit()
+            return await self.hedging.arun(_send_request, admit_hedge=_admit_hedge)
+
         if stream and delta_stream:
             # No retry for delta streaming
-            output = _call_model_service()
+            output = await _call_model_service()
         elif stream and (not delta_stream):
-            output = retry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
+            output = aretry_model_service_iterator(_call_model_service, max_retries=self.max_retries)
+        elif self.hedging:
+            output = await aretry_model_service(_call_model_service_hedged, max_retries=self.max_retries)
         else:
-            output = retry_model_service(_call_model_service, max_retries=self.max_retries)
+            output = await aretry_model_service(_call_model_service, max_retries=self.max_retries)
 
         if isinstance(output, list):
             output = self._postprocess_messages(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+            if cache_key:
+                self.response_cache.put(cache_key, output)
             return self._convert_messages_to_target_type(output, _return_message_type)
         else:
-            output = self._postprocess_messages_iterator(output, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
-            return self._convert_messages_iterator_to_target_type(output, _return_message_type)
+            output = self._apostprocess_messages_iterator(output,
+                                                          fncall_mode=fncall_mode,
+                                                          generate_cfg=generate_cfg,
+                                                          delta_stream=delta_stream)
+            if cache_key and not delta_stream:
+                output = self._acache_messages_iterator(output, cache_key=cache_key)
+            return self._aconvert_messages_iterator_to_target_type(output, _return_message_type)
+
+    def chat_batch(
+        self,
+        messages_list: List[List[Union[Message, Dict]]],
+        functions: Optional[List[Dict]] = None,
+        max_concurrency: int = 8,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> List[Union[List[Message], List[Dict], Exception]]:
+        """Chat for a batch of independent requests without streaming, with at most max_concurrency at a time.
+
+        The requests share the client pool and the rate limiter of the model. A backend with a native batch endpoint
+        may override this method.
+
+        Returns:
+            The responses in the order of the requests, where a failed request gets its exception instead of failing
+            the batch.
+        """
+
+        def _chat(messages: List[Union[Message, Dict]]) -> Union[List[Message], List[Dict], Exception]:
+            try:
+                return self.chat(messages, functions=functions, stream=False, extra_generate_cfg=extra_generate_cfg)
+            except Exception as e:
+                logger.warning(f'A request of the batch failed: {e}')
+                return e
+
+        if not messages_list:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(messages_list))) as executor:
+            return list(executor.map(_chat, messages_list))
+
+    async def achat_batch(
+        self,
+        messages_list: List[List[Union[Message, Dict]]],
+        functions: Optional[List[Dict]] = None,
+        max_concurrency: int = 8,
+        extra_generate_cfg: Optional[Dict] = None,
+    ) -> List[Union[List[Message], List[Dict], Exception]]:
+        """The async version of `chat_batch`, with the same arguments."""
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _achat(messages: List[Union[Message, Dict]]) -> Union[List[Message], List[Dict], Exception]:
+            async with semaphore:
+                try:
+                    return await self.achat(messages,
+                                            functions=functions,
+                                            stream=False,
+                                            extra_generate_cfg=extra_generate_cfg)
+                except Exception as e:
+                    logger.warning(f'A request of the batch failed: {e}')
+                    return e
+
+        return list(await asyncio.gather(*[_achat(messages) for messages in messages_list]))
+
+    def _get_response_cache_key(
+        self,
+        messages: List[Message],
+        functions: Optional[List[Dict]],
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Optional[str]:
+        """The key of the request in the response cache, or None if the response should not be cached"""
+        if self.response_cache is None or not is_deterministic(generate_cfg):
+            return None
+        return get_response_cache_key(self.model,
+                                      messages,
+                                      functions=functions,
+                                      generate_cfg=generate_cfg,
+                                      lang=lang,
+                                      model_type=type(self).__name__)
+
+    def _cache_messages_iterator(self, messages_iter: Iterator[List[Message]],
+                                 cache_key: str) -> Iterator[List[Message]]:
+        # Only the complete response is cached, i.e., not if the caller stops early or an error is raised
+        messages = None
+        for messages in messages_iter:
+            yield messages
+        if messages is not None:
+            self.response_cache.put(cache_key, messages)
+
+    async def _acache_messages_iterator(self, messages_iter: AsyncIterator[List[Message]],
+                                        cache_key: str) -> AsyncIterator[List[Message]]:
+        messages = None
+        async for messages in messages_iter:
+            yield messages
+        if messages is not None:
+            self.response_cache.put(cache_key, messages)
+
+    def _prepare_chat(
+        self,
+        messages: List[Union[Message, Dict]],
+        functions: Optional[List[Dict]],
+        extra_generate_cfg: Optional[Dict],
+    ) -> Tuple[List[Message], Optional[List[Dict]], dict, Literal['en', 'zh'], str, int]:
+        """Merge the generate_cfg, and truncate and preprocess the messages, which are shared by chat and achat.
+
+        Returns:
+            The messages, functions, generate_cfg, lang, the type of the returned messages, and the estimated number of
+            the tokens of the truncated messages.
+        """
+        generate_cfg = merge_generate_cfgs(base_generate_cfg=self.generate_cfg, new_generate_cfg=extra_generate_cfg)
+        if 'lang' in generate_cfg:
+            lang: Literal['en', 'zh'] = generate_cfg.pop('lang')
+        else:
+            lang: Literal['en', 'zh'] = 'zh' if has_chinese_messages(messages) else 'en'
+
+        _return_message_type = 'dict'
+        if any(not isinstance(msg, dict) for msg in messages):
+            _return_message_type = 'message'
+        # The messages are processed as new compact messages, which are converted back to the returned type at last
+        messages = [to_compact_message(msg) for msg in messages]
+
+        if messages[0].role != SYSTEM:
+            messages = [CompactMessage(role=SYSTEM, content=DEFAULT_SYSTEM_MESSAGE)] + messages
+
+        # Not precise. It's hard to estimate tokens related with function calling and multimodal items.
+        messages, num_input_tokens = _truncate_input_messages_roughly(
+            messages=messages,
+            max_tokens=generate_cfg.pop('max_input_tokens', DEFAULT_MAX_INPUT_TOKENS),
+        )
+
+        messages = self._preprocess_messages(messages, lang=lang)
+        return messages, functions, generate_cfg, lang, _return_message_type, num_input_tokens
 
     def _chat(
         self,
@@ -144,11 +394,26 @@ class BaseChatModel(ABC):
         delta_stream: bool,
         generate_cfg: dict,
     ) -> Union[List[Message], Iterator[List[Message]]]:
+        # The model service hooks, which may be implemented by the users, get the public Message type
+        messages = [to_pydantic_message(msg) for msg in messages]
         if stream:
             return self._chat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
         else:
             return self._chat_no_stream(messages, generate_cfg=generate_cfg)
 
+    async def _achat(
+        self,
+        messages: List[Message],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        messages = [to_pydantic_message(msg) for msg in messages]
+        if stream:
+            return self._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+        else:
+            return await self._achat_no_stream(messages, generate_cfg=generate_cfg)
+
     @abstractmethod
     def _chat_with_functions(
         self,
@@ -178,6 +443,46 @@ class BaseChatModel(ABC):
     ) -> List[Message]:
         raise NotImplementedError
 
+    async def _achat_with_functions(
+        self,
+        messages: List[Message],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        # Run the sync implementation in a worker thread, if the model has no native async implementation
+        output = await asyncio.to_thread(self._chat_with_functions,
+                                         messages=messages,
+                                         functions=functions,
+                                         stream=stream,
+                                         delta_stream=delta_stream,
+                                         generate_cfg=generate_cfg,
+                                         lang=lang)
+        if isinstance(output, list):
+            return output
+        return _iterate_in_thread(output)
+
+    async def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        # Run the sync implementation in a worker thread, if the model has no native async implementation
+        it = self._chat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg)
+        async for rsp in _iterate_in_thread(it):
+            yield rsp
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        # Run the sync implementation in a worker thread, if the model has no native async implementation
+        return await asyncio.to_thread(self._chat_no_stream, messages, generate_cfg=generate_cfg)
+
     def _preprocess_messages(self, messages: List[Message], lang: Literal['en', 'zh']) -> List[Message]:
         messages = [format_as_multimodal_message(msg, add_upload_info=True, lang=lang) for msg in messages]
         return messages
@@ -188,7 +493,7 @@ class BaseChatModel(ABC):
         fncall_mode: bool,
         generate_cfg: dict,
     ) -> List[Message]:
-        messages = [format_as_multimodal_message(msg, add_upload_info=False) for msg in messages]
+        messages = [format_as_multimodal_message(to_compact_message(msg), add_upload_info=False) for msg in messages]
         messages = self._postprocess_stop_words(messages, generate_cfg=generate_cfg)
         return messages
 
@@ -197,18 +502,55 @@ class BaseChatModel(ABC):
         messages: Iterator[List[Message]],
         fncall_mode: bool,
         generate_cfg: dict,
+        delta_stream: bool = False,
     ) -> Iterator[List[Message]]:
-        for m in messages:
-            m = self._postprocess_messages(m, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
-            # TODO: Postprocessing may be incorrect if delta_stream=True.
-            # TODO: Early break if truncated at stop words.
+        # The stop words are handled incrementally by the stream, instead of rescanning the full response every time
+        stop_words_stream = StopWordsStream(generate_cfg.get('stop', []), delta_stream=delta_stream)
+        generate_cfg = {**generate_cfg, 'stop': []}
+        try:
+            for m in messages:
+                m = stop_words_stream.process(m)
+                m = self._postprocess_messages(m, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+                if m:
+                    yield m
+                if stop_words_stream.stopped:
+                    # Stop generating as soon as a stop word is seen
+                    break
+            m = stop_words_stream.flush()
             if m:
-                yield m
+                yield self._postprocess_messages(m, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        finally:
+            if hasattr(messages, 'close'):
+                messages.close()
+
+    async def _apostprocess_messages_iterator(
+        self,
+        messages: AsyncIterator[List[Message]],
+        fncall_mode: bool,
+        generate_cfg: dict,
+        delta_stream: bool = False,
+    ) -> AsyncIterator[List[Message]]:
+        stop_words_stream = StopWordsStream(generate_cfg.get('stop', []), delta_stream=delta_stream)
+        generate_cfg = {**generate_cfg, 'stop': []}
+        try:
+            async for m in messages:
+                m = stop_words_stream.process(m)
+                m = self._postprocess_messages(m, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+                if m:
+                    yield m
+                if stop_words_stream.stopped:
+                    break
+            m = stop_words_stream.flush()
+            if m:
+                yield self._postprocess_messages(m, fncall_mode=fncall_mode, generate_cfg=generate_cfg)
+        finally:
+            if hasattr(messages, 'aclose'):
+                await messages.aclose()
 
     def _convert_messages_to_target_type(self, messages: List[Message],
                                          target_type: str) -> Union[List[Message], List[Dict]]:
         if target_type == 'message':
-            return [Message(**x) if isinstance(x, dict) else x for x in messages]
+            return [Message(**x) if isinstance(x, dict) else to_pydantic_message(x) for x in messages]
         elif target_type == 'dict':
             return [x.model_dump() if not isinstance(x, dict) else x for x in messages]
         else:
@@ -220,9 +562,17 @@ class BaseChatModel(ABC):
         for messages in messages_iter:
             yield self._convert_messages_to_target_type(messages, target_type)
 
+    async def _aconvert_messages_iterator_to_target_type(
+            self, messages_iter: AsyncIterator[List[Message]],
+            target_type: str) -> Union[AsyncIterator[List[Message]], AsyncIterator[List[Dict]]]:
+        async for messages in messages_iter:
+            yield self._convert_messages_to_target_type(messages, target_type)
+
     def _postprocess_stop_words(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
-        messages = copy.deepcopy(messages)
         stop = generate_cfg.get('stop', [])
+        if not stop:
+            return messages
+        messages = copy.deepcopy(messages)
 
         # Make sure it stops before stop words.
         trunc_messages = []
@@ -243,25 +593,22 @@ class BaseChatModel(ABC):
         messages = trunc_messages
 
         # It may ends with 'Observation' when the stop word is 'Observation:'.
-        partial_stop = []
-        for s in stop:
-            s = tokenizer.tokenize(s)[:-1]
-            if s:
-                s = tokenizer.convert_tokens_to_string(s)
-                partial_stop.append(s)
-        partial_stop = sorted(set(partial_stop))
+        matcher = get_stop_words_matcher(tuple(stop))
         last_msg = messages[-1].content
         for i in range(len(last_msg) - 1, -1, -1):
             item_type, item_text = last_msg[i].get_type_and_value()
             if item_type == 'text':
-                for s in partial_stop:
-                    if item_text.endswith(s):
-                        last_msg[i].text = item_text[:-len(s)]
+                last_msg[i].text = matcher.strip_partial_stop(item_text)
                 break
 
         return messages
 
 
+async def _aiter_list(items: list) -> AsyncIterator:
+    for item in items:
+        yield item
+
+
 def _truncate_at_stop_word(text: str, stop: List[str]):
     truncated = False
     for s in stop:
@@ -272,7 +619,7 @@ def _truncate_at_stop_word(text: str, stop: List[str]):
     return truncated, text
 
 
-def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -> List[Message]:
+def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -> Tuple[List[Message], int]:
     sys_msg = messages[0]
     assert sys_msg.role == SYSTEM  # The default system is prepended if none exists
     if len([m for m in messages if m.role == SYSTEM]) >= 2:
@@ -296,25 +643,24 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
                 )
 
     def _count_tokens(msg: Message) -> int:
-        return tokenizer.count_tokens(extract_text_from_message(msg, add_upload_info=True))
+        # The history messages are the same in the LLM calls of a conversation, so their counts are memoized
+        return count_tokens_cached(extract_text_from_message(msg, add_upload_info=True))
 
+    # Keep the latest turns whose reverse cumulative sum of the tokens is within max_tokens
     token_cnt = _count_tokens(sys_msg)
-    truncated = []
-    for i, turn in enumerate(reversed(turns)):
-        cur_turn_msgs = []
-        cur_token_cnt = 0
-        for m in reversed(turn):
-            cur_turn_msgs.append(m)
-            cur_token_cnt += _count_tokens(m)
-        # Check "i == 0" so that at least one user message is included
-        if (i == 0) or (token_cnt + cur_token_cnt <= max_tokens):
-            truncated.extend(cur_turn_msgs)
+    num_kept_turns = 0
+    for turn in reversed(turns):
+        cur_token_cnt = sum(_count_tokens(m) for m in turn)
+        # Check "num_kept_turns == 0" so that at least one user message is included
+        if (num_kept_turns == 0) or (token_cnt + cur_token_cnt <= max_tokens):
             token_cnt += cur_token_cnt
+            num_kept_turns += 1
         else:
             break
     # Always include the system message
-    truncated.append(sys_msg)
-    truncated.reverse()
+    truncated = [sys_msg]
+    for turn in turns[len(turns) - num_kept_turns:]:
+        truncated.extend(turn)
 
     if len(truncated) < 2:  # one system message + one or more user messages
         raise ModelServiceError(
@@ -329,7 +675,7 @@ def _truncate_input_messages_roughly(messages: List[Message], max_tokens: int) -
             'To configure the context limit, please specifiy "max_input_tokens" in the model generate_cfg. '
             f'Example: generate_cfg = {{..., "max_input_tokens": {(token_cnt // 100 + 1) * 100}}}',
         )
-    return truncated
+    return truncated, token_cnt
 
 
 def retry_model_service(
@@ -364,6 +710,40 @@ def retry_model_service_iterator(
             num_retries, delay = _raise_or_delay(e, num_retries, delay, max_retries)
 
 
+async def aretry_model_service(
+    fn,
+    max_retries: int = 10,
+) -> Any:
+    """Retry a coroutine function, waiting without blocking the event loop"""
+
+    num_retries, delay = 0, 1.0
+    while True:
+        try:
+            return await fn()
+
+        except ModelServiceError as e:
+            num_retries, delay = _raise_or_get_delay(e, num_retries, delay, max_retries)
+            await asyncio.sleep(delay)
+
+
+async def aretry_model_service_iterator(
+    it_fn,
+    max_retries: int = 10,
+) -> AsyncIterator:
+    """Retry an async iterator, where it_fn is a coroutine function returning the async iterator"""
+
+    num_retries, delay = 0, 1.0
+    while True:
+        try:
+            async for rsp in await it_fn():
+                yield rsp
+            break
+
+        except ModelServiceError as e:
+            num_retries, delay = _raise_or_get_delay(e, num_retries, delay, max_retries)
+            await asyncio.sleep(delay)
+
+
 def _raise_or_delay(
     e: ModelServiceError,
     num_retries: int,
@@ -373,18 +753,30 @@ def _raise_or_delay(
     exponential_base: float = 2.0,
 ) -> Tuple[int, float]:
     """Retry with exponential backoff"""
+    num_retries, delay = _raise_or_get_delay(e,
+                                             num_retries,
+                                             delay,
+                                             max_retries=max_retries,
+                                             max_delay=max_delay,
+                                             exponential_base=exponential_base)
+    time.sleep(delay)
+    return num_retries, delay
 
-    if max_retries <= 0:  # no retry
-        raise e
 
-    # If harmful input or output detected, let it fail
-    if e.code == 'DataInspectionFailed':
-        raise e
-    if 'inappropriate content' in str(e):
+def _raise_or_get_delay(
+    e: ModelServiceError,
+    num_retries: int,
+    delay: float,
+    max_retries: int = 10,
+    max_delay: float = 300.0,
+    exponential_base: float = 2.0,
+) -> Tuple[int, float]:
+    """Raise the error if it should not be retried, otherwise return the number of retries and the next delay"""
+
+    if max_retries <= 0:  # no retry
         raise e
 
-    # Retry is meaningless if the input is too long
-    if 'maximum context length' in str(e):
+    if not is_retryable_error(e):
         raise e
 
     print_traceback(is_error=False)
@@ -395,5 +787,30 @@ def _raise_or_delay(
     num_retries += 1
     jittor = 1.0 + random.random()
     delay = min(delay * exponential_base, max_delay) * jittor
-    time.sleep(delay)
     return num_retries, delay
+
+
+def is_retryable_error(e: ModelServiceError) -> bool:
+    """Whether the error may be gone by retrying, i.e., not caused by the request itself"""
+
+    # If harmful input or output detected, let it fail
+    if e.code == 'DataInspectionFailed':
+        return False
+    if 'inappropriate content' in str(e):
+        return False
+
+    # Retry is meaningless if the input is too long
+    if 'maximum context length' in str(e):
+        return False
+
+    return True
+
+
+async def _iterate_in_thread(it: Iterator) -> AsyncIterator:
+    """Iterate a blocking iterator in worker threads, one item at a time"""
+    sentinel = object()
+    while True:
+        item = await asyncio.to_thread(next, it, sentinel)
+        if item is sentinel:
+            break
+        yield item
@@ -0,0 +1,166 @@
+"""The compact messages used inside the LLMs.
+
+The pydantic models in schema.py validate on every construction and dump themselves on every access of
+`ContentItem.type`, which dominates the time of preprocessing and postprocessing the messages of a long conversation.
+The classes here mirror the dict-like interface of `Message`, `ContentItem` and `FunctionCall` with plain slots, and
+the messages are converted from and to the pydantic models only at the boundary of `BaseChatModel.chat` and of the
+model service hooks, such as `_chat_stream`, which get and return the pydantic models.
+"""
+
+from typing import Dict, List, Literal, Optional, Tuple, Union
+
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
+
+_ROLES = (USER, ASSISTANT, SYSTEM, FUNCTION)
+
+
+class _CompactModel:
+    __slots__ = ()
+
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return value if value else default
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (_CompactModel, Message, ContentItem, FunctionCall)):
+            return self.model_dump() == other.model_dump()
+        return NotImplemented
+
+    def __str__(self):
+        return f'{self.model_dump()}'
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.model_dump()})'
+
+    def model_dump(self) -> dict:
+        raise NotImplementedError
+
+
+class CompactFunctionCall(_CompactModel):
+    __slots__ = ('name', 'arguments')
+
+    def __init__(self, name: str, arguments: str):
+        self.name = name
+        self.arguments = arguments
+
+    def __deepcopy__(self, memo):
+        return CompactFunctionCall(self.name, self.arguments)
+
+    def model_dump(self) -> dict:
+        return {'name': self.name, 'arguments': self.arguments}
+
+
+class CompactContentItem(_CompactModel):
+    __slots__ = ('text', 'image', 'file')
+
+    def __init__(self, text: Optional[str] = None, image: Optional[str] = None, file: Optional[str] = None):
+        self.text = text
+        self.image = image
+        self.file = file
+
+    def __deepcopy__(self, memo):
+        return CompactContentItem(self.text, self.image, self.file)
+
+    def get_type_and_value(self) -> Tuple[Literal['text', 'image', 'file'], str]:
+        if self.text is not None:
+            return 'text', self.text
+        if self.image is not None:
+            return 'image', self.image
+        return 'file', self.file
+
+    @property
+    def type(self) -> Literal['text', 'image', 'file']:
+        return self.get_type_and_value()[0]
+
+    @property
+    def value(self) -> str:
+        return self.get_type_and_value()[1]
+
+    def model_dump(self) -> dict:
+        return {k: v for k, v in (('text', self.text), ('image', self.image), ('file', self.file)) if v is not None}
+
+
+class CompactMessage(_CompactModel):
+    __slots__ = ('role', 'content', 'name', 'function_call')
+
+    def __init__(self,
+                 role: str,
+                 content: Optional[Union[str, List[CompactContentItem]]],
+                 name: Optional[str] = None,
+                 function_call: Optional[CompactFunctionCall] = None):
+        self.role = role
+        self.content = '' if content is None else content
+        self.name = name
+        self.function_call = function_call
+
+    def __deepcopy__(self, memo):
+        # The strings are immutable, so only the containers are copied
+        content = self.content if isinstance(self.content, str) else [item.__deepcopy__(memo) for item in self.content]
+        function_call = self.function_call.__deepcopy__(memo) if self.function_call else None
+        return CompactMessage(self.role, content, name=self.name, function_call=function_call)
+
+    def model_dump(self) -> dict:
+        res = {
+            'role': self.role,
+            'content': self.content if isinstance(self.content, str) else [item.model_dump() for item in self.content],
+        }
+        if self.name is not None:
+            res['name'] = self.name
+        if self.function_call is not None:
+            res['function_call'] = self.function_call.model_dump()
+        return res
+
+
+def to_compact_message(msg: Union[Message, CompactMessage, Dict]) -> CompactMessage:
+    """Convert a message to a new compact message, where a dict is checked as strictly as `Message(**msg)`."""
+    if isinstance(msg, dict):
+        role = msg.get('role')
+        if role not in _ROLES:
+            raise ValueError(f'{role} must be one of {",".join(_ROLES)}')
+        content, name, function_call = msg.get('content'), msg.get('name'), msg.get('function_call')
+    else:
+        role, content, name, function_call = msg.role, msg.content, msg.name, msg.function_call
+    if content is None:
+        content = ''
+    elif not isinstance(content, str):
+        if not isinstance(content, list):
+            raise ValueError(f'The content of a message must be a str or a list, but got {type(content).__name__}')
+        content = [_to_compact_content_item(item) for item in content]
+    if function_call is not None:
+        if isinstance(function_call, dict):
+            if not isinstance(function_call.get('name'), str) or not isinstance(function_call.get('arguments'), str):
+                raise ValueError(f'The function_call must have the name and the arguments, but got {function_call}')
+            function_call = CompactFunctionCall(function_call['name'], function_call['arguments'])
+        else:
+            function_call = CompactFunctionCall(function_call.name, function_call.arguments)
+    return CompactMessage(role, content, name=name, function_call=function_call)
+
+
+def _to_compact_content_item(item: Union[ContentItem, CompactContentItem, Dict]) -> CompactContentItem:
+    if isinstance(item, dict):
+        text, image, file = item.get('text'), item.get('image'), item.get('file')
+        if (text is not None) + bool(image) + bool(file) != 1:
+            raise ValueError("Exactly one of 'text', 'image', or 'file' must be provided.")
+        return CompactContentItem(text, image, file)
+    if not isinstance(item, (ContentItem, CompactContentItem)):
+        raise ValueError(f'The content item must be a dict or a ContentItem, but got {type(item).__name__}')
+    return CompactContentItem(item.text, item.image, item.file)
+
+
+def to_pydantic_message(msg: Union[Message, CompactMessage]) -> Message:
+    """Convert a compact message to a `Message` without validating it again."""
+    if isinstance(msg, Message):
+        return msg
+    content = msg.content
+    if not isinstance(content, str):
+        content = [ContentItem.model_construct(text=item.text, image=item.image, file=item.file) for item in content]
+    function_call = msg.function_call
+    if function_call is not None:
+        function_call = FunctionCall.model_construct(name=function_call.name, arguments=function_call.arguments)
+    return Message.model_construct(role=msg.role, content=content, name=msg.name, function_call=function_call)
@@ -1,10 +1,11 @@
 import copy
 import json
 from abc import ABC
-from typing import Dict, Iterator, List, Literal, Optional, Union
+from typing import AsyncIterator, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
 from qwen_agent.llm.base import BaseChatModel
-from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, FunctionCall, Message
+from qwen_agent.llm.compact import CompactContentItem, CompactFunctionCall, CompactMessage, to_compact_message
+from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, Message
 
 
 class BaseFnCallModel(BaseChatModel, ABC):
@@ -39,22 +40,22 @@ class BaseFnCallModel(BaseChatModel, ABC):
                     func_content = '\n' if new_messages[-1].role == ASSISTANT else ''
                     func_content += f'{FN_NAME}: {f_name}'
                     func_content += f'\n{FN_ARGS}: {f_args}'
-                    content.append(ContentItem(text=func_content))
+                    content.append(CompactContentItem(text=func_content))
                 if new_messages[-1].role == ASSISTANT:
                     new_messages[-1].content += content
                 else:
-                    new_messages.append(Message(role=role, content=content))
+                    new_messages.append(CompactMessage(role=role, content=content))
             elif role == FUNCTION:
                 assert new_messages[-1].role == ASSISTANT
                 assert isinstance(content, list)
                 if content:
                     assert len(content) == 1
-                    assert isinstance(content[0], ContentItem)
+                    assert isinstance(content[0], CompactContentItem)
                     f_result = content[0].text
                     assert f_result is not None
                 else:
                     f_result = ''
-                new_messages[-1].content += [ContentItem(text=f'\n{FN_RESULT}: {f_result}\n{FN_EXIT}: ')]
+                new_messages[-1].content += [CompactContentItem(text=f'\n{FN_RESULT}: {f_result}\n{FN_EXIT}: ')]
             else:
                 raise TypeError
 
@@ -79,10 +80,26 @@ class BaseFnCallModel(BaseChatModel, ABC):
         generate_cfg: dict,
         lang: Literal['en', 'zh'],
     ) -> Union[List[Message], Iterator[List[Message]]]:
-        if delta_stream:
-            raise NotImplementedError
-        messages = self._prepend_fncall_system(messages, functions, lang=lang)
-        return self._continue_assistant_response(messages, generate_cfg=generate_cfg, stream=stream)
+        messages = self._prepend_fncall_system([to_compact_message(msg) for msg in messages], functions, lang=lang)
+        return self._continue_assistant_response(messages,
+                                                 generate_cfg=generate_cfg,
+                                                 stream=stream,
+                                                 delta_stream=delta_stream)
+
+    async def _achat_with_functions(
+        self,
+        messages: List[Message],
+        functions: List[Dict],
+        stream: bool,
+        delta_stream: bool,
+        generate_cfg: dict,
+        lang: Literal['en', 'zh'],
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        messages = self._prepend_fncall_system([to_compact_message(msg) for msg in messages], functions, lang=lang)
+        return await self._acontinue_assistant_response(messages,
+                                                        generate_cfg=generate_cfg,
+                                                        stream=stream,
+                                                        delta_stream=delta_stream)
 
     def _prepend_fncall_system(
         self,
@@ -100,7 +117,7 @@ class BaseFnCallModel(BaseChatModel, ABC):
         if isinstance(messages[0].content, str):
             messages[0].content += tool_system
         else:
-            messages[0].content.append(ContentItem(text=tool_system))
+            messages[0].content.append(CompactContentItem(text=tool_system))
 
         return messages
 
@@ -109,7 +126,23 @@ class BaseFnCallModel(BaseChatModel, ABC):
         messages: List[Message],
         generate_cfg: dict,
         stream: bool,
+        delta_stream: bool = False,
     ) -> Iterator[List[Message]]:
+        messages = self._merge_assistant_response_into_user(messages)
+        return self._chat(messages, stream=stream, delta_stream=delta_stream, generate_cfg=generate_cfg)
+
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+        delta_stream: bool = False,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        messages = self._merge_assistant_response_into_user(messages)
+        return await self._achat(messages, stream=stream, delta_stream=delta_stream, generate_cfg=generate_cfg)
+
+    @staticmethod
+    def _merge_assistant_response_into_user(messages: List[Message]) -> List[Message]:
         # Simulate text completion with chat completion
         if messages and messages[-1].role == ASSISTANT:
             assert len(messages) > 1 and messages[-2].role == USER
@@ -119,13 +152,13 @@ class BaseFnCallModel(BaseChatModel, ABC):
             if isinstance(usr, str) and isinstance(bot, str):
                 usr = usr + '\n\n' + bot
             elif isinstance(usr, list) and isinstance(bot, list):
-                usr = usr + [ContentItem(text='\n\n')] + bot
+                usr = usr + [CompactContentItem(text='\n\n')] + bot
             else:
                 raise NotImplementedError
             text_to_complete = copy.deepcopy(messages[-2])
             text_to_complete.content = usr
             messages = messages[:-2] + [text_to_complete]
-        return self._chat(messages, stream=stream, delta_stream=False, generate_cfg=generate_cfg)
+        return messages
 
     def _postprocess_messages(
         self,
@@ -138,6 +171,75 @@ class BaseFnCallModel(BaseChatModel, ABC):
             messages = self._postprocess_fncall_messages(messages)
         return messages
 
+    def _postprocess_messages_iterator(
+        self,
+        messages: Iterator[List[Message]],
+        fncall_mode: bool,
+        generate_cfg: dict,
+        delta_stream: bool = False,
+    ) -> Iterator[List[Message]]:
+        if fncall_mode and delta_stream:
+            return self._postprocess_fncall_delta_iterator(messages, generate_cfg=generate_cfg)
+        return super()._postprocess_messages_iterator(messages,
+                                                      fncall_mode=fncall_mode,
+                                                      generate_cfg=generate_cfg,
+                                                      delta_stream=delta_stream)
+
+    def _apostprocess_messages_iterator(
+        self,
+        messages: AsyncIterator[List[Message]],
+        fncall_mode: bool,
+        generate_cfg: dict,
+        delta_stream: bool = False,
+    ) -> AsyncIterator[List[Message]]:
+        if fncall_mode and delta_stream:
+            return self._apostprocess_fncall_delta_iterator(messages, generate_cfg=generate_cfg)
+        return super()._apostprocess_messages_iterator(messages,
+                                                       fncall_mode=fncall_mode,
+                                                       generate_cfg=generate_cfg,
+                                                       delta_stream=delta_stream)
+
+    def _postprocess_fncall_delta_iterator(self, messages: Iterator[List[Message]],
+                                           generate_cfg: dict) -> Iterator[List[Message]]:
+        # The stop words are handled by the delta stream first, and then the function calls
+        output = super()._postprocess_messages_iterator(messages,
+                                                        fncall_mode=False,
+                                                        generate_cfg=generate_cfg,
+                                                        delta_stream=True)
+        fncall_stream = FnCallDeltaStream()
+        try:
+            for m in output:
+                m = fncall_stream.process(m)
+                if m:
+                    yield m
+                if fncall_stream.stopped:
+                    break
+            m = fncall_stream.flush()
+            if m:
+                yield m
+        finally:
+            output.close()
+
+    async def _apostprocess_fncall_delta_iterator(self, messages: AsyncIterator[List[Message]],
+                                                  generate_cfg: dict) -> AsyncIterator[List[Message]]:
+        output = super()._apostprocess_messages_iterator(messages,
+                                                         fncall_mode=False,
+                                                         generate_cfg=generate_cfg,
+                                                         delta_stream=True)
+        fncall_stream = FnCallDeltaStream()
+        try:
+            async for m in output:
+                m = fncall_stream.process(m)
+                if m:
+                    yield m
+                if fncall_stream.stopped:
+                    break
+            m = fncall_stream.flush()
+            if m:
+                yield m
+        finally:
+            await output.aclose()
+
     def _postprocess_fncall_messages(self, messages: List[Message], stop_at_fncall: bool = True) -> List[Message]:
         """
         If the model calls function by built-in function call template,
@@ -161,7 +263,7 @@ class BaseFnCallModel(BaseChatModel, ABC):
             assert isinstance(content, list)
 
             if role in (SYSTEM, USER):
-                new_messages.append(Message(role=role, content=content))
+                new_messages.append(CompactMessage(role=role, content=content))
                 continue
 
             new_content = []
@@ -176,7 +278,7 @@ class BaseFnCallModel(BaseChatModel, ABC):
                 if i < 0:  # no function call
                     show_text = remove_incomplete_special_tokens(item_text)
                     if show_text:
-                        new_content.append(ContentItem(text=show_text))
+                        new_content.append(CompactContentItem(text=show_text))
                     continue
 
                 if i > 0:
@@ -185,9 +287,9 @@ class BaseFnCallModel(BaseChatModel, ABC):
                         answer = answer[:-1]
                     show_text = remove_incomplete_special_tokens(answer)
                     if show_text:
-                        new_content.append(ContentItem(text=show_text))
+                        new_content.append(CompactContentItem(text=show_text))
                     if new_content:
-                        new_messages.append(Message(
+                        new_messages.append(CompactMessage(
                             role=role,
                             content=new_content,
                         ))  # split thought and function call
@@ -197,30 +299,12 @@ class BaseFnCallModel(BaseChatModel, ABC):
                 for part in item_text.split(f'{FN_NAME}:'):
                     if not part:
                         continue
-                    if part.endswith('\n'):
-                        part = part[:-1]
-                    i = part.find(f'\n{FN_ARGS}:')
-                    j = part.find(f'\n{FN_RESULT}:')
-                    k = part.find(f'\n{FN_EXIT}:')
-                    fn_name, fn_args, result, answer = '', '', '', ''
-                    if i < 0:
-                        fn_name = part.strip()
-                    else:
-                        fn_name = part[:i].strip()
-                        if j < i:
-                            fn_args = part[i + len(f'\n{FN_ARGS}:'):].strip()
-                        else:
-                            fn_args = part[i + len(f'\n{FN_ARGS}:'):j].strip()
-                            if k < j:
-                                result = part[j + len(f'\n{FN_RESULT}:'):]
-                            else:
-                                result = part[j + len(f'\n{FN_RESULT}:'):k]
-                                answer = part[k + len(f'\n{FN_EXIT}:'):]
+                    fn_name, fn_args, result, answer = _split_fncall_part(part)
                     new_messages.append(
-                        Message(
+                        CompactMessage(
                             role=ASSISTANT,
                             content=[],
-                            function_call=FunctionCall(
+                            function_call=CompactFunctionCall(
                                 name=remove_incomplete_special_tokens(fn_name),
                                 arguments=remove_incomplete_special_tokens(fn_args),
                             ),
@@ -234,9 +318,9 @@ class BaseFnCallModel(BaseChatModel, ABC):
                         # rm the ' ' after ':'
                         show_text = remove_incomplete_special_tokens(result[1:])
                         new_messages.append(
-                            Message(
+                            CompactMessage(
                                 role=FUNCTION,
-                                content=[ContentItem(text=show_text)],
+                                content=[CompactContentItem(text=show_text)],
                                 name=remove_incomplete_special_tokens(fn_name),
                             ))
 
@@ -244,12 +328,12 @@ class BaseFnCallModel(BaseChatModel, ABC):
                         # rm the ' ' after ':'
                         show_text = remove_incomplete_special_tokens(answer[1:])
                         if show_text:
-                            new_messages.append(Message(
+                            new_messages.append(CompactMessage(
                                 role=ASSISTANT,
-                                content=[ContentItem(text=show_text)],
+                                content=[CompactContentItem(text=show_text)],
                             ))
             if new_content:
-                new_messages.append(Message(role=role, content=new_content))
+                new_messages.append(CompactMessage(role=role, content=new_content))
 
         return new_messages
 
@@ -327,8 +411,39 @@ def get_function_description(function: Dict, lang: Literal['en', 'zh']) -> str:
                             args_format=args_format).rstrip()
 
 
+def _split_fncall_part(part: str) -> Tuple[str, str, str, str]:
+    """Split the text after '✿FUNCTION✿:' into the function name, the arguments, the result and the answer."""
+    if part.endswith('\n'):
+        part = part[:-1]
+    i = part.find(f'\n{FN_ARGS}:')
+    j = part.find(f'\n{FN_RESULT}:')
+    k = part.find(f'\n{FN_EXIT}:')
+    fn_name, fn_args, result, answer = '', '', '', ''
+    if i < 0:
+        fn_name = part.strip()
+    else:
+        fn_name = part[:i].strip()
+        if j < i:
+            fn_args = part[i + len(f'\n{FN_ARGS}:'):].strip()
+        else:
+            fn_args = part[i + len(f'\n{FN_ARGS}:'):j].strip()
+            if k < j:
+                result = part[j + len(f'\n{FN_RESULT}:'):]
+            else:
+                result = part[j + len(f'\n{FN_RESULT}:'):k]
+                answer = part[k + len(f'\n{FN_EXIT}:'):]
+    return fn_name, fn_args, result, answer
+
+
 # Mainly for removing incomplete trailing special tokens when streaming the output
 def remove_incomplete_special_tokens(text: str) -> str:
+    text = _remove_trailing_special_tokens(text)
+    text = text.lstrip('\n').rstrip()
+    return text
+
+
+def _remove_trailing_special_tokens(text: str) -> str:
+    """Remove the trailing spaces and the trailing special token, complete or not. The result is a prefix of text."""
     special_tokens = (FN_NAME, FN_ARGS, FN_RESULT, FN_EXIT)
     text = text.rstrip()
     if text.endswith(special_tokens):
@@ -343,5 +458,119 @@ def remove_incomplete_special_tokens(text: str) -> str:
             if s.startswith(trail_token):
                 text = text[:trail_start]
                 break
-    text = text.lstrip('\n').rstrip()
-    return text
+    return text.rstrip()
+
+
+class FnCallDeltaStream:
+    """Parse the function calls in a delta stream incrementally, which is the delta version of
+    `BaseFnCallModel._postprocess_fncall_messages` with `stop_at_fncall=True`.
+
+    The text before '✿FUNCTION✿:' is streamed as delta messages, except for the trailing spaces and the special token
+    that may be incomplete, which are held back until more text comes. The function call is returned only once its
+    arguments are closed, i.e., by '✿RESULT✿:', the next function call, or the end of the stream. Once the function
+    call is returned, `stopped` is set and the caller should close the upstream.
+    """
+
+    def __init__(self):
+        self.stopped = False
+        self._started = False  # Whether the leading ': ' of the continued generation is removed
+        self._has_answer = False  # Whether any text before the function call is returned
+        self._held = ''
+        self._fn_text: Optional[str] = None  # The text after '✿FUNCTION✿:', None if no function call yet
+        self._fn_scanned = 0
+        self._role = ASSISTANT
+        self._is_str = True  # Whether to return the content as a string, which is the same as the input
+
+    def process(self, messages: List[Message]) -> List[Message]:
+        text = ''
+        for msg in messages:
+            self._role = msg.role
+            self._is_str = isinstance(msg.content, str)
+            if self._is_str:
+                text += msg.content
+            else:
+                text += ''.join(item.text for item in msg.content if item.text)
+        if self.stopped or not text:
+            return []
+        if self._fn_text is not None:
+            return self._process_fncall(text)
+
+        self._held += text
+        if not self._started:
+            if self._held == ':':  # Unknown whether it is ': ' yet
+                return []
+            # Remove ': ' brought by continued generation of function calling
+            if self._held.startswith(': '):
+                self._held = self._held[2:]
+            elif self._held.startswith(':'):
+                self._held = self._held[1:]
+            self._started = True
+        if not self._has_answer:
+            self._held = self._held.lstrip('\n')
+
+        i = self._held.find(f'{FN_NAME}:')
+        if i < 0:
+            # Hold back all that may be removed at last, e.g., both of the tokens in 'answer✿RETURN✿✿FUNC'
+            answer = self._held
+            while True:
+                stripped = _remove_trailing_special_tokens(answer)
+                if stripped == answer:
+                    break
+                answer = stripped
+            self._held = self._held[len(answer):]
+            return self._answer_messages(answer)
+
+        answer = _remove_trailing_special_tokens(self._held[:i])
+        fn_text, self._held = self._held[i + len(f'{FN_NAME}:'):], ''
+        self._fn_text = ''
+        return self._answer_messages(answer) + self._process_fncall(fn_text)
+
+    def flush(self) -> Optional[List[Message]]:
+        """The function call or the text held back at the end of the stream."""
+        if self.stopped:
+            return None
+        if self._fn_text is None:
+            if not self._started:
+                return None
+            held, self._held = self._held, ''
+            # Only the last special token is removed, as in the full mode
+            return self._answer_messages(_remove_trailing_special_tokens(held)) or None
+        if not self._fn_text:
+            return None
+        return self._fncall_messages(self._fn_text)
+
+    def _process_fncall(self, text: str) -> List[Message]:
+        self._fn_text += text
+        # Resume the search a little before, in case that a marker is split across the deltas
+        start = max(self._fn_scanned - len(f'{FN_NAME}:'), 0)
+        i = self._fn_text.find(f'{FN_NAME}:', start)
+        while i == 0:  # Skip the empty function call, as in the full mode
+            self._fn_text, start = self._fn_text[len(f'{FN_NAME}:'):], 0
+            i = self._fn_text.find(f'{FN_NAME}:')
+        self._fn_scanned = len(self._fn_text)
+        if i > 0:
+            # Discard the text after the first function call
+            return self._fncall_messages(self._fn_text[:i])
+        if self._fn_text.find(f'\n{FN_RESULT}:', start) >= 0:
+            return self._fncall_messages(self._fn_text)
+        return []
+
+    def _answer_messages(self, answer: str) -> List[Message]:
+        if not answer:
+            return []
+        self._has_answer = True
+        return [CompactMessage(self._role, answer if self._is_str else [CompactContentItem(text=answer)])]
+
+    def _fncall_messages(self, fn_text: str) -> List[Message]:
+        self.stopped = True
+        fn_name, fn_args, _, _ = _split_fncall_part(fn_text)
+        return [
+            CompactMessage(
+                role=ASSISTANT,
+                content='' if self._is_str else [],
+                function_call=CompactFunctionCall(
+                    name=remove_incomplete_special_tokens(fn_name),
+                    arguments=remove_incomplete_special_tokens(fn_args),
+                ),
+            )
+        ]
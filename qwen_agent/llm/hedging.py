@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Awaitable, Callable, Optional
+
+from qwen_agent.log import logger
+
+DEFAULT_HEDGING_CFG = {
+    'percentile': 95,  # Hedge a request if it is slower than this percentile of the recent latencies
+    'initial_delay': 1.0,  # Seconds to hedge before there are enough latencies
+    'min_samples': 20,
+    'window': 200,  # The number of the recent latencies
+    'max_extra_load': 0.1,  # The hedged requests are at most this fraction of all the requests
+}
+
+
+class HedgingPolicy:
+    """Send a duplicate of a slow request, and take the first result.
+
+    The duplicate is sent if no result arrives within the `percentile` of the recent latencies, as long as the
+    duplicates are at most `max_extra_load` of all the requests. The loser is cancelled in an event loop. A blocking
+    request can not be interrupted, so the loser is left to finish in its thread and its result is discarded. Each
+    blocking request runs in a thread of its own, so that the concurrency of the requests is not capped by a pool.
+    """
+
+    def __init__(self,
+                 percentile: float = 95,
+                 initial_delay: float = 1.0,
+                 min_samples: int = 20,
+                 window: int = 200,
+                 max_extra_load: float = 0.1):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.max_extra_load = max_extra_load
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def get_delay(self) -> float:
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.initial_delay
+            latencies = sorted(self._latencies)
+        i = min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)
+        return latencies[i]
+
+    def run(self, fn: Callable[[], Any], admit_hedge: Optional[Callable[[], bool]] = None) -> Any:
+        """Call fn, and call it again in parallel if it is slow.
+
+        Args:
+            fn: The request, which is already admitted by the rate limiter if any, so that the time waiting to be
+              admitted is neither hedged nor sampled.
+            admit_hedge: Admit the duplicate without waiting, e.g., `RateLimiter.try_acquire`, or return False to
+              give up hedging.
+        """
+        delay = self._start_request()
+        primary = self._submit(fn)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_budget(admit_hedge):
+            return primary.result()
+        logger.info(f'Hedge a request without response in {delay:.2f}s')
+        hedge = self._submit(fn)
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    self._count_win(future is hedge)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def arun(self, fn: Callable[[], Awaitable], admit_hedge: Optional[Callable[[], bool]] = None) -> Any:
+        """The async version of `run`, where fn is a coroutine function."""
+        delay = self._start_request()
+        primary = self._create_task(fn)
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done or not self._take_budget(admit_hedge):
+                return await primary
+            logger.info(f'Hedge a request without response in {delay:.2f}s')
+            hedge = self._create_task(fn)
+            tasks.append(hedge)
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._count_win(task is hedge)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counters, 'samples': len(self._latencies)}
+
+    def _start_request(self) -> float:
+        with self._lock:
+            self._counters['requests'] += 1
+        return self.get_delay()
+
+    def _take_budget(self, admit_hedge: Optional[Callable[[], bool]] = None) -> bool:
+        with self._lock:
+            if self._counters['hedged'] >= self.max_extra_load * self._counters['requests']:
+                return False
+            if admit_hedge is not None and not admit_hedge():
+                return False
+            self._counters['hedged'] += 1
+            return True
+
+    def _count_win(self, is_hedge: bool):
+        if is_hedge:
+            with self._lock:
+                self._counters['hedge_wins'] += 1
+
+    def _record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _submit(self, fn: Callable[[], Any]) -> Future:
+        start = time.time()
+        future = Future()
+
+        def _run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=_run, name='qwen_agent_hedging', daemon=True).start()
+
+        def _on_done(f: Future):
+            if not f.cancelled() and f.exception() is None:
+                self._record(time.time() - start)
+
+        future.add_done_callback(_on_done)
+        return future
+
+    def _create_task(self, fn: Callable[[], Awaitable]) -> asyncio.Task:
+        start = time.time()
+        task = asyncio.ensure_future(fn())
+
+        def _on_done(t: asyncio.Task):
+            # A cancelled loser is slower than the winner, whose elapsed time keeps the tail of the latencies
+            if t.cancelled() or t.exception() is None:
+                self._record(time.time() - start)
+
+        task.add_done_callback(_on_done)
+        return task
+
+
+def get_hedging_policy(cfg: Optional[dict]) -> Optional[HedgingPolicy]:
+    if not cfg:
+        return None
+    return HedgingPolicy(**{**DEFAULT_HEDGING_CFG, **cfg})
@@ -1,6 +1,9 @@
+import asyncio
 import os
+import threading
+import weakref
 from pprint import pformat
-from typing import Dict, Iterator, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
 import openai
 
@@ -15,6 +18,16 @@ from qwen_agent.log import logger
 
 from .schema import ASSISTANT, Message
 
+# The config of the http connection pool, which is popped from generate_cfg and not sent with the requests
+DEFAULT_HTTP_CLIENT_CFG = {
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'keepalive_expiry': 60.0,  # Seconds to keep an idle connection alive
+    'http2': False,
+    'connect_timeout': 10.0,
+    'timeout': 600.0,  # The default timeout of reading, writing and waiting for a connection from the pool
+}
+
 
 @register_llm('oai')
 class TextChatAtOAI(BaseTextChatModel):
@@ -37,12 +50,15 @@ class TextChatAtOAI(BaseTextChatModel):
             api_key = os.getenv('OPENAI_API_KEY', 'EMPTY')
         api_key = api_key.strip()
 
+        http_cfg = {k: self.generate_cfg.pop(k) for k in DEFAULT_HTTP_CLIENT_CFG if k in self.generate_cfg}
+
         if openai.__version__.startswith('0.'):
             if api_base:
                 openai.api_base = api_base
             if api_key:
                 openai.api_key = api_key
             self._chat_complete_create = openai.ChatCompletion.create
+            self._chat_complete_acreate = openai.ChatCompletion.acreate
         else:
             api_kwargs = {}
             if api_base:
@@ -51,20 +67,15 @@ class TextChatAtOAI(BaseTextChatModel):
                 api_kwargs['api_key'] = api_key
 
             def _chat_complete_create(*args, **kwargs):
-                # OpenAI API v1 does not allow the following args, must pass by extra_body
-                extra_params = ['top_k', 'repetition_penalty']
-                if any((k in kwargs) for k in extra_params):
-                    kwargs['extra_body'] = {}
-                    for k in extra_params:
-                        if k in kwargs:
-                            kwargs['extra_body'][k] = kwargs.pop(k)
-                if 'request_timeout' in kwargs:
-                    kwargs['timeout'] = kwargs.pop('request_timeout')
-
-                client = openai.OpenAI(**api_kwargs)
-                return client.chat.completions.create(*args, **kwargs)
+                client = get_openai_client(api_kwargs, http_cfg)
+                return client.chat.completions.create(*args, **_convert_to_v1_kwargs(kwargs))
+
+            async def _chat_complete_acreate(*args, **kwargs):
+                client = get_openai_client(api_kwargs, http_cfg, is_async=True)
+                return await client.chat.completions.create(*args, **_convert_to_v1_kwargs(kwargs))
 
             self._chat_complete_create = _chat_complete_create
+            self._chat_complete_acreate = _chat_complete_acreate
 
     def _chat_stream(
         self,
@@ -101,3 +112,176 @@ class TextChatAtOAI(BaseTextChatModel):
             return [Message(ASSISTANT, response.choices[0].message.content)]
         except OpenAIError as ex:
             raise ModelServiceError(exception=ex)
+
+    async def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        messages = [msg.model_dump() for msg in messages]
+        logger.debug(f'*{pformat(messages, indent=2)}*')
+        try:
+            response = await self._chat_complete_acreate(model=self.model,
+                                                         messages=messages,
+                                                         stream=True,
+                                                         **generate_cfg)
+            if delta_stream:
+                async for chunk in response:
+                    if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
+                        yield [Message(ASSISTANT, chunk.choices[0].delta.content)]
+            else:
+                full_response = ''
+                async for chunk in response:
+                    if hasattr(chunk.choices[0].delta, 'content') and chunk.choices[0].delta.content:
+                        full_response += chunk.choices[0].delta.content
+                        yield [Message(ASSISTANT, full_response)]
+        except OpenAIError as ex:
+            raise ModelServiceError(exception=ex)
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        messages = [msg.model_dump() for msg in messages]
+        logger.debug(f'*{pformat(messages, indent=2)}*')
+        try:
+            response = await self._chat_complete_acreate(model=self.model,
+                                                         messages=messages,
+                                                         stream=False,
+                                                         **generate_cfg)
+            return [Message(ASSISTANT, response.choices[0].message.content)]
+        except OpenAIError as ex:
+            raise ModelServiceError(exception=ex)
+
+
+def _convert_to_v1_kwargs(kwargs: dict) -> dict:
+    # OpenAI API v1 does not allow the following args, must pass by extra_body
+    extra_params = ['top_k', 'repetition_penalty']
+    if any((k in kwargs) for k in extra_params):
+        kwargs['extra_body'] = {}
+        for k in extra_params:
+            if k in kwargs:
+                kwargs['extra_body'][k] = kwargs.pop(k)
+    if 'request_timeout' in kwargs:
+        kwargs['timeout'] = kwargs.pop('request_timeout')
+    return kwargs
+
+
+class _PooledClient:
+
+    def __init__(self, api_kwargs: dict, http_cfg: dict, is_async: bool):
+        import httpx
+
+        self.base_url = api_kwargs.get('base_url')
+        self.is_async = is_async
+        self.http_cfg = http_cfg
+        self.num_requests = 0  # The HTTP requests sent, including the retries
+
+        limits = httpx.Limits(max_connections=http_cfg['max_connections'],
+                              max_keepalive_connections=http_cfg['max_keepalive_connections'],
+                              keepalive_expiry=http_cfg['keepalive_expiry'])
+        timeout = httpx.Timeout(http_cfg['timeout'], connect=http_cfg['connect_timeout'])
+        try:
+            if is_async:
+                self.transport = httpx.AsyncHTTPTransport(limits=limits, http2=http_cfg['http2'])
+                http_client = httpx.AsyncClient(transport=self.transport,
+                                                timeout=timeout,
+                                                event_hooks={'request': [self._acount_request]})
+            else:
+                self.transport = httpx.HTTPTransport(limits=limits, http2=http_cfg['http2'])
+                http_client = httpx.Client(transport=self.transport,
+                                           timeout=timeout,
+                                           event_hooks={'request': [self._count_request]})
+        except ImportError:
+            raise ModuleNotFoundError('Please install h2 for http2 by: `pip install httpx[http2]`')
+        client_cls = openai.AsyncOpenAI if is_async else openai.OpenAI
+        self.client = client_cls(**api_kwargs, timeout=timeout, http_client=http_client)
+
+    def _count_request(self, request):
+        self.num_requests += 1
+
+    async def _acount_request(self, request):
+        self.num_requests += 1
+
+    @property
+    def stats(self) -> dict:
+        num_connections, num_idle_connections = self._get_connection_stats()
+        return {
+            'base_url': self.base_url,
+            'async': self.is_async,
+            'requests': self.num_requests,
+            'connections': num_connections,
+            'idle_connections': num_idle_connections,
+            'max_connections': self.http_cfg['max_connections'],
+            'max_keepalive_connections': self.http_cfg['max_keepalive_connections'],
+            'http2': self.http_cfg['http2'],
+        }
+
+
+    def _get_connection_stats(self) -> Tuple[Optional[int], Optional[int]]:
+        # The connections of the underlying httpcore pool are not a public API of httpx, so they are None if the
+        # internals are changed, such as by an upgrade of httpx
+        try:
+            connections = list(self.transport._pool.connections)
+            return len(connections), sum(1 for conn in connections if conn.is_idle())
+        except Exception:
+            return None, None
+
+
+# The clients are shared by the models using the same server in a process, so that the connections are reused
+_CLIENTS: Dict[tuple, _PooledClient] = {}
+# The connections of an async client are bound to the event loop, so there are async clients for each event loop
+_ASYNC_CLIENTS: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, _PooledClient]]' = \
+    weakref.WeakKeyDictionary()
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS_PID = os.getpid()
+
+
+def get_openai_client(api_kwargs: dict, http_cfg: Optional[dict] = None, is_async: bool = False):
+    """Get the long-lived OpenAI client of (base_url, api_key, http_cfg), which is created on first use.
+
+    Args:
+        api_kwargs: The base_url and api_key of the client.
+        http_cfg: The config of the connection pool, see DEFAULT_HTTP_CLIENT_CFG.
+        is_async: Get an openai.AsyncOpenAI for the running event loop instead of an openai.OpenAI.
+    """
+    global _CLIENTS_PID
+    http_cfg = {**DEFAULT_HTTP_CLIENT_CFG, **(http_cfg or {})}
+    key = (api_kwargs.get('base_url'), api_kwargs.get('api_key'), tuple(sorted(http_cfg.items())))
+    with _CLIENTS_LOCK:
+        # The connections can not be used across fork, so create new clients in a new process
+        if _CLIENTS_PID != os.getpid():
+            _CLIENTS.clear()
+            _ASYNC_CLIENTS.clear()
+            _CLIENTS_PID = os.getpid()
+        if is_async:
+            _remove_closed_loops()
+            clients = _ASYNC_CLIENTS.setdefault(asyncio.get_running_loop(), {})
+        else:
+            clients = _CLIENTS
+        pooled = clients.get(key)
+        if pooled is None:
+            pooled = _PooledClient(api_kwargs, http_cfg, is_async=is_async)
+            clients[key] = pooled
+    return pooled.client
+
+
+def get_openai_client_stats() -> List[dict]:
+    """The statistics of the connection pools of the shared OpenAI clients, for sizing the pools.
+
+    The numbers of the connections are read from the internals of httpx, and are None if they are not available.
+    """
+    with _CLIENTS_LOCK:
+        _remove_closed_loops()
+        pools = list(_CLIENTS.values())
+        for clients in _ASYNC_CLIENTS.values():
+            pools.extend(clients.values())
+    return [pooled.stats for pooled in pools]
+
+
+def _remove_closed_loops():
+    # E.g., the loops of finished asyncio.run, whose connections can not be used anymore
+    for loop in [loop for loop in _ASYNC_CLIENTS if loop.is_closed()]:
+        del _ASYNC_CLIENTS[loop]
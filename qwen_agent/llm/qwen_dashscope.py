@@ -1,15 +1,19 @@
+import asyncio
 import os
 from http import HTTPStatus
 from pprint import pformat
-from typing import Dict, Iterator, List, Optional
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Union
 
 import dashscope
 
-from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.base import ModelServiceError, _iterate_in_thread, register_llm
 from qwen_agent.llm.schema import ASSISTANT, DEFAULT_SYSTEM_MESSAGE, SYSTEM, USER, Message
 from qwen_agent.llm.text_base import BaseTextChatModel
 from qwen_agent.log import logger
 
+# The async API of dashscope is not available in the old versions, in which the sync API runs in worker threads
+_HAS_AIO_GENERATION = hasattr(dashscope, 'AioGeneration')
+
 
 @register_llm('qwen_dashscope')
 class QwenChatAtDS(BaseTextChatModel):
@@ -61,6 +65,7 @@ class QwenChatAtDS(BaseTextChatModel):
         messages: List[Message],
         generate_cfg: dict,
         stream: bool,
+        delta_stream: bool = False,
     ) -> Iterator[List[Message]]:
         prompt = self._build_text_completion_prompt(messages)
         logger.debug(f'*{prompt}*')
@@ -71,6 +76,8 @@ class QwenChatAtDS(BaseTextChatModel):
             stream=True,
             use_raw_prompt=True,
             **generate_cfg)
+        if stream and delta_stream:
+            return self._delta_stream_output(response)
         it = self._full_stream_output(response)
         if stream:
             return it  # streaming the response
@@ -78,6 +85,85 @@ class QwenChatAtDS(BaseTextChatModel):
             *_, final_response = it  # return the final response without streaming
             return final_response
 
+    async def _achat_stream(
+        self,
+        messages: List[Message],
+        delta_stream: bool,
+        generate_cfg: dict,
+    ) -> AsyncIterator[List[Message]]:
+        if not _HAS_AIO_GENERATION:
+            async for rsp in super()._achat_stream(messages, delta_stream=delta_stream, generate_cfg=generate_cfg):
+                yield rsp
+            return
+        messages = [msg.model_dump() for msg in messages]
+        logger.debug(f'*{pformat(messages, indent=2)}*')
+        response = await dashscope.AioGeneration.call(
+            self.model,
+            messages=messages,  # noqa
+            result_format='message',
+            stream=True,
+            **generate_cfg)
+        if delta_stream:
+            it = self._adelta_stream_output(response)
+        else:
+            it = self._afull_stream_output(response)
+        async for rsp in it:
+            yield rsp
+
+    async def _achat_no_stream(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+    ) -> List[Message]:
+        if not _HAS_AIO_GENERATION:
+            return await super()._achat_no_stream(messages, generate_cfg=generate_cfg)
+        messages = [msg.model_dump() for msg in messages]
+        logger.debug(f'*{pformat(messages, indent=2)}*')
+        response = await dashscope.AioGeneration.call(
+            self.model,
+            messages=messages,  # noqa
+            result_format='message',
+            stream=False,
+            **generate_cfg)
+        if response.status_code == HTTPStatus.OK:
+            return [Message(ASSISTANT, response.output.choices[0].message.content)]
+        else:
+            raise ModelServiceError(code=response.code, message=response.message)
+
+    async def _acontinue_assistant_response(
+        self,
+        messages: List[Message],
+        generate_cfg: dict,
+        stream: bool,
+        delta_stream: bool = False,
+    ) -> Union[List[Message], AsyncIterator[List[Message]]]:
+        if not _HAS_AIO_GENERATION:
+            output = await asyncio.to_thread(self._continue_assistant_response,
+                                             messages,
+                                             generate_cfg=generate_cfg,
+                                             stream=stream,
+                                             delta_stream=delta_stream)
+            return _iterate_in_thread(output) if stream else output
+        prompt = self._build_text_completion_prompt(messages)
+        logger.debug(f'*{prompt}*')
+        response = await dashscope.AioGeneration.call(
+            self.model,
+            prompt=prompt,  # noqa
+            result_format='message',
+            stream=True,
+            use_raw_prompt=True,
+            **generate_cfg)
+        if stream and delta_stream:
+            return self._adelta_stream_output(response)
+        it = self._afull_stream_output(response)
+        if stream:
+            return it  # streaming the response
+        else:
+            final_response = None
+            async for final_response in it:  # return the final response without streaming
+                pass
+            return final_response
+
     @staticmethod
     def _build_text_completion_prompt(messages: List[Message]) -> str:
         im_start = '<|im_start|>'
@@ -133,6 +219,37 @@ class QwenChatAtDS(BaseTextChatModel):
             else:
                 raise ModelServiceError(code=chunk.code, message=chunk.message)
 
+    @staticmethod
+    async def _adelta_stream_output(response) -> AsyncIterator[List[Message]]:
+        last_len = 0
+        delay_len = 5
+        in_delay = False
+        text = ''
+        async for chunk in response:
+            if chunk.status_code == HTTPStatus.OK:
+                text = chunk.output.choices[0].message.content
+                if (len(text) - last_len) <= delay_len:
+                    in_delay = True
+                    continue
+                else:
+                    in_delay = False
+                    real_text = text[:-delay_len]
+                    now_rsp = real_text[last_len:]
+                    yield [Message(ASSISTANT, now_rsp)]
+                    last_len = len(real_text)
+            else:
+                raise ModelServiceError(code=chunk.code, message=chunk.message)
+        if text and (in_delay or (last_len != len(text))):
+            yield [Message(ASSISTANT, text[last_len:])]
+
+    @staticmethod
+    async def _afull_stream_output(response) -> AsyncIterator[List[Message]]:
+        async for chunk in response:
+            if chunk.status_code == HTTPStatus.OK:
+                yield [Message(ASSISTANT, chunk.output.choices[0].message.content)]
+            else:
+                raise ModelServiceError(code=chunk.code, message=chunk.message)
+
 
 def initialize_dashscope(cfg: Optional[Dict] = None) -> None:
     cfg = cfg or {}
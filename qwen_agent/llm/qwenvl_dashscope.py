@@ -29,9 +29,6 @@ class QwenVLChatAtDS(BaseFnCallModel):
         delta_stream: bool,
         generate_cfg: dict,
     ) -> Iterator[List[Message]]:
-        if delta_stream:
-            raise NotImplementedError
-
         messages = _format_local_files(messages)
         messages = [msg.model_dump() for msg in messages]
         logger.debug(f'*{pformat(messages, indent=2)}*')
@@ -41,9 +38,19 @@ class QwenVLChatAtDS(BaseFnCallModel):
                                                          stream=True,
                                                          **generate_cfg)
 
+        last_text = ''
         for chunk in response:
             if chunk.status_code == HTTPStatus.OK:
-                yield _extract_vl_response(chunk)
+                output = _extract_vl_response(chunk)
+                if delta_stream:
+                    # Each chunk is the full response so far, and only the new text is yielded
+                    text = ''.join(item.text for item in output[0].content)
+                    delta = text[len(last_text):] if text.startswith(last_text) else text
+                    last_text = text
+                    if delta:
+                        yield [Message(role=output[0].role, content=[ContentItem(text=delta)])]
+                else:
+                    yield output
             else:
                 raise ModelServiceError(code=chunk.code, message=chunk.message)
 
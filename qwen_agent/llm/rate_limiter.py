@@ -0,0 +1,200 @@
+import asyncio
+import heapq
+import itertools
+import json
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+PRIORITY_INTERACTIVE = 0  # The default priority, e.g., the turns of a chat session
+PRIORITY_BACKGROUND = 10  # E.g., the calls of the document ingestion
+
+# The limiters are shared by the models with the same model and config in a process
+_RATE_LIMITERS: Dict[str, 'RateLimiter'] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    """A bucket refilled at `amount_per_minute`, holding at most the amount of one minute."""
+
+    def __init__(self, amount_per_minute: float):
+        self.capacity = float(amount_per_minute)
+        self.rate = self.capacity / 60.0
+        self.available = self.capacity
+        self._last_refill = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def get_delay(self, amount: float) -> float:
+        """Seconds to wait for the amount, where an amount larger than the capacity waits for a full bucket."""
+        amount = min(amount, self.capacity)
+        return max(amount - self.available, 0.0) / self.rate
+
+
+class _Waiter:
+    __slots__ = ('priority', 'seq', 'tokens', 'loop', 'event')
+
+    def __init__(self, priority: int, seq: int, tokens: int):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.event: Optional[asyncio.Event] = None
+
+    def __lt__(self, other: '_Waiter') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RateLimiter:
+    """A client-side limiter of the requests and the estimated tokens per minute of a model.
+
+    The requests are admitted one by one in the order of (priority, arrival), where a smaller priority goes first,
+    so that the interactive turns are not starved by the background calls. The waiting requests of all the threads
+    and event loops of the process are in one queue, whose length is the `queue_depth`.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._cond = threading.Condition()
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._num_admitted = 0
+
+    def acquire(self, tokens: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        """Block until a request with the estimated tokens is admitted."""
+        with self._cond:
+            waiter = self._enqueue(tokens, priority)
+            try:
+                while True:
+                    admitted, delay = self._try_admit(waiter)
+                    if admitted:
+                        return
+                    self._cond.wait(delay)
+            except BaseException:
+                self._dequeue(waiter)
+                raise
+
+    async def aacquire(self, tokens: int = 0, priority: int = PRIORITY_INTERACTIVE):
+        """Wait until a request with the estimated tokens is admitted, without blocking the event loop."""
+        with self._cond:
+            waiter = self._enqueue(tokens, priority)
+            waiter.loop = asyncio.get_running_loop()
+            waiter.event = asyncio.Event()
+        try:
+            while True:
+                with self._cond:
+                    admitted, delay = self._try_admit(waiter)
+                    waiter.event.clear()
+                if admitted:
+                    return
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                self._dequeue(waiter)
+            raise
+
+    def try_acquire(self, tokens: int = 0) -> bool:
+        """Admit a request at once if no request is waiting and the buckets are enough, otherwise return False."""
+        with self._cond:
+            if self._queue or self._get_delay(tokens) > 0:
+                return False
+            self._take(tokens)
+            return True
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of the requests waiting to be admitted."""
+        return len(self._queue)
+
+    @property
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            for bucket in (self._request_bucket, self._token_bucket):
+                if bucket:
+                    bucket.refill(now)
+            return {
+                'requests_per_minute': self.requests_per_minute,
+                'tokens_per_minute': self.tokens_per_minute,
+                'available_requests': self._request_bucket.available if self._request_bucket else None,
+                'available_tokens': self._token_bucket.available if self._token_bucket else None,
+                'queue_depth': len(self._queue),
+                'admitted': self._num_admitted,
+            }
+
+    def _enqueue(self, tokens: int, priority: int) -> _Waiter:
+        waiter = _Waiter(priority, next(self._seq), tokens)
+        heapq.heappush(self._queue, waiter)
+        if self._queue[0] is waiter:
+            self._notify_head()
+        return waiter
+
+    def _dequeue(self, waiter: _Waiter):
+        if waiter in self._queue:
+            self._queue.remove(waiter)
+            heapq.heapify(self._queue)
+            self._notify_head()
+
+    def _try_admit(self, waiter: _Waiter) -> Tuple[bool, Optional[float]]:
+        """Admit the waiter if it is the first one and the buckets are enough, otherwise return the delay to check
+        again, which is None if it should wait to be notified."""
+        if self._queue[0] is not waiter:
+            return False, None
+        delay = self._get_delay(waiter.tokens)
+        if delay > 0:
+            return False, delay
+        self._take(waiter.tokens)
+        heapq.heappop(self._queue)
+        self._notify_head()
+        return True, None
+
+    def _get_delay(self, tokens: int) -> float:
+        now = time.monotonic()
+        delay = 0.0
+        if self._request_bucket:
+            self._request_bucket.refill(now)
+            delay = max(delay, self._request_bucket.get_delay(1))
+        if self._token_bucket:
+            self._token_bucket.refill(now)
+            delay = max(delay, self._token_bucket.get_delay(tokens))
+        return delay
+
+    def _take(self, tokens: int):
+        if self._request_bucket:
+            self._request_bucket.available -= 1
+        if self._token_bucket:
+            self._token_bucket.available -= min(tokens, self._token_bucket.capacity)
+        self._num_admitted += 1
+
+    def _notify_head(self):
+        # Only the first waiter can be admitted, which may be waiting in a thread or an event loop
+        self._cond.notify_all()
+        if self._queue and self._queue[0].loop is not None:
+            head = self._queue[0]
+            try:
+                head.loop.call_soon_threadsafe(head.event.set)
+            except RuntimeError:  # The loop is closed
+                pass
+
+
+def get_rate_limiter(model: str, cfg: dict, model_server: Optional[str] = None) -> RateLimiter:
+    """Get the process-wide limiter of the model on the model server.
+
+    Args:
+        model: The model name.
+        cfg: The config of the limiter, such as {'requests_per_minute': 600, 'tokens_per_minute': 1000000}.
+        model_server: The model server, so that the same model on different servers is limited separately.
+    """
+    key = json.dumps({'model': model, 'model_server': model_server, **cfg}, sort_keys=True)
+    with _RATE_LIMITERS_LOCK:
+        if key not in _RATE_LIMITERS:
+            _RATE_LIMITERS[key] = RateLimiter(**cfg)
+        return _RATE_LIMITERS[key]
@@ -0,0 +1,172 @@
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.utils.utils import hash_sha256
+
+DEFAULT_MAX_ENTRIES = 1024  # The capacity of the in-memory LRU cache
+
+# The caches are shared by the models with the same cache config, e.g., the LLMs created by different agents
+_RESPONSE_CACHES: Dict[str, 'BaseResponseCache'] = {}
+_RESPONSE_CACHES_LOCK = threading.Lock()
+
+
+class BaseResponseCache(ABC):
+    """A cache of the final responses of the LLM, where the key is the hash of the request."""
+
+    def __init__(self, ttl: Optional[float] = None):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0}
+
+    def get(self, key: str) -> Optional[List[Message]]:
+        value = self._get(key)
+        if value is not None:
+            value = json.loads(value)
+            if value['expire_at'] is not None and value['expire_at'] < time.time():
+                self._delete(key)
+                value = None
+        with self._lock:
+            self._counters['misses' if value is None else 'hits'] += 1
+        if value is None:
+            return None
+        return [Message(**msg) for msg in value['messages']]
+
+    def put(self, key: str, messages: List[Union[Message, Dict]]):
+        value = {
+            'expire_at': (time.time() + self.ttl) if self.ttl else None,
+            'messages': [msg if isinstance(msg, dict) else msg.model_dump() for msg in messages],
+        }
+        self._put(key, json.dumps(value, ensure_ascii=False))
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    @abstractmethod
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def _put(self, key: str, value: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _delete(self, key: str):
+        raise NotImplementedError
+
+
+class MemoryResponseCache(BaseResponseCache):
+    """An LRU cache in the memory of the process."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: Optional[float] = None):
+        super().__init__(ttl=ttl)
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[str, str]' = OrderedDict()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def _put(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class StorageResponseCache(BaseResponseCache):
+    """A cache on disk, which is shared by processes, with the LRU eviction of the cache manager of the tools."""
+
+    def __init__(self,
+                 backend: str,
+                 path: Optional[str] = None,
+                 max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None):
+        super().__init__(ttl=ttl)
+        # Imported here to avoid the circular import of qwen_agent.tools
+        from qwen_agent.tools.cache_manager import get_cache_manager
+        from qwen_agent.tools.storage import KeyNotExistsError, Storage
+
+        self._key_not_exists_error = KeyNotExistsError
+        storage = Storage({
+            'storage_root_path': path or os.path.join(DEFAULT_WORKSPACE, 'llm_cache'),
+            'storage_backend': backend,
+        })
+        # The keys idle for ttl seconds are surely expired, so the cache manager can evict them as well
+        self.db = get_cache_manager(storage, {'max_bytes': max_bytes, 'ttl': ttl} if (max_bytes or ttl) else None)
+
+    def _get(self, key: str) -> Optional[str]:
+        try:
+            return self.db.get(key)
+        except self._key_not_exists_error:
+            return None
+
+    def _put(self, key: str, value: str):
+        self.db.put(key, value)
+
+    def _delete(self, key: str):
+        self.db.delete(key)
+
+
+def get_response_cache(cache_cfg: dict) -> BaseResponseCache:
+    """Get the response cache shared by the models with the same cache config.
+
+    Args:
+        cache_cfg: The config of the cache, such as:
+          {'backend': 'memory', 'max_entries': 1024, 'ttl': 3600}, or
+          {'backend': 'sqlite', 'path': 'workspace/llm_cache', 'max_bytes': 1024**3, 'ttl': 7 * 24 * 3600},
+          where the backend is one of 'memory', 'file' and 'sqlite'. The disk caches are bounded by `max_bytes`
+          instead of `max_entries`, which is ignored for them.
+    """
+    cache_cfg = dict(cache_cfg)
+    backend = cache_cfg.pop('backend', 'memory')
+    if backend != 'memory' and cache_cfg.pop('max_entries', None) is not None:
+        logger.warning(f'Ignore `max_entries` of the {backend} response cache, which is bounded by `max_bytes`.')
+    key = json.dumps([backend, cache_cfg], sort_keys=True)
+    with _RESPONSE_CACHES_LOCK:
+        if key not in _RESPONSE_CACHES:
+            if backend == 'memory':
+                _RESPONSE_CACHES[key] = MemoryResponseCache(**cache_cfg)
+            elif backend in ('file', 'sqlite'):
+                _RESPONSE_CACHES[key] = StorageResponseCache(backend, **cache_cfg)
+            else:
+                raise ValueError('Please set the backend of the response cache from ["memory", "file", "sqlite"]')
+        return _RESPONSE_CACHES[key]
+
+
+def is_deterministic(generate_cfg: dict) -> bool:
+    """Whether the response can be cached, i.e., the decoding is greedy or the sampling is seeded.
+
+    The default of the model service is usually sampling, so the config without a temperature is not cached.
+    """
+    return generate_cfg.get('temperature') == 0 or generate_cfg.get('seed') is not None
+
+
+def get_response_cache_key(model: str, messages: List[Message], functions: Optional[List[Dict]],
+                           generate_cfg: dict, **kwargs) -> str:
+    """The canonical hash of a request, which does not depend on the order of the dict keys."""
+    request = {
+        'model': model,
+        'messages': [msg.model_dump() for msg in messages],
+        'functions': functions,
+        'generate_cfg': generate_cfg,
+        **kwargs,
+    }
+    return hash_sha256(json.dumps(request, sort_keys=True, ensure_ascii=False, default=str))
@@ -0,0 +1,198 @@
+import functools
+from typing import Dict, List, Optional, Tuple
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.utils.tokenization_qwen import tokenizer
+
+
+class StopWordsMatcher:
+    """An Aho-Corasick automaton over the stop words, which scans a text incrementally in one pass.
+
+    The state after scanning a text is the longest suffix of the text that is a prefix of some stop word, so the
+    scan can be resumed from the state when more text comes, and the depth of the state is the length of the text
+    that may still become a stop word.
+    """
+
+    def __init__(self, stop: Tuple[str, ...]):
+        self.stop = stop
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        self._match_len: List[int] = [0]  # The length of the longest stop word ending at the state
+        for word in stop:
+            state = 0
+            for c in word:
+                if c not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match_len.append(0)
+                    self._goto[state][c] = len(self._goto) - 1
+                state = self._goto[state][c]
+            self._match_len[state] = max(self._match_len[state], len(word))
+
+        # Build the failure links in BFS order
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for c, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(c, 0)
+                self._match_len[next_state] = max(self._match_len[next_state],
+                                                  self._match_len[self._fail[next_state]])
+
+        # It may end with 'Observation' when the stop word is 'Observation:', see _postprocess_stop_words
+        partial_stop = []
+        for s in stop:
+            s = tokenizer.tokenize(s)[:-1]
+            if s:
+                s = tokenizer.convert_tokens_to_string(s)
+                partial_stop.append(s)
+        self.partial_stop: List[str] = sorted(set(partial_stop))
+
+    def scan(self, text: str, start: int = 0, state: int = 0) -> Tuple[Optional[int], int]:
+        """Scan text[start:] from the state.
+
+        Returns:
+            The start position of the first completed stop word, or None if none, and the state after. The position
+            is negative if the stop word begins in the text scanned before.
+        """
+        goto, fail, match_len = self._goto, self._fail, self._match_len
+        for i in range(start, len(text)):
+            c = text[i]
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if match_len[state]:
+                return i + 1 - match_len[state], state
+        return None, state
+
+    def depth(self, state: int) -> int:
+        return self._depth[state]
+
+    def strip_partial_stop(self, text: str) -> str:
+        stripped = text
+        for s in self.partial_stop:
+            if text.endswith(s):
+                stripped = text[:-len(s)]
+        return stripped
+
+
+@functools.lru_cache(maxsize=64)
+def get_stop_words_matcher(stop: Tuple[str, ...]) -> StopWordsMatcher:
+    """The matcher is built once for the same stop words, which are usually the same in all requests of a model."""
+    return StopWordsMatcher(stop)
+
+
+class StopWordsStream:
+    """Truncate a stream of responses at the stop words, scanning only the new text of each response.
+
+    In the full stream mode, each response is the full response so far, and the text scanned before is remembered
+    by a cursor for each text item. In the delta stream mode, the text that may be the beginning of a stop word is
+    held back until it is known not to be, and is flushed at the end.
+    Once a stop word is found, `stopped` is set and the caller should close the upstream.
+    """
+
+    def __init__(self, stop: List[str], delta_stream: bool = False):
+        self.matcher = get_stop_words_matcher(tuple(stop))
+        self.delta_stream = delta_stream
+        self.stopped = False
+        # For the full stream: The text, the scanned length and the state of each text item
+        self._cursors: List[Tuple[str, int, int]] = []
+        # For the delta stream
+        self._state = 0
+        self._held = ''
+        self._role = ASSISTANT
+
+    def process(self, messages: List[Message]) -> List[Message]:
+        if self.delta_stream:
+            return self._process_delta(messages)
+        return self._process_full(messages)
+
+    def flush(self) -> Optional[List[Message]]:
+        """The text held back in the delta stream mode, which is not a stop word."""
+        held, self._held = self._held, ''
+        # The held text is the end of the response, which may be a partial stop word
+        held = self.matcher.strip_partial_stop(held)
+        if held and not self.stopped:
+            return [Message(self._role, held)]
+        return None
+
+    def _process_full(self, messages: List[Message]) -> List[Message]:
+        new_messages = []
+        k = 0  # The index of the text item among all the text items
+        for msg in messages:
+            items = _get_text_items(msg)
+            new_texts = {}
+            for i, text in items:
+                if k < len(self._cursors) and text.startswith(self._cursors[k][0]):
+                    _, scanned, state = self._cursors[k]
+                else:
+                    scanned, state = 0, 0
+                    del self._cursors[k:]
+                pos, state = self.matcher.scan(text, start=scanned, state=state)
+                if k < len(self._cursors):
+                    self._cursors[k] = (text, len(text), state)
+                else:
+                    self._cursors.append((text, len(text), state))
+                k += 1
+                if pos is not None:
+                    # Keep the text before the stop word and discard the rest of the response
+                    self.stopped = True
+                    new_texts[i] = text[:pos]
+                    new_messages.append(_replace_text_items(msg, new_texts, truncate_after=i))
+                    return self._strip_partial_stop(new_messages)
+            new_messages.append(msg)
+        return self._strip_partial_stop(new_messages)
+
+    def _process_delta(self, messages: List[Message]) -> List[Message]:
+        new_messages = []
+        for msg in messages:
+            self._role = msg.role
+            new_texts = {}
+            for i, text in _get_text_items(msg):
+                pos, self._state = self.matcher.scan(text, state=self._state)
+                text = self._held + text
+                if pos is not None:
+                    self.stopped = True
+                    new_texts[i] = self.matcher.strip_partial_stop(text[:len(self._held) + pos])
+                    new_messages.append(_replace_text_items(msg, new_texts, truncate_after=i))
+                    self._held = ''
+                    return new_messages
+                n = len(text) - self.matcher.depth(self._state)
+                new_texts[i], self._held = text[:n], text[n:]
+            new_messages.append(_replace_text_items(msg, new_texts))
+        return new_messages
+
+    def _strip_partial_stop(self, messages: List[Message]) -> List[Message]:
+        if not messages:
+            return messages
+        items = _get_text_items(messages[-1])
+        if items:
+            i, text = items[-1]
+            stripped = self.matcher.strip_partial_stop(text)
+            if stripped != text:
+                messages[-1] = _replace_text_items(messages[-1], {i: stripped})
+        return messages
+
+
+def _get_text_items(msg: Message) -> List[Tuple[int, str]]:
+    if isinstance(msg.content, str):
+        return [(0, msg.content)]
+    return [(i, item.text) for i, item in enumerate(msg.content) if item.text is not None]
+
+
+def _replace_text_items(msg: Message, new_texts: Dict[int, str], truncate_after: Optional[int] = None) -> Message:
+    """A shallow copy of the message with some text items replaced, without modifying the original message."""
+    if isinstance(msg.content, str):
+        content = new_texts.get(0, msg.content)
+    else:
+        content = [
+            item.model_copy(update={'text': new_texts[i]}) if i in new_texts else item
+            for i, item in enumerate(msg.content)
+        ]
+        if truncate_after is not None:
+            content = content[:truncate_after + 1]
+    return msg.model_copy(update={'content': content})
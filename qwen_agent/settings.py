@@ -1,3 +1,4 @@
+import os
 from typing import List, Literal
 
 # Settings for LLMs
@@ -6,8 +7,12 @@ DEFAULT_MAX_INPUT_TOKENS: int = 5800  # The LLM will truncate the input messages
 # Settings for agents
 MAX_LLM_CALL_PER_RUN: int = 8
 
+# Settings for tokenization
+DEFAULT_CACHE_DIR: str = os.getenv('QWEN_AGENT_CACHE_DIR', os.path.expanduser('~/.cache/qwen_agent'))  # E.g., the vocab
+
 # Settings for tools
 DEFAULT_WORKSPACE: str = 'workspace'
+DEFAULT_STORAGE_BACKEND: Literal['file', 'sqlite'] = 'file'  # The backend of the caches of the tools, see tools/storage.py
 
 # Settings for RAG
 DEFAULT_MAX_REF_TOKEN: int = 4000  # The window size reserved for RAG materials
@@ -1,16 +1,9 @@
-from qwen_agent.tools.search_tools import FrontPageSearch, HybridSearch, KeywordSearch, VectorSearch
-from qwen_agent.tools.wealthy_consultant import GetProductInfo, GetFAQ, Recommend
+from qwen_agent.utils.utils import lazy_module_attrs
 
-from .amap_weather import AmapWeather
-from .base import TOOL_REGISTRY, BaseTool
-from .code_interpreter import CodeInterpreter
-from .doc_parser import DocParser
-from .extract_doc_vocabulary import ExtractDocVocabulary
-from .image_gen import ImageGen
-from .retrieval import Retrieval
-from .simple_doc_parser import SimpleDocParser
-from .storage import Storage
-from .web_extractor import WebExtractor
+from .base import BUILTIN_TOOLS, TOOL_REGISTRY, BaseTool
+
+# The tools are imported on first access, so that importing a tool does not import the heavy packages of the others
+__getattr__, __dir__ = lazy_module_attrs(__name__, {cls: (module, cls) for module, cls in BUILTIN_TOOLS.values()})
 
 __all__ = [
     'BaseTool',
@@ -3,14 +3,35 @@ from typing import Dict, List, Optional, Union
 
 import json5
 
-from qwen_agent.utils.utils import has_chinese_chars, logger
-
-TOOL_REGISTRY = {}
+from qwen_agent.utils.utils import LazyRegistry, has_chinese_chars, logger
+
+# The built-in tools are imported on first use, since some of them depend on heavy packages such as matplotlib:
+# the tool name -> (the module registering it, the class name)
+BUILTIN_TOOLS = {
+    'amap_weather': ('qwen_agent.tools.amap_weather', 'AmapWeather'),
+    'code_interpreter': ('qwen_agent.tools.code_interpreter', 'CodeInterpreter'),
+    'doc_parser': ('qwen_agent.tools.doc_parser', 'DocParser'),
+    'extract_doc_vocabulary': ('qwen_agent.tools.extract_doc_vocabulary', 'ExtractDocVocabulary'),
+    'front_page_search': ('qwen_agent.tools.search_tools.front_page_search', 'FrontPageSearch'),
+    'hybrid_search': ('qwen_agent.tools.search_tools.hybrid_search', 'HybridSearch'),
+    'image_gen': ('qwen_agent.tools.image_gen', 'ImageGen'),
+    'keyword_search': ('qwen_agent.tools.search_tools.keyword_search', 'KeywordSearch'),
+    'retrieval': ('qwen_agent.tools.retrieval', 'Retrieval'),
+    'simple_doc_parser': ('qwen_agent.tools.simple_doc_parser', 'SimpleDocParser'),
+    'storage': ('qwen_agent.tools.storage', 'Storage'),
+    'vector_search': ('qwen_agent.tools.search_tools.vector_search', 'VectorSearch'),
+    'web_extractor': ('qwen_agent.tools.web_extractor', 'WebExtractor'),
+    'faq_embedding': ('qwen_agent.tools.wealthy_consultant.faq', 'GetFAQ'),
+    '产品查询': ('qwen_agent.tools.wealthy_consultant.get_product_info', 'GetProductInfo'),
+    '产品推荐': ('qwen_agent.tools.wealthy_consultant.recommend', 'Recommend'),
+}
+TOOL_REGISTRY = LazyRegistry({name: module for name, (module, _) in BUILTIN_TOOLS.items()})
 
 
 def register_tool(name, allow_overwrite=False):
     def decorator(cls):
-        if name in TOOL_REGISTRY:
+        is_builtin = TOOL_REGISTRY.is_builtin(name, cls)
+        if name in TOOL_REGISTRY and not is_builtin:
             if allow_overwrite:
                 logger.warning(f'Tool `{name}` already exists! Overwriting with class {cls}.')
             else:
@@ -18,6 +39,8 @@ def register_tool(name, allow_overwrite=False):
         if cls.name and (cls.name != name):
             raise ValueError(f'{cls.__name__}.name="{cls.name}" conflicts with @register_tool(name="{name}").')
         cls.name = name
+        if is_builtin and TOOL_REGISTRY.is_registered(name):
+            return cls  # The built-in tool has been overwritten before its module is imported
         TOOL_REGISTRY[name] = cls
 
         return cls
@@ -0,0 +1,179 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from qwen_agent.log import logger
+from qwen_agent.tools.storage import KeyNotExistsError, Storage
+
+DEFAULT_COMPACT_INTERVAL = 600  # Seconds between two background compactions
+DEFAULT_TOUCH_INTERVAL = 60  # Seconds within which repeated reads of a key only update its access time once
+LOW_WATERMARK = 0.9  # Evict down to this fraction of the quota, so that every put does not trigger an eviction
+
+# The cache managers are shared by the tools using the same storage, so there is one compaction job per storage
+_CACHE_MANAGERS: Dict[Tuple[str, str], 'CacheManager'] = {}
+_CACHE_MANAGERS_LOCK = threading.Lock()
+
+
+class CacheManager:
+    """A cache over Storage with LRU/TTL eviction and a byte quota.
+
+    It has the same get/put/delete API as Storage. The access time of each key is tracked by the storage backend,
+    and the eviction runs in the compaction, either in a background thread or by calling `compact`:
+      - The keys not accessed for `ttl` seconds are evicted.
+      - If the total size exceeds `max_bytes`, the least recently used keys are evicted until the total size is
+        below LOW_WATERMARK * max_bytes.
+    Without `max_bytes` and `ttl`, nothing is evicted and only the hit/miss counters are kept.
+    """
+
+    def __init__(self,
+                 storage: Storage,
+                 max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 compact_interval: Optional[float] = DEFAULT_COMPACT_INTERVAL,
+                 touch_interval: float = DEFAULT_TOUCH_INTERVAL):
+        self.storage = storage
+        self.backend = storage.backend
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compact_interval = compact_interval
+        self.touch_interval = touch_interval
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._last_touch: Dict[str, float] = {}
+        self._total_bytes: Optional[int] = None  # Known after a compaction, then updated by put/delete approximately
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._compact_thread: Optional[threading.Thread] = None
+
+    @property
+    def evictable(self) -> bool:
+        return bool(self.max_bytes or self.ttl)
+
+    def get(self, key: str) -> str:
+        try:
+            value = self.backend.get(key)
+        except KeyNotExistsError:
+            self._count('misses')
+            raise
+        self._count('hits')
+        if self.evictable:
+            now = time.time()
+            if now - self._last_touch.get(key, 0) >= self.touch_interval:
+                self._last_touch[key] = now
+                self.backend.touch(key)
+        return value
+
+    def put(self, key: str, value: str):
+        self.backend.put(key, value)
+        if not self.evictable:
+            return
+        self._last_touch[key] = time.time()
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(value.encode('utf-8'))
+            over_quota = self.max_bytes and (self._total_bytes is None or self._total_bytes > self.max_bytes)
+        if over_quota:
+            if self._compact_thread is not None:
+                self._wakeup.set()
+            else:
+                self.compact()
+
+    def delete(self, key: str) -> bool:
+        self._last_touch.pop(key, None)
+        return self.backend.delete(key)
+
+    def list_keys(self, prefix: str = '') -> List[str]:
+        return self.backend.list_keys(prefix)
+
+    def compact(self) -> int:
+        """Evict the expired keys and the least recently used keys over the quota, and return the number evicted."""
+        with self._compact_lock:
+            entries = self.backend.list_entries()
+            now = time.time()
+            to_evict = []
+            if self.ttl:
+                to_evict = [key for key, _, atime in entries if now - atime > self.ttl]
+                entries = [x for x in entries if now - x[2] <= self.ttl]
+            total_bytes = sum(size for _, size, _ in entries)
+            if self.max_bytes and total_bytes > self.max_bytes:
+                entries.sort(key=lambda x: x[2])
+                for key, size, _ in entries:
+                    if total_bytes <= self.max_bytes * LOW_WATERMARK:
+                        break
+                    to_evict.append(key)
+                    total_bytes -= size
+
+            num_evicted = 0
+            for key in to_evict:
+                # Another process may have evicted it
+                num_evicted += self.delete(key)
+            with self._lock:
+                self._total_bytes = total_bytes
+                self._counters['evictions'] += num_evicted
+            # Forget the access times of the keys that are not in the storage anymore
+            if len(self._last_touch) > len(entries):
+                existing = set(key for key, _, _ in entries)
+                self._last_touch = {k: v for k, v in self._last_touch.items() if k in existing}
+        if num_evicted:
+            logger.info(f'Evicted {num_evicted} keys from {self.storage.root}, remaining {total_bytes} bytes.')
+        return num_evicted
+
+    def start(self):
+        """Start the background compaction, which runs every `compact_interval` seconds or when over the quota."""
+        if self._compact_thread is not None or not self.evictable or not self.compact_interval:
+            return
+        self._stopped.clear()
+        self._compact_thread = threading.Thread(target=self._compact_loop,
+                                                name=f'cache_compaction_{self.storage.root}',
+                                                daemon=True)
+        self._compact_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._compact_thread is not None:
+            self._compact_thread.join()
+            self._compact_thread = None
+
+    def _compact_loop(self):
+        while not self._stopped.is_set():
+            try:
+                self.compact()
+            except Exception as ex:
+                logger.warning(f'Failed to compact the cache in {self.storage.root}: {type(ex).__name__}: {ex}')
+            self._wakeup.wait(self.compact_interval)
+            self._wakeup.clear()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counters, 'bytes': self._total_bytes}
+
+
+def get_cache_manager(storage: Storage, cache_cfg: Optional[dict] = None) -> CacheManager:
+    """Get the cache manager of the storage, which is shared by the storages of the same backend and root.
+
+    Args:
+        storage: The storage of the cache.
+        cache_cfg: The eviction config, such as {'max_bytes': 10 * 1024**3, 'ttl': 7 * 24 * 3600,
+          'compact_interval': 600}. If provided, it replaces the config of the shared cache manager.
+    """
+    key = (storage.backend_type, storage.root)
+    with _CACHE_MANAGERS_LOCK:
+        manager = _CACHE_MANAGERS.get(key)
+        if manager is None:
+            manager = CacheManager(storage)
+            _CACHE_MANAGERS[key] = manager
+        if cache_cfg:
+            manager.max_bytes = cache_cfg.get('max_bytes', manager.max_bytes)
+            manager.ttl = cache_cfg.get('ttl', manager.ttl)
+            manager.compact_interval = cache_cfg.get('compact_interval', manager.compact_interval)
+            manager.start()
+    return manager
@@ -15,12 +15,9 @@ import sys
 import time
 import uuid
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 import json5
-import matplotlib
-import PIL.Image
-from jupyter_client import BlockingKernelClient
 
 from qwen_agent.log import logger
 from qwen_agent.settings import DEFAULT_WORKSPACE
@@ -28,6 +25,10 @@ from qwen_agent.tools.base import BaseTool, register_tool
 from qwen_agent.utils.utils import (append_signal_handler, extract_code, has_chinese_chars, print_traceback,
                                     save_url_to_local_work_dir)
 
+if TYPE_CHECKING:
+    # jupyter_client, matplotlib and PIL are imported on first call, since they take a while to import
+    from jupyter_client import BlockingKernelClient
+
 LAUNCH_KERNEL_PY = """
 from ipykernel import kernelapp as app
 app.launch_new_instance()
@@ -36,7 +37,7 @@ app.launch_new_instance()
 INIT_CODE_FILE = str(Path(__file__).absolute().parent / 'resource' / 'code_interpreter_init_kernel.py')
 ALIB_FONT_FILE = str(Path(__file__).absolute().parent / 'resource' / 'AlibabaPuHuiTi-3-45-Light.ttf')
 
-_KERNEL_CLIENTS: Dict[str, BlockingKernelClient] = {}
+_KERNEL_CLIENTS: Dict[str, 'BlockingKernelClient'] = {}
 _MISC_SUBPROCESSES: Dict[str, subprocess.Popen] = {}
 
 
@@ -158,7 +159,9 @@ class CodeInterpreter(BaseTool):
             if os.path.exists(fname):
                 os.remove(fname)
 
-    def _start_kernel(self, kernel_id: str) -> Tuple[BlockingKernelClient, subprocess.Popen]:
+    def _start_kernel(self, kernel_id: str) -> Tuple['BlockingKernelClient', subprocess.Popen]:
+        from jupyter_client import BlockingKernelClient
+
         connection_file = os.path.join(self.work_dir, f'kernel_connection_file_{kernel_id}.json')
         launch_kernel_script = os.path.join(self.work_dir, f'launch_kernel_{kernel_id}.py')
         for f in [connection_file, launch_kernel_script]:
@@ -204,7 +207,7 @@ class CodeInterpreter(BaseTool):
         kc.wait_for_ready()
         return kc, kernel_process
 
-    def _execute_code(self, kc: BlockingKernelClient, code: str) -> str:
+    def _execute_code(self, kc: 'BlockingKernelClient', code: str) -> str:
         kc.wait_for_ready()
         kc.execute(code)
         result = ''
@@ -260,6 +263,8 @@ class CodeInterpreter(BaseTool):
 
     # TODO: Remove this buggy image service and return local_image_file directly.
     def _serve_image(self, image_base64: str) -> str:
+        import PIL.Image
+
         image_file = f'{uuid.uuid4()}.png'
         local_image_file = os.path.join(self.work_dir, image_file)
 
@@ -279,6 +284,8 @@ class CodeInterpreter(BaseTool):
 
 
 def _fix_matplotlib_cjk_font_issue():
+    import matplotlib
+
     ttf_name = os.path.basename(ALIB_FONT_FILE)
     local_ttf = os.path.join(os.path.abspath(os.path.join(matplotlib.matplotlib_fname(), os.path.pardir)), 'fonts',
                              'ttf', ttf_name)
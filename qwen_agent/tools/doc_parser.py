@@ -1,18 +1,21 @@
+import itertools
 import json
 import os
 import re
 import time
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
-import json5
 from pydantic import BaseModel
 
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_WORKSPACE
+from qwen_agent.settings import (DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_STORAGE_BACKEND,
+                                 DEFAULT_WORKSPACE)
 from qwen_agent.tools.base import BaseTool, register_tool
-from qwen_agent.tools.simple_doc_parser import PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser, get_plain_doc
+from qwen_agent.tools.cache_manager import get_cache_manager
+from qwen_agent.tools.simple_doc_parser import (DEFAULT_REVALIDATE_INTERVAL, PARAGRAPH_SPLIT_SYMBOL, SimpleDocParser,
+                                                get_plain_doc)
 from qwen_agent.tools.storage import KeyNotExistsError, Storage
-from qwen_agent.utils.tokenization_qwen import count_tokens, tokenizer
+from qwen_agent.utils.tokenization_qwen import tokenizer
 from qwen_agent.utils.utils import get_basename_from_url, hash_sha256
 
 
@@ -20,24 +23,32 @@ class Chunk(BaseModel):
     content: str
     metadata: dict
     token: int
+    keywords: Optional[List[str]] = None  # The stemmed and stopword-filtered terms, computed at chunking time
 
-    def __init__(self, content: str, metadata: dict, token: int):
-        super().__init__(content=content, metadata=metadata, token=token)
+    def __init__(self, content: str, metadata: dict, token: int, keywords: Optional[List[str]] = None):
+        super().__init__(content=content, metadata=metadata, token=token, keywords=keywords)
 
     def to_dict(self) -> dict:
-        return {'content': self.content, 'metadata': self.metadata, 'token': self.token}
+        res = {'content': self.content, 'metadata': self.metadata, 'token': self.token}
+        if self.keywords is not None:
+            res['keywords'] = self.keywords
+        return res
 
 
 class Record(BaseModel):
     url: str
     raw: List[Chunk]
     title: str
+    fingerprint: Optional[str] = None  # Identifies one chunking of the doc, and is shared by its partial records
 
-    def __init__(self, url: str, raw: List[Chunk], title: str):
-        super().__init__(url=url, raw=raw, title=title)
+    def __init__(self, url: str, raw: List[Chunk], title: str, fingerprint: Optional[str] = None):
+        super().__init__(url=url, raw=raw, title=title, fingerprint=fingerprint)
 
     def to_dict(self) -> dict:
-        return {'url': self.url, 'raw': [x.to_dict() for x in self.raw], 'title': self.title}
+        res = {'url': self.url, 'raw': [x.to_dict() for x in self.raw], 'title': self.title}
+        if self.fingerprint is not None:
+            res['fingerprint'] = self.fingerprint
+        return res
 
 
 @register_tool('doc_parser')
@@ -56,9 +67,21 @@ class DocParser(BaseTool):
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
 
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
-        self.db = Storage({'storage_root_path': self.data_root})
+        self.db = get_cache_manager(
+            Storage({
+                'storage_root_path': self.data_root,
+                'storage_backend': self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+            }), self.cfg.get('cache_cfg'))
 
-        self.doc_extractor = SimpleDocParser({'structured_doc': True})
+        self.doc_extractor = SimpleDocParser({
+            'structured_doc': True,
+            'max_workers': self.cfg.get('max_workers', 1),
+            'storage_backend': self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND),
+            'cache_cfg': self.cfg.get('cache_cfg'),
+            'revalidate_interval': self.cfg.get('revalidate_interval', DEFAULT_REVALIDATE_INTERVAL)
+        })
+        # The number of new chunks between two partial records yielded by `iter_call`
+        self.stream_chunk_interval: int = self.cfg.get('stream_chunk_interval', 8)
 
     def call(self, params: Union[str, dict], **kwargs) -> dict:
         """Extracting and blocking
@@ -86,39 +109,25 @@ class DocParser(BaseTool):
 
         url = params['url']
 
-        cached_name_chunking = f'{hash_sha256(url)}_{str(parser_page_size)}'
-        try:
-            # Directly load the chunked doc
-            record = self.db.get(cached_name_chunking)
-            record = json5.loads(record)
-            logger.info(f'Read chunked {url} from cache.')
+        # Directly load the chunked doc
+        record = self.get_cached_record(url, parser_page_size=parser_page_size)
+        if record is not None:
             return record
-        except KeyNotExistsError:
-            doc = self.doc_extractor.call({'url': url})
+        cached_name_chunking = f'{hash_sha256(url)}_{str(parser_page_size)}'
+        doc = self.doc_extractor.call({'url': url}, parse_executor=kwargs.get('parse_executor'))
 
         total_token = 0
         for page in doc:
             for para in page['content']:
                 total_token += para['token']
 
-        if doc and 'title' in doc[0]:
-            title = doc[0]['title']
-        else:
-            title = get_basename_from_url(url)
+        title = self._get_title(doc, url)
 
         logger.info(f'Start chunking {url} ({title})...')
         time1 = time.time()
         if total_token <= max_ref_token:
             # The whole doc is one chunk
-            content = [
-                Chunk(content=get_plain_doc(doc),
-                      metadata={
-                          'source': url,
-                          'title': title,
-                          'chunk_id': 0
-                      },
-                      token=total_token)
-            ]
+            content = self._get_whole_doc_chunks(doc, url, title, total_token)
             cached_name_chunking = f'{hash_sha256(url)}_without_chunking'
         else:
             content = self.split_doc_to_chunk(doc, url, title=title, parser_page_size=parser_page_size)
@@ -126,18 +135,132 @@ class DocParser(BaseTool):
         time2 = time.time()
         logger.info(f'Finished chunking {url} ({title}). Time spent: {time2 - time1} seconds.')
 
+        return self._save_record(cached_name_chunking, url, content, title)
+
+    def iter_call(self, params: Union[str, dict], **kwargs) -> Iterator[dict]:
+        """Same as `call`, but parse and chunk the doc page by page.
+
+        The record of the chunks completed so far is yielded every `stream_chunk_interval` chunks, and the full
+        record is yielded at last. So the front part of a long doc can be searched while the rest is being parsed.
+        The chunked doc is cached only if the generator is exhausted.
+        """
+        params = self._verify_json_format_args(params)
+        max_ref_token = kwargs.get('max_ref_token', self.max_ref_token)
+        parser_page_size = kwargs.get('parser_page_size', self.parser_page_size)
+
+        url = params['url']
+
+        record = self.get_cached_record(url, parser_page_size=parser_page_size)
+        if record is not None:
+            yield record
+            return
+        cached_name_chunking = f'{hash_sha256(url)}_{str(parser_page_size)}'
+        pages = self.doc_extractor.iter_call({'url': url})
+
+        # Only the pages before exceeding max_ref_token are buffered, to decide if the doc needs chunking
+        head = []
+        total_token = 0
+        for page in pages:
+            head.append(page)
+            total_token += sum(para['token'] for para in page['content'])
+            if total_token > max_ref_token:
+                break
+
+        title = self._get_title(head, url)
+
+        logger.info(f'Start chunking {url} ({title}) page by page...')
+        time1 = time.time()
+        if total_token <= max_ref_token:
+            content = self._get_whole_doc_chunks(head, url, title, total_token)
+            cached_name_chunking = f'{hash_sha256(url)}_without_chunking'
+            fingerprint = None
+        else:
+            fingerprint = _new_fingerprint(cached_name_chunking)
+            content = []
+            for chk in self.iter_chunks(itertools.chain(head, pages), url, title=title,
+                                        parser_page_size=parser_page_size):
+                content.extend(add_keywords_to_chunks([chk]))
+                if len(content) % self.stream_chunk_interval == 0:
+                    # A copy, since the list goes on growing after the partial record is yielded
+                    yield Record(url=url, raw=content[:], title=title, fingerprint=fingerprint).to_dict()
+
+        time2 = time.time()
+        logger.info(f'Finished chunking {url} ({title}). Time spent: {time2 - time1} seconds.')
+
+        yield self._save_record(cached_name_chunking, url, content, title, fingerprint=fingerprint)
+
+    @staticmethod
+    def _get_title(doc: List[dict], url: str) -> str:
+        if doc and 'title' in doc[0]:
+            return doc[0]['title']
+        return get_basename_from_url(url)
+
+    @staticmethod
+    def _get_whole_doc_chunks(doc: List[dict], url: str, title: str, total_token: int) -> List[Chunk]:
+        content = [
+            Chunk(content=get_plain_doc(doc),
+                  metadata={
+                      'source': url,
+                      'title': title,
+                      'chunk_id': 0
+                  },
+                  token=total_token)
+        ]
+        return add_keywords_to_chunks(content)
+
+    def _save_record(self,
+                     cached_name_chunking: str,
+                     url: str,
+                     content: List[Chunk],
+                     title: str,
+                     fingerprint: Optional[str] = None) -> dict:
         # save the document data
-        new_record = Record(url=url, raw=content, title=title).to_dict()
+        fingerprint = fingerprint or _new_fingerprint(cached_name_chunking)
+        new_record = Record(url=url, raw=content, title=title, fingerprint=fingerprint).to_dict()
         new_record_str = json.dumps(new_record, ensure_ascii=False)
         self.db.put(cached_name_chunking, new_record_str)
         return new_record
 
+    def get_cached_record(self, url: str, parser_page_size: Optional[int] = None) -> Optional[dict]:
+        """Load the chunked doc from cache, and return None if it has not been chunked."""
+        parser_page_size = parser_page_size or self.parser_page_size
+        record = None
+        # A short doc is cached as one chunk whatever the page size is
+        url_hash = hash_sha256(url)
+        for cached_name_chunking in [f'{url_hash}_{str(parser_page_size)}', f'{url_hash}_without_chunking']:
+            try:
+                record = json.loads(self.db.get(cached_name_chunking))
+                break
+            except KeyNotExistsError:
+                continue
+        if record is None:
+            return None
+        if not self.doc_extractor.check_cache(url):
+            # The chunks and the other caches derived from the doc, such as the bm25 postings, are all stale
+            for key in self.db.list_keys(f'{hash_sha256(url)}_'):
+                self.db.delete(key)
+            return None
+        logger.info(f'Read chunked {url} from cache.')
+        return record
+
     def split_doc_to_chunk(self,
                            doc: List[dict],
                            path: str,
                            title: str = '',
                            parser_page_size: int = DEFAULT_PARSER_PAGE_SIZE) -> List[Chunk]:
-        res = []
+        return add_keywords_to_chunks(list(self.iter_chunks(doc, path, title=title,
+                                                            parser_page_size=parser_page_size)))
+
+    def iter_chunks(self,
+                    doc: Iterable[dict],
+                    path: str,
+                    title: str = '',
+                    parser_page_size: int = DEFAULT_PARSER_PAGE_SIZE) -> Iterator[Chunk]:
+        """Split the pages to chunks, and yield each chunk once it is complete.
+
+        The pages are consumed one by one, so the doc can be a generator of the pages being parsed.
+        """
+        num_chunks = 0
         chunk = []
         available_token = parser_page_size
         has_para = False
@@ -163,22 +286,22 @@ class DocParser(BaseTool):
                         # Record one chunk
                         if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
                             chunk.pop()  # Redundant page information
-                        res.append(
-                            Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
-                                [x if isinstance(x, str) else x[0] for x in chunk]),
-                                  metadata={
-                                      'source': path,
-                                      'title': title,
-                                      'chunk_id': len(res)
-                                  },
-                                  token=parser_page_size - available_token))
+                        yield Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
+                            [x if isinstance(x, str) else x[0] for x in chunk]),
+                                    metadata={
+                                        'source': path,
+                                        'title': title,
+                                        'chunk_id': num_chunks
+                                    },
+                                    token=parser_page_size - available_token)
+                        num_chunks += 1
 
                         # Define new chunk
                         overlap_txt = self._get_last_part(chunk)
                         if overlap_txt.strip():
                             chunk = [f'[page: {str(chunk[-1][1])}]', overlap_txt]
                             has_para = False
-                            available_token = parser_page_size - count_tokens(overlap_txt)
+                            available_token = parser_page_size - tokenizer.count(overlap_txt)
                         else:
                             chunk = []
                             has_para = False
@@ -188,19 +311,17 @@ class DocParser(BaseTool):
                         # Split paragraph to sentences
                         _sentences = re.split(r'\. |。', txt)
                         sentences = []
-                        for s in _sentences:
-                            token = count_tokens(s)
+                        for s, token_ids in zip(_sentences, tokenizer.encode_batch(_sentences)):
+                            token = len(token_ids)
                             if not s.strip() or token == 0:
                                 continue
                             if token <= available_token:
                                 sentences.append([s, token])
                             else:
                                 # Limit the length of a sentence to chunk size
-                                token_list = tokenizer.tokenize(s)
-                                for si in range(0, len(token_list), available_token):
-                                    ss = tokenizer.convert_tokens_to_string(
-                                        token_list[si:min(len(token_list), si + available_token)])
-                                    sentences.append([ss, min(available_token, len(token_list) - si)])
+                                for si in range(0, token, available_token):
+                                    ss = tokenizer.truncate_ids(token_ids, max_token=available_token, start_token=si)
+                                    sentences.append([ss, min(available_token, token - si)])
                         sent_index = 0
                         while sent_index < len(sentences):
                             s = sentences[sent_index][0]
@@ -220,21 +341,21 @@ class DocParser(BaseTool):
                                 if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$',
                                                                                chunk[-1]) is not None:
                                     chunk.pop()  # Redundant page information
-                                res.append(
-                                    Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
-                                        [x if isinstance(x, str) else x[0] for x in chunk]),
-                                          metadata={
-                                              'source': path,
-                                              'title': title,
-                                              'chunk_id': len(res)
-                                          },
-                                          token=parser_page_size - available_token))
+                                yield Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join(
+                                    [x if isinstance(x, str) else x[0] for x in chunk]),
+                                            metadata={
+                                                'source': path,
+                                                'title': title,
+                                                'chunk_id': num_chunks
+                                            },
+                                            token=parser_page_size - available_token)
+                                num_chunks += 1
 
                                 overlap_txt = self._get_last_part(chunk)
                                 if overlap_txt.strip():
                                     chunk = [f'[page: {str(chunk[-1][1])}]', overlap_txt]
                                     has_para = False
-                                    available_token = parser_page_size - count_tokens(overlap_txt)
+                                    available_token = parser_page_size - tokenizer.count(overlap_txt)
                                 else:
                                     chunk = []
                                     has_para = False
@@ -244,16 +365,13 @@ class DocParser(BaseTool):
         if has_para:
             if isinstance(chunk[-1], str) and re.fullmatch(r'^\[page: \d+\]$', chunk[-1]) is not None:
                 chunk.pop()  # Redundant page information
-            res.append(
-                Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
-                      metadata={
-                          'source': path,
-                          'title': title,
-                          'chunk_id': len(res)
-                      },
-                      token=parser_page_size - available_token))
-
-        return res
+            yield Chunk(content=PARAGRAPH_SPLIT_SYMBOL.join([x if isinstance(x, str) else x[0] for x in chunk]),
+                        metadata={
+                            'source': path,
+                            'title': title,
+                            'chunk_id': num_chunks
+                        },
+                        token=parser_page_size - available_token)
 
     def _get_last_part(self, chunk: list) -> str:
         overlap = ''
@@ -288,3 +406,26 @@ class DocParser(BaseTool):
                 else:
                     return overlap
         return overlap
+
+
+def add_keywords_to_chunks(chunks: List[Chunk]) -> List[Chunk]:
+    """Segment each chunk once, so that the searchers do not need to re-segment it for every query."""
+    from qwen_agent.tools.search_tools.keyword_search import split_text_into_keywords
+    for chk in chunks:
+        if chk.keywords is None:
+            chk.keywords = split_text_into_keywords(chk.content)
+    return chunks
+
+
+def get_chunk_keywords(chunk: Chunk) -> List[str]:
+    """Get the keywords of a chunk, which may be loaded from a cache produced before the keywords were stored."""
+    if chunk.keywords is None:
+        from qwen_agent.tools.search_tools.keyword_search import split_text_into_keywords
+        return split_text_into_keywords(chunk.content)
+    return chunk.keywords
+
+
+def _new_fingerprint(cached_name_chunking: str) -> str:
+    # The cache key plus the time of chunking, which changes whenever the doc is chunked again, such as after the
+    # doc is modified. It starts with the url hash, so the derived caches are deleted together with the stale record.
+    return f'{cached_name_chunking}_{time.time_ns()}'
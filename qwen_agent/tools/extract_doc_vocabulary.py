@@ -4,8 +4,9 @@ from typing import Dict, Optional, Union
 
 import json5
 
-from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.settings import DEFAULT_STORAGE_BACKEND, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
+from qwen_agent.tools.cache_manager import get_cache_manager
 from qwen_agent.tools.search_tools.keyword_search import WORDS_TO_IGNORE, string_tokenizer
 from qwen_agent.tools.simple_doc_parser import SimpleDocParser
 from qwen_agent.tools.storage import KeyNotExistsError, Storage
@@ -26,10 +27,17 @@ class ExtractDocVocabulary(BaseTool):
 
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
-        self.simple_doc_parse = SimpleDocParser()
+        self.simple_doc_parse = SimpleDocParser({
+            'storage_backend': self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND),
+            'cache_cfg': self.cfg.get('cache_cfg')
+        })
 
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
-        self.db = Storage({'storage_root_path': self.data_root})
+        self.db = get_cache_manager(
+            Storage({
+                'storage_root_path': self.data_root,
+                'storage_backend': self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+            }), self.cfg.get('cache_cfg'))
 
     def call(self, params: Union[str, dict], **kwargs) -> str:
         params = self._verify_json_format_args(params)
@@ -38,19 +46,21 @@ class ExtractDocVocabulary(BaseTool):
 
         if isinstance(files, str):
             files = json5.loads(files)
-        docs = []
-        for file in files:
-            _doc = self.simple_doc_parse.call(params={'url': file}, **kwargs)
-            docs.append(_doc)
 
         try:
-            all_voc = self.db.call({'operate': 'get', 'key': document_id})
+            all_voc = self.db.get(document_id)
         except KeyNotExistsError:
             try:
                 from sklearn.feature_extraction.text import TfidfVectorizer
             except ModuleNotFoundError:
                 raise ModuleNotFoundError('Please install sklearn by: `pip install scikit-learn`')
 
+            # The whole docs are used rather than the chunks, whose overlaps would be counted twice
+            docs = []
+            for file in files:
+                _doc = self.simple_doc_parse.call(params={'url': file}, **kwargs)
+                docs.append(_doc)
+
             vectorizer = TfidfVectorizer(tokenizer=string_tokenizer, stop_words=WORDS_TO_IGNORE)
             tfidf_matrix = vectorizer.fit_transform(docs)
             sorted_items = sorted(zip(vectorizer.get_feature_names_out(),
@@ -59,6 +69,6 @@ class ExtractDocVocabulary(BaseTool):
                                   reverse=True)
             all_voc = ', '.join([term for term, score in sorted_items])
             if document_id:
-                self.db.call({'operate': 'put', 'key': document_id, 'value': json.dumps(all_voc, ensure_ascii=False)})
+                self.db.put(document_id, json.dumps(all_voc, ensure_ascii=False))
 
         return all_voc
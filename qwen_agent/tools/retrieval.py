@@ -1,12 +1,28 @@
-from typing import Dict, Optional, Union
+import multiprocessing
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Union
 
 import json5
 
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_SEARCHERS
+from qwen_agent.log import logger
+from qwen_agent.settings import (DEFAULT_MAX_REF_TOKEN, DEFAULT_PARSER_PAGE_SIZE, DEFAULT_RAG_SEARCHERS,
+                                 DEFAULT_STORAGE_BACKEND)
 from qwen_agent.tools.base import TOOL_REGISTRY, BaseTool, register_tool
 from qwen_agent.tools.doc_parser import DocParser, Record
 from qwen_agent.tools.simple_doc_parser import PARSER_SUPPORTED_FILE_TYPES
 
+DEFAULT_MAX_DOWNLOAD_WORKERS = 8
+DEFAULT_MAX_PARSE_WORKERS = 1  # Parse in the download threads unless a process pool is configured
+
+# The in-flight parsing tasks are shared by all Retrieval objects in the process, so that concurrent sessions asking
+# for the same file do not parse it twice. The executors are shared by the Retrieval objects of the same pool size.
+_EXECUTOR_LOCK = threading.Lock()
+_DOWNLOAD_EXECUTORS: Dict[int, ThreadPoolExecutor] = {}
+_PARSE_EXECUTORS: Dict[int, ProcessPoolExecutor] = {}
+_INFLIGHT_PARSING: Dict[str, Future] = {}
+_PARTIAL_RECORDS: Dict[str, dict] = {}  # The front chunks of the files being parsed page by page
+
 
 @register_tool('retrieval')
 class Retrieval(BaseTool):
@@ -30,14 +46,37 @@ class Retrieval(BaseTool):
         super().__init__(cfg)
         self.max_ref_token: int = self.cfg.get('max_ref_token', DEFAULT_MAX_REF_TOKEN)
         self.parser_page_size: int = self.cfg.get('parser_page_size', DEFAULT_PARSER_PAGE_SIZE)
-        self.doc_parse = DocParser({'max_ref_token': self.max_ref_token, 'parser_page_size': self.parser_page_size})
+        self.storage_backend: str = self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+        self.cache_cfg: Optional[dict] = self.cfg.get('cache_cfg')  # The eviction config of the caches
+        self.doc_parse = DocParser({
+            'max_ref_token': self.max_ref_token,
+            'parser_page_size': self.parser_page_size,
+            'storage_backend': self.storage_backend,
+            'cache_cfg': self.cache_cfg
+        })
+        self.max_download_workers: int = self.cfg.get('max_download_workers', DEFAULT_MAX_DOWNLOAD_WORKERS)
+        # The size of the process pool to parse multiple files in parallel. The pool uses spawn, which re-imports the
+        # main module in each worker, so it is opt-in for the scripts guarded by `if __name__ == '__main__'`.
+        self.max_parse_workers: int = self.cfg.get('max_parse_workers', DEFAULT_MAX_PARSE_WORKERS)
+        # Seconds to wait for the files not in the cache, None to wait until all files are parsed. If it is set, the
+        # files are parsed page by page, so that the front chunks of the unfinished files can be searched after it.
+        self.parse_timeout: Optional[float] = self.cfg.get('parse_timeout', None)
 
         self.rag_searchers = self.cfg.get('rag_searchers', DEFAULT_RAG_SEARCHERS)
         if len(self.rag_searchers) == 1:
-            self.search = TOOL_REGISTRY[self.rag_searchers[0]]({'max_ref_token': self.max_ref_token})
+            self.search = TOOL_REGISTRY[self.rag_searchers[0]]({
+                'max_ref_token': self.max_ref_token,
+                'storage_backend': self.storage_backend,
+                'cache_cfg': self.cache_cfg
+            })
         else:
             from qwen_agent.tools.search_tools.hybrid_search import HybridSearch
-            self.search = HybridSearch({'max_ref_token': self.max_ref_token, 'rag_searchers': self.rag_searchers})
+            self.search = HybridSearch({
+                'max_ref_token': self.max_ref_token,
+                'rag_searchers': self.rag_searchers,
+                'storage_backend': self.storage_backend,
+                'cache_cfg': self.cache_cfg
+            })
 
     def call(self, params: Union[str, dict], **kwargs) -> list:
         """RAG tool.
@@ -55,13 +94,102 @@ class Retrieval(BaseTool):
         files = params.get('files', [])
         if isinstance(files, str):
             files = json5.loads(files)
-        records = []
-        for file in files:
-            _record = self.doc_parse.call(params={'url': file}, **kwargs)
-            records.append(_record)
+        records = self._parse_files(files, **kwargs)
 
         query = params.get('query', '')
         if records:
             return self.search.call(params={'query': query}, docs=[Record(**rec) for rec in records], **kwargs)
         else:
             return []
+
+    def _parse_files(self, files: List[str], **kwargs) -> List[dict]:
+        """Parse files concurrently, and return the records in the order of files.
+
+        The cached records are loaded at once. The missed files are downloaded and chunked in a thread pool, and the
+        CPU-bound parsing of the files is run in a process pool when there are multiple files to parse and
+        `max_parse_workers` is more than 1. If `parse_timeout` is set, the files are parsed page by page instead, and
+        only the chunks completed before the timeout are returned for the files still being parsed, whose parsing goes
+        on in the background for the later calls. A file with no chunk completed is left out, unless no file is
+        available at all.
+        """
+        parser_page_size = kwargs.get('parser_page_size', self.parser_page_size)
+        records = [self.doc_parse.get_cached_record(file, parser_page_size=parser_page_size) for file in files]
+        missed = [i for i, rec in enumerate(records) if rec is None]
+        if not missed:
+            return records
+
+        if len(missed) > 1 and self.max_parse_workers > 1 and self.parse_timeout is None:
+            kwargs = {**kwargs, 'parse_executor': self._get_parse_executor()}
+        futures = {i: self._submit_parsing(files[i], **kwargs) for i in missed}
+        done, _ = wait(futures.values(), timeout=self.parse_timeout)
+        with _EXECUTOR_LOCK:
+            partial_records = {
+                i: _PARTIAL_RECORDS.get(self._get_parsing_key(files[i], **kwargs))
+                for i, future in futures.items()
+                if not future.done()
+            }
+        if not done and len(missed) == len(files) and not any(partial_records.values()):
+            # At least one file is needed to search
+            done, _ = wait(futures.values(), return_when=FIRST_COMPLETED)
+        for i, future in futures.items():
+            if future.done():
+                records[i] = future.result()
+            elif partial_records.get(i) is None:
+                logger.info(f'Leave out {files[i]}, which is still being parsed.')
+            else:
+                records[i] = partial_records[i]
+                logger.info(f'Search the first {len(records[i]["raw"])} chunks of {files[i]}, '
+                            'which is still being parsed.')
+        return [rec for rec in records if rec is not None]
+
+    def _submit_parsing(self, file: str, **kwargs) -> Future:
+        key = self._get_parsing_key(file, **kwargs)
+        with _EXECUTOR_LOCK:
+            if key in _INFLIGHT_PARSING:
+                logger.info(f'Wait for the in-flight parsing of {file}.')
+                return _INFLIGHT_PARSING[key]
+            if self.parse_timeout is None:
+                future = self._get_download_executor().submit(self.doc_parse.call, params={'url': file}, **kwargs)
+            else:
+                future = self._get_download_executor().submit(self._parse_page_by_page, key, file, **kwargs)
+            _INFLIGHT_PARSING[key] = future
+
+        def _on_done(_):
+            with _EXECUTOR_LOCK:
+                _INFLIGHT_PARSING.pop(key, None)
+                _PARTIAL_RECORDS.pop(key, None)
+
+        future.add_done_callback(_on_done)
+        return future
+
+    def _parse_page_by_page(self, key: str, file: str, **kwargs) -> dict:
+        record = None
+        for record in self.doc_parse.iter_call(params={'url': file}, **kwargs):
+            with _EXECUTOR_LOCK:
+                _PARTIAL_RECORDS[key] = record
+        return record
+
+    def _get_parsing_key(self, file: str, **kwargs) -> str:
+        return '|'.join([
+            self.doc_parse.data_root, file,
+            str(kwargs.get('parser_page_size', self.parser_page_size)),
+            str(kwargs.get('max_ref_token', self.max_ref_token))
+        ])
+
+    def _get_download_executor(self) -> ThreadPoolExecutor:
+        # Called with _EXECUTOR_LOCK held
+        if self.max_download_workers not in _DOWNLOAD_EXECUTORS:
+            _DOWNLOAD_EXECUTORS[self.max_download_workers] = ThreadPoolExecutor(
+                max_workers=self.max_download_workers, thread_name_prefix='doc_download')
+        return _DOWNLOAD_EXECUTORS[self.max_download_workers]
+
+    def _get_parse_executor(self) -> ProcessPoolExecutor:
+        with _EXECUTOR_LOCK:
+            executor = _PARSE_EXECUTORS.get(self.max_parse_workers)
+            if executor is None or getattr(executor, '_broken', False):
+                if executor is not None:
+                    executor.shutdown(wait=False)
+                # Use spawn, because forking a process with running threads is unsafe
+                executor = _PARSE_EXECUTORS[self.max_parse_workers] = ProcessPoolExecutor(
+                    max_workers=self.max_parse_workers, mp_context=multiprocessing.get_context('spawn'))
+            return executor
@@ -1,7 +1,11 @@
-from .front_page_search import FrontPageSearch
-from .hybrid_search import HybridSearch
-from .keyword_search import KeywordSearch
-from .vector_search import VectorSearch
+from qwen_agent.utils.utils import lazy_module_attrs
+
+__getattr__, __dir__ = lazy_module_attrs(__name__, {
+    'FrontPageSearch': '.front_page_search',
+    'HybridSearch': '.hybrid_search',
+    'KeywordSearch': '.keyword_search',
+    'VectorSearch': '.vector_search',
+})
 
 __all__ = [
     'KeywordSearch',
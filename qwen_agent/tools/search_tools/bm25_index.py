@@ -0,0 +1,143 @@
+import math
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def build_doc_postings(tokenized_chunks: List[List[str]]) -> dict:
+    """Build the BM25 postings of one document.
+
+    Args:
+        tokenized_chunks: The keyword list of each chunk, indexed by chunk id.
+
+    Returns:
+        A json serializable dict:
+          {
+            'chunk_lens': [the number of keywords in each chunk],
+            'postings': {'term': [[chunk_id, term frequency], ...]}
+          }
+    """
+    doc_postings = {'chunk_lens': [], 'postings': {}}
+    extend_doc_postings(doc_postings, tokenized_chunks)
+    return doc_postings
+
+
+def extend_doc_postings(doc_postings: dict, tokenized_chunks: List[List[str]]) -> Dict[str, int]:
+    """Append new chunks to the postings of one document in place.
+
+    Returns:
+        The number of the new chunks containing each term.
+    """
+    new_df = {}
+    postings = doc_postings['postings']
+    chunk_lens = doc_postings['chunk_lens']
+    for words in tokenized_chunks:
+        chunk_id = len(chunk_lens)
+        chunk_lens.append(len(words))
+        for word, freq in Counter(words).items():
+            postings.setdefault(word, []).append([chunk_id, freq])
+            new_df[word] = new_df.get(word, 0) + 1
+    return new_df
+
+
+class BM25Index:
+    """An incrementally updated BM25Okapi index over the chunks of multiple documents.
+
+    Each document contributes its own postings (see `build_doc_postings`), so adding or removing a document only
+    updates the corpus statistics by the terms of that document. The scores are the same as `rank_bm25.BM25Okapi`
+    built over all chunks of the indexed documents, but only the postings of the query terms are visited.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.docs: Dict[str, dict] = {}
+        self._df: Dict[str, int] = {}  # term -> number of chunks with this term
+        self._num_chunks = 0
+        self._total_len = 0
+        self._average_idf: Optional[float] = None  # lazily computed, reset on every update
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.docs
+
+    def add_document(self, doc_id: str, doc_postings: dict):
+        if doc_id in self.docs:
+            self.remove_document(doc_id)
+        self.docs[doc_id] = doc_postings
+        for term, posting in doc_postings['postings'].items():
+            self._df[term] = self._df.get(term, 0) + len(posting)
+        self._num_chunks += len(doc_postings['chunk_lens'])
+        self._total_len += sum(doc_postings['chunk_lens'])
+        self._average_idf = None
+
+    def append_chunks(self, doc_id: str, tokenized_chunks: List[List[str]]):
+        """Append new chunks to an indexed document, such as a document that is still being parsed."""
+        new_df = extend_doc_postings(self.docs[doc_id], tokenized_chunks)
+        for term, df in new_df.items():
+            self._df[term] = self._df.get(term, 0) + df
+        self._num_chunks += len(tokenized_chunks)
+        self._total_len += sum(len(words) for words in tokenized_chunks)
+        self._average_idf = None
+
+    def rename_document(self, doc_id: str, new_doc_id: str):
+        self.docs[new_doc_id] = self.docs.pop(doc_id)
+
+    def remove_document(self, doc_id: str):
+        doc_postings = self.docs.pop(doc_id, None)
+        if doc_postings is None:
+            return
+        for term, posting in doc_postings['postings'].items():
+            df = self._df[term] - len(posting)
+            if df > 0:
+                self._df[term] = df
+            else:
+                del self._df[term]
+        self._num_chunks -= len(doc_postings['chunk_lens'])
+        self._total_len -= sum(doc_postings['chunk_lens'])
+        self._average_idf = None
+
+    def _raw_idf(self, df: int) -> float:
+        return math.log(self._num_chunks - df + 0.5) - math.log(df + 0.5)
+
+    def _idf(self, term: str) -> float:
+        df = self._df.get(term, 0)
+        if not df:
+            return 0.0
+        idf = self._raw_idf(df)
+        if idf < 0:
+            # Same as BM25Okapi: set a floor for the terms contained in more than half of the chunks
+            if self._average_idf is None:
+                self._average_idf = sum(self._raw_idf(x) for x in self._df.values()) / len(self._df)
+            idf = self.epsilon * self._average_idf
+        return idf
+
+    def get_scores(self, query: List[str]) -> Dict[str, np.ndarray]:
+        """Score all chunks of the indexed documents.
+
+        Returns:
+            A dict mapping the doc id to the scores of its chunks, indexed by chunk id.
+        """
+        scores = {doc_id: np.zeros(len(doc_postings['chunk_lens'])) for doc_id, doc_postings in self.docs.items()}
+        if not self._total_len:
+            return scores
+        avgdl = self._total_len / self._num_chunks
+
+        norms = {}
+        for term in query:
+            idf = self._idf(term)
+            if not idf:
+                continue
+            for doc_id, doc_postings in self.docs.items():
+                posting = doc_postings['postings'].get(term)
+                if not posting:
+                    continue
+                if doc_id not in norms:
+                    chunk_lens = np.asarray(doc_postings['chunk_lens'], dtype=np.float64)
+                    norms[doc_id] = self.k1 * (1 - self.b + self.b * chunk_lens / avgdl)
+                chunk_ids, freqs = np.asarray(posting, dtype=np.int64).T
+                freqs = freqs.astype(np.float64)
+                scores[doc_id][chunk_ids] += idf * (freqs * (self.k1 + 1) / (freqs + norms[doc_id][chunk_ids]))
+        return scores
@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from qwen_agent.log import logger
+from qwen_agent.utils.utils import hash_sha256
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+EMBEDDING_REGISTRY = {}
+
+# The stores are shared by the searchers of the same files in a process, keyed by (root, model name, dtype)
+_STORES: Dict[Tuple[str, str, str], 'EmbeddingStore'] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def register_embedding(embedding_type):
+
+    def decorator(cls):
+        EMBEDDING_REGISTRY[embedding_type] = cls
+        return cls
+
+    return decorator
+
+
+class BaseEmbedding(ABC):
+    """The base class of the embedding backends used by VectorSearch"""
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        self.cfg = cfg or {}
+        self.model = self.cfg.get('model', '')
+
+    @property
+    def model_name(self) -> str:
+        """The unique name of the embedding model, which is a part of the cache key of the vectors."""
+        return f'{self.__class__.__name__}:{self.model}'
+
+    @abstractmethod
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed a batch of texts and return a matrix of shape (len(texts), dim)."""
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed_documents([text])[0]
+
+
+@register_embedding('dashscope')
+class DashScopeEmbedding(BaseEmbedding):
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.model = self.model or 'text-embedding-v1'
+        try:
+            from langchain_community.embeddings import DashScopeEmbeddings
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('Please install langchain_community by: `pip install langchain_community`')
+        self.client = DashScopeEmbeddings(model=self.model,
+                                          dashscope_api_key=self.cfg.get('api_key',
+                                                                         os.getenv('DASHSCOPE_API_KEY', '')))
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.client.embed_documents(texts), dtype=np.float32)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return np.asarray(self.client.embed_query(text), dtype=np.float32)
+
+
+@register_embedding('sentence_transformer')
+class SentenceTransformerEmbedding(BaseEmbedding):
+    """Offline embedding with a local SentenceTransformer model, such as `agents/resource/acge_text_embedding`"""
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        if not self.model:
+            raise ValueError('Please specify the local path or the name of the SentenceTransformer model by `model`.')
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('Please install sentence_transformers by: `pip install sentence_transformers`')
+        self.encoder = SentenceTransformer(self.model)
+        self.batch_size = self.cfg.get('batch_size', 32)
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.encoder.encode(texts, batch_size=self.batch_size, normalize_embeddings=True),
+                          dtype=np.float32)
+
+
+def get_embedding(cfg: Optional[Union[Dict, BaseEmbedding]] = None) -> BaseEmbedding:
+    """The interface of instantiating embedding objects.
+
+    Args:
+        cfg: An embedding object, or the embedding configuration, such as:
+          {'embedding_type': 'dashscope', 'model': 'text-embedding-v1'}
+          {'embedding_type': 'sentence_transformer', 'model': 'qwen_agent/agents/resource/acge_text_embedding'}
+    """
+    if isinstance(cfg, BaseEmbedding):
+        return cfg
+    cfg = cfg or {}
+    embedding_type = cfg.get('embedding_type', 'dashscope')
+    if embedding_type not in EMBEDDING_REGISTRY:
+        raise ValueError(f'Please set embedding_type from {str(EMBEDDING_REGISTRY.keys())}')
+    return EMBEDDING_REGISTRY[embedding_type](cfg)
+
+
+class EmbeddingStore:
+    """A persistent cache of embeddings, keyed by the content hash of the text and the embedding model.
+
+    The vectors of one model are appended to a raw matrix file which is read by memory mapping, and the id map
+    records the row of each content hash. Only the texts that have not been seen are sent to the embedding backend.
+
+    The appends are serialized by a file lock and re-read the id map under it, so the stores of the same files in
+    several processes do not overwrite the rows of each other. Use `get_embedding_store` to share one store in a
+    process. The file lock is not available on Windows, where only one process can use the files.
+    """
+
+    def __init__(self, root: str, embedding: BaseEmbedding, dtype: str = 'float32'):
+        self.embedding = embedding
+        self.dtype = np.dtype(dtype)
+        self.root = os.path.join(root, hash_sha256(embedding.model_name))
+        os.makedirs(self.root, exist_ok=True)
+        self.vectors_path = os.path.join(self.root, f'vectors.{self.dtype.name}')
+        self.ids_path = os.path.join(self.root, 'ids.json')
+        self.lock_path = os.path.join(self.root, 'lock')
+
+        self._lock = threading.Lock()
+        self._dim = 0
+        self._ids: Dict[str, int] = {}
+        self._vectors: Optional[np.ndarray] = None
+        self._load_ids()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Get the embedding of each text in float32, embedding only the texts not stored yet."""
+        keys = [hash_sha256(text) for text in texts]
+        if not keys:
+            return np.zeros((0, self._dim), dtype=np.float32)
+        with self._lock:
+            missing = self._get_missing(dict(zip(keys, texts)))
+            if missing:
+                logger.info(f'Embedding {len(missing)} new texts with {self.embedding.model_name}...')
+                self._append(list(missing.keys()), self.embedding.embed_documents(list(missing.values())))
+            vectors = self._get_vectors()
+            return np.asarray(vectors[[self._ids[key] for key in keys]], dtype=np.float32)
+
+    def get_query_embedding(self, query: str) -> np.ndarray:
+        key = hash_sha256(f'query:{query}')
+        with self._lock:
+            if self._get_missing({key: query}):
+                self._append([key], self.embedding.embed_query(query).reshape(1, -1))
+            return np.asarray(self._get_vectors()[self._ids[key]], dtype=np.float32)
+
+    def _get_missing(self, texts: Dict[str, str]) -> Dict[str, str]:
+        missing = {key: text for key, text in texts.items() if key not in self._ids}
+        if missing:
+            # The texts may have been stored by another process
+            self._load_ids()
+            missing = {key: text for key, text in missing.items() if key not in self._ids}
+        return missing
+
+    def _load_ids(self):
+        # The id map is replaced atomically, so it can be read without the file lock
+        if os.path.exists(self.ids_path):
+            with open(self.ids_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            self._dim = meta['dim']
+            self._ids = meta['ids']
+            self._vectors = None
+
+    def _append(self, keys: List[str], vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released on closing the file
+            # Append after the rows written by the other processes since the id map was read
+            self._load_ids()
+            new_rows = [i for i, key in enumerate(keys) if key not in self._ids]
+            if not new_rows:
+                return
+            if not self._dim:
+                self._dim = vectors.shape[1]
+            assert vectors.shape[1] == self._dim, f'Embedding dim {vectors.shape[1]} != {self._dim} in {self.root}'
+
+            n = len(self._ids)
+            with open(self.vectors_path, 'ab') as f:
+                # Drop the rows written by an interrupted append, which are not in the id map just read
+                f.truncate(n * self._dim * self.dtype.itemsize)
+                f.write(vectors[new_rows].tobytes())
+            for i, row in enumerate(new_rows):
+                self._ids[keys[row]] = n + i
+
+            tmp_path = f'{self.ids_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self._dim, 'ids': self._ids}, f)
+            os.replace(tmp_path, self.ids_path)
+            self._vectors = None  # Re-map the grown file when needed
+
+    def _get_vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(len(self._ids), self._dim))
+        return self._vectors
+
+
+def get_embedding_store(root: str, embedding: BaseEmbedding, dtype: str = 'float32') -> EmbeddingStore:
+    """Get the embedding store of the root and the embedding model, which is shared in this process."""
+    key = (os.path.abspath(root), embedding.model_name, np.dtype(dtype).name)
+    with _STORES_LOCK:
+        if key not in _STORES:
+            _STORES[key] = EmbeddingStore(root=root, embedding=embedding, dtype=dtype)
+        return _STORES[key]
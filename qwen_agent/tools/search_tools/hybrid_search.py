@@ -1,11 +1,25 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
 from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
+from qwen_agent.log import logger
 from qwen_agent.settings import DEFAULT_RAG_SEARCHERS
 from qwen_agent.tools.base import TOOL_REGISTRY, register_tool
 from qwen_agent.tools.doc_parser import Record
 from qwen_agent.tools.search_tools.base_search import BaseSearch
 from qwen_agent.tools.search_tools.front_page_search import POSITIVE_INFINITY
 
+DEFAULT_SEARCHER_TIMEOUT = 60  # Seconds to wait for one sub-searcher before ignoring its results
+RRF_K = 60
+
+# The pools of the sub-searchers are shared by the HybridSearch instances of the same pool size in a process
+_EXECUTORS: Dict[int, ThreadPoolExecutor] = {}
+_EXECUTORS_LOCK = threading.Lock()
+
 
 @register_tool('hybrid_search')
 class HybridSearch(BaseSearch):
@@ -18,30 +32,86 @@ class HybridSearch(BaseSearch):
             raise ValueError(f'{self.name} can not be in `rag_searchers` = {self.rag_searchers}')
         self.search_objs = [TOOL_REGISTRY[name](cfg) for name in self.rag_searchers]
 
+        # The weight of each sub-searcher in the reciprocal rank fusion, either a list or a dict keyed by name
+        weights = self.cfg.get('rag_searcher_weights', {})
+        if isinstance(weights, dict):
+            weights = [weights.get(name, 1.0) for name in self.rag_searchers]
+        if len(weights) != len(self.rag_searchers):
+            raise ValueError(
+                f'`rag_searcher_weights` = {weights} does not match `rag_searchers` = {self.rag_searchers}')
+        self.searcher_weights: List[float] = weights
+
+        self.searcher_timeout: Optional[float] = self.cfg.get('searcher_timeout', DEFAULT_SEARCHER_TIMEOUT)
+        self.top_k: Optional[int] = self.cfg.get('top_k', None)  # Only sort the top-k chunks if provided
+
+        # A slow sub-searcher keeps occupying its worker after timeout, so reserve more workers than searchers
+        self.executor = _get_executor(self.cfg.get('max_workers', 4 * len(self.search_objs)))
+
     def sort_by_scores(self, query: str, docs: List[Record], **kwargs) -> List[Tuple[str, int, float]]:
+        futures = [
+            self.executor.submit(s_obj.sort_by_scores, query=query, docs=docs, **kwargs) for s_obj in self.search_objs
+        ]
+
+        # One deadline for all sub-searchers, which run in parallel
+        done, _ = wait(futures, timeout=self.searcher_timeout)
         chunk_and_score_list = []
-        for s_obj in self.search_objs:
-            chunk_and_score_list.append(s_obj.sort_by_scores(query=query, docs=docs, **kwargs))
+        first_error = None
+        for name, weight, future in zip(self.rag_searchers, self.searcher_weights, futures):
+            if future not in done:
+                logger.warning(f'Ignore the results of {name}, which does not finish in {self.searcher_timeout}s.')
+                first_error = first_error or FutureTimeoutError()
+                continue
+            try:
+                chunk_and_score_list.append((weight, future.result()))
+            except Exception as ex:
+                logger.warning(f'Ignore the results of {name} due to the error: {type(ex).__name__}: {ex}')
+                first_error = first_error or ex
+        if not chunk_and_score_list and first_error is not None:
+            raise first_error
 
-        chunk_score_map = {}
+        return self._fuse_by_rrf(chunk_and_score_list, docs=docs)
+
+    def _fuse_by_rrf(self, chunk_and_score_list: List[Tuple[float, List[Tuple[str, int, float]]]],
+                     docs: List[Record]) -> List[Tuple[str, int, float]]:
+        # All chunks are flattened into one array, in which the chunk (doc, i) is at offsets[doc.url] + i
+        offsets = {}
+        urls = []
         for doc in docs:
-            chunk_score_map[doc.url] = [0] * len(doc.raw)
-
-        for chunk_and_score in chunk_and_score_list:
-            for i in range(len(chunk_and_score)):
-                doc_id = chunk_and_score[i][0]
-                chunk_id = chunk_and_score[i][1]
-                score = chunk_and_score[i][2]
-                if score == POSITIVE_INFINITY:
-                    chunk_score_map[doc_id][chunk_id] = POSITIVE_INFINITY
-                else:
-                    # TODO: This needs to be adjusted for performance
-                    chunk_score_map[doc_id][chunk_id] += 1 / (i + 1 + 60)
-
-        all_chunk_and_score = []
-        for k, v in chunk_score_map.items():
-            for i, x in enumerate(v):
-                all_chunk_and_score.append((k, i, x))
-        all_chunk_and_score.sort(key=lambda item: item[2], reverse=True)
-
-        return all_chunk_and_score
+            if doc.url not in offsets:
+                offsets[doc.url] = len(urls)
+                urls.extend([doc.url] * len(doc.raw))
+        chunk_ids = np.arange(len(urls)) - np.asarray([offsets[url] for url in urls], dtype=np.int64)
+
+        scores = np.zeros(len(urls))
+        pinned = np.zeros(len(urls), dtype=bool)
+        for weight, chunk_and_score in chunk_and_score_list:
+            if not chunk_and_score:
+                continue
+            idx = np.fromiter((offsets[doc_id] + chunk_id for doc_id, chunk_id, _ in chunk_and_score),
+                              dtype=np.int64,
+                              count=len(chunk_and_score))
+            raw_scores = np.fromiter((score for _, _, score in chunk_and_score),
+                                     dtype=np.float64,
+                                     count=len(chunk_and_score))
+            is_inf = (raw_scores == POSITIVE_INFINITY)
+            ranks = np.arange(len(chunk_and_score))
+            pinned[idx[is_inf]] = True
+            # TODO: This needs to be adjusted for performance
+            np.add.at(scores, idx[~is_inf], weight / (ranks[~is_inf] + 1 + RRF_K))
+        scores[pinned] = POSITIVE_INFINITY
+
+        # Sort by descending score, keeping the doc order for ties
+        if self.top_k and self.top_k < len(scores):
+            order = np.argpartition(-scores, self.top_k - 1)[:self.top_k]
+            order = order[np.lexsort((order, -scores[order]))]
+        else:
+            order = np.argsort(-scores, kind='stable')
+
+        return [(urls[i], int(chunk_ids[i]), float(scores[i])) for i in order]
+
+
+def _get_executor(max_workers: int) -> ThreadPoolExecutor:
+    with _EXECUTORS_LOCK:
+        if max_workers not in _EXECUTORS:
+            _EXECUTORS[max_workers] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hybrid_search')
+        return _EXECUTORS[max_workers]
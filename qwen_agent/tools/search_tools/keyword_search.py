@@ -1,21 +1,44 @@
-from typing import List, Tuple
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 import jieba
 import json5
 import snowballstemmer
 
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN
+from qwen_agent.settings import DEFAULT_MAX_REF_TOKEN, DEFAULT_STORAGE_BACKEND, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import register_tool
-from qwen_agent.tools.doc_parser import Record
+from qwen_agent.tools.cache_manager import get_cache_manager
+from qwen_agent.tools.doc_parser import Record, get_chunk_keywords
 from qwen_agent.tools.search_tools.base_search import BaseSearch, RefMaterialOutput
+from qwen_agent.tools.search_tools.bm25_index import BM25Index, build_doc_postings, extend_doc_postings
+from qwen_agent.tools.storage import KeyNotExistsError, Storage
 from qwen_agent.utils.tokenization_qwen import tokenizer
-from qwen_agent.utils.utils import has_chinese_chars
+from qwen_agent.utils.utils import has_chinese_chars, hash_sha256
 
 
 @register_tool('keyword_search')
 class KeywordSearch(BaseSearch):
 
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        # The BM25 postings are persisted next to the chunk cache of DocParser
+        self.index_root = self.cfg.get('index_path', os.path.join(DEFAULT_WORKSPACE, 'tools', 'doc_parser'))
+        self.db = get_cache_manager(
+            Storage({
+                'storage_root_path': self.index_root,
+                'storage_backend': self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+            }), self.cfg.get('cache_cfg'))
+
+        self.bm25_index = BM25Index()
+        # The LRU cache of the postings of the docs searched recently, keyed by the index id
+        self._postings: 'OrderedDict[str, dict]' = OrderedDict()
+        self.max_cached_docs: int = self.cfg.get('max_cached_docs', 64)
+        self._index_lock = threading.Lock()
+
     def search(self, query: str, docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
         chunk_and_score = self.sort_by_scores(query=query, docs=docs)
         if not chunk_and_score:
@@ -34,23 +57,64 @@ class KeywordSearch(BaseSearch):
             # This represents the queries that do not use retrieval: summarize, etc.
             return []
 
-        # Plain all chunks from all docs
-        all_chunks = []
-        for doc in docs:
-            all_chunks.extend(doc.raw)
-
         # Using bm25 retrieval
-        from rank_bm25 import BM25Okapi
-        bm25 = BM25Okapi([split_text_into_keywords(x.content) for x in all_chunks])
-        doc_scores = bm25.get_scores(wordlist)
-        chunk_and_score = [
-            (chk.metadata['source'], chk.metadata['chunk_id'], score) for chk, score in zip(all_chunks, doc_scores)
-        ]
+        with self._index_lock:
+            doc_ids = self._update_index(docs)
+            doc_scores = self.bm25_index.get_scores(wordlist)
+
+        chunk_and_score = []
+        for doc, doc_id in zip(docs, doc_ids):
+            for chk, score in zip(doc.raw, doc_scores[doc_id]):
+                chunk_and_score.append((chk.metadata['source'], chk.metadata['chunk_id'], score))
         chunk_and_score.sort(key=lambda item: item[2], reverse=True)
         assert len(chunk_and_score) > 0
 
         return chunk_and_score
 
+    def _update_index(self, docs: List[Record]) -> List[str]:
+        """Make the BM25 index score exactly the given docs, and return the index id of each doc.
+
+        The postings of the docs out of this query are kept in memory for the later queries, so the sessions querying
+        different docs do not rebuild the postings of each other.
+        """
+        doc_ids = [self._get_index_id(doc) for doc in docs]
+        for doc, doc_id in zip(docs, doc_ids):
+            doc_postings = self.bm25_index.docs.get(doc_id) or self._postings.get(doc_id)
+            if doc_postings is None:
+                try:
+                    doc_postings = json.loads(self.db.get(doc_id))
+                except KeyNotExistsError:
+                    logger.info(f'Start building the bm25 index of {doc.url}...')
+                    doc_postings = build_doc_postings([])
+            num_indexed = len(doc_postings['chunk_lens'])
+            if num_indexed < len(doc.raw):
+                # The doc has grown since it was indexed, such as a doc being parsed page by page
+                new_chunks = [get_chunk_keywords(x) for x in doc.raw[num_indexed:]]
+                if doc_id in self.bm25_index:
+                    self.bm25_index.append_chunks(doc_id, new_chunks)
+                else:
+                    extend_doc_postings(doc_postings, new_chunks)
+                self.db.put(doc_id, json.dumps(doc_postings, ensure_ascii=False))
+            if doc_id not in self.bm25_index:
+                self.bm25_index.add_document(doc_id, doc_postings)
+            self._postings[doc_id] = doc_postings
+            self._postings.move_to_end(doc_id)
+
+        for doc_id in list(self.bm25_index.docs.keys()):
+            if doc_id not in doc_ids:
+                self.bm25_index.remove_document(doc_id)
+        while len(self._postings) > max(self.max_cached_docs, len(docs)):
+            self._postings.popitem(last=False)
+        return doc_ids
+
+    @staticmethod
+    def _get_index_id(doc: Record) -> str:
+        if doc.fingerprint:
+            return f'{doc.fingerprint}_bm25'
+        # The docs not chunked by DocParser, such as the texts given directly, are identified by their chunks
+        chunking = hash_sha256('\n'.join(chk.content for chk in doc.raw) + f'_{len(doc.raw)}')
+        return f'{hash_sha256(doc.url)}_{chunking}_bm25'
+
     @staticmethod
     def _get_the_front_part(docs: List[Record], max_ref_token: int = DEFAULT_MAX_REF_TOKEN) -> list:
         single_max_ref_token = int(max_ref_token / len(docs))
@@ -94,7 +158,17 @@ WORDS_TO_IGNORE = [
     "wouldn't", '说说', '讲讲', '介绍', 'summary'
 ]
 
-STEMMER = snowballstemmer.stemmer('english')
+_WORDS_TO_IGNORE_SET = frozenset(WORDS_TO_IGNORE)
+
+_THREAD_LOCAL = threading.local()
+
+
+def stem_words(words: List[str]) -> List[str]:
+    # The snowball stemmer is stateful, so each thread uses its own stemmer
+    stemmer = getattr(_THREAD_LOCAL, 'stemmer', None)
+    if stemmer is None:
+        stemmer = _THREAD_LOCAL.stemmer = snowballstemmer.stemmer('english')
+    return stemmer.stemWords(words)
 
 
 def string_tokenizer(text: str) -> List[str]:
@@ -103,14 +177,14 @@ def string_tokenizer(text: str) -> List[str]:
         _wordlist = list(jieba.lcut(text.strip()))
     else:
         _wordlist = text.strip().split()
-    return STEMMER.stemWords(_wordlist)
+    return stem_words(_wordlist)
 
 
 def split_text_into_keywords(text: str) -> List[str]:
     _wordlist = string_tokenizer(text)
     wordlist = []
     for x in _wordlist:
-        if x in WORDS_TO_IGNORE:
+        if x in _WORDS_TO_IGNORE_SET:
             continue
         wordlist.append(x)
     return wordlist
@@ -129,10 +203,10 @@ def parse_keyword(text):
             _wordlist.extend([kw.lower() for kw in res['keywords_zh']])
         if 'keywords_en' in res and isinstance(res['keywords_en'], list):
             _wordlist.extend([kw.lower() for kw in res['keywords_en']])
-        _wordlist = STEMMER.stemWords(_wordlist)
+        _wordlist = stem_words(_wordlist)
         wordlist = []
         for x in _wordlist:
-            if x in WORDS_TO_IGNORE:
+            if x in _WORDS_TO_IGNORE_SET:
                 continue
             wordlist.append(x)
         split_wordlist = split_text_into_keywords(res['text'])
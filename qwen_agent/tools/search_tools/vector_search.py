@@ -1,29 +1,50 @@
 import json
 import os
-from typing import List, Tuple
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
+from qwen_agent.settings import DEFAULT_WORKSPACE
 from qwen_agent.tools.base import register_tool
 from qwen_agent.tools.doc_parser import Record
 from qwen_agent.tools.search_tools.base_search import BaseSearch
+from qwen_agent.tools.search_tools.embedding_store import EmbeddingStore, get_embedding, get_embedding_store
+from qwen_agent.utils.utils import hash_sha256
+
+DEFAULT_MAX_CACHED_INDEXES = 16
 
 
 @register_tool('vector_search')
 class VectorSearch(BaseSearch):
     # TODO: Optimize the accuracy of the embedding retriever.
 
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        # The embedding backend is pluggable, such as:
+        #   {'embedding_type': 'sentence_transformer', 'model': 'qwen_agent/agents/resource/acge_text_embedding'}
+        self.embedding_cfg = self.cfg.get('embedding', {'embedding_type': 'dashscope', 'model': 'text-embedding-v1'})
+        self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
+        self.vector_dtype = self.cfg.get('vector_dtype', 'float32')
+        self.max_cached_indexes = self.cfg.get('max_cached_indexes', DEFAULT_MAX_CACHED_INDEXES)
+
+        self._store: Optional[EmbeddingStore] = None
+        self._store_lock = threading.Lock()
+        self._indexes = OrderedDict()  # The LRU cache of the search indexes, keyed by the doc set
+        self._indexes_lock = threading.Lock()
+
+    @property
+    def store(self) -> EmbeddingStore:
+        # The embedding backend is initialized on the first search
+        with self._store_lock:
+            if self._store is None:
+                self._store = get_embedding_store(root=self.data_root,
+                                                  embedding=get_embedding(self.embedding_cfg),
+                                                  dtype=self.vector_dtype)
+            return self._store
+
     def sort_by_scores(self, query: str, docs: List[Record], **kwargs) -> List[Tuple[str, int, float]]:
-        # TODO: More types of embedding can be configured
-        try:
-            from langchain.schema import Document
-        except ModuleNotFoundError:
-            raise ModuleNotFoundError('Please install langchain by: `pip install langchain`')
-        try:
-            from langchain_community.embeddings import DashScopeEmbeddings
-            from langchain_community.vectorstores import FAISS
-        except ModuleNotFoundError:
-            raise ModuleNotFoundError(
-                'Please install langchain_community by: `pip install langchain_community`, '
-                'and install faiss by: `pip install faiss-cpu` or `pip install faiss-gpu` (for CUDA supported GPU)')
         # Extract raw query
         try:
             query_json = json.loads(query)
@@ -37,11 +58,49 @@ class VectorSearch(BaseSearch):
         all_chunks = []
         for doc in docs:
             for chk in doc.raw:
-                all_chunks.append(Document(page_content=chk.content[:2000], metadata=chk.metadata))
+                all_chunks.append(chk)
+        if not all_chunks:
+            return []
+
+        index = self._get_index([chk.content[:2000] for chk in all_chunks])
+        query_embedding = self.store.get_query_embedding(query).reshape(1, -1)
+        distances, chunk_ids = _search_l2(index, query_embedding, k=len(all_chunks))
+
+        return [(all_chunks[i].metadata['source'], all_chunks[i].metadata['chunk_id'], float(score))
+                for i, score in zip(chunk_ids, distances)]
+
+    def _get_index(self, texts: List[str]):
+        index_key = hash_sha256(json.dumps(texts, ensure_ascii=False))
+        with self._indexes_lock:
+            if index_key in self._indexes:
+                self._indexes.move_to_end(index_key)
+                return self._indexes[index_key]
+
+        index = _build_l2_index(self.store.get_embeddings(texts))
+
+        with self._indexes_lock:
+            self._indexes[index_key] = index
+            while len(self._indexes) > self.max_cached_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+
+def _build_l2_index(vectors: np.ndarray):
+    try:
+        import faiss
+    except ModuleNotFoundError:
+        # Brute-force search with NumPy
+        return vectors
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    return index
 
-        embeddings = DashScopeEmbeddings(model='text-embedding-v1',
-                                         dashscope_api_key=os.getenv('DASHSCOPE_API_KEY', ''))
-        db = FAISS.from_documents(all_chunks, embeddings)
-        chunk_and_score = db.similarity_search_with_score(query, k=len(all_chunks))
 
-        return [(chk.metadata['source'], chk.metadata['chunk_id'], score) for chk, score in chunk_and_score]
+def _search_l2(index, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the squared L2 distances and ids of the top-k nearest vectors, sorted by distance."""
+    if isinstance(index, np.ndarray):
+        distances = ((index - query)**2).sum(axis=1)
+        chunk_ids = np.argsort(distances, kind='stable')[:k]
+        return distances[chunk_ids], chunk_ids
+    distances, chunk_ids = index.search(query, k)
+    return distances[0], chunk_ids[0]
@@ -1,21 +1,26 @@
 import json
+import math
+import multiprocessing
 import os
 import re
+import shutil
+import threading
 import time
 import urllib.parse
 from collections import Counter
-from typing import Dict, List, Optional, Union
-
-import json5
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from qwen_agent.log import logger
-from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.settings import DEFAULT_STORAGE_BACKEND, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
+from qwen_agent.tools.cache_manager import get_cache_manager
 from qwen_agent.tools.storage import KeyNotExistsError, Storage
 from qwen_agent.utils.str_processing import rm_cid, rm_continuous_placeholders, rm_hexadecimal
-from qwen_agent.utils.tokenization_qwen import count_tokens
-from qwen_agent.utils.utils import (get_file_type, hash_sha256, is_http_url, read_text_from_file,
-                                    sanitize_chrome_file_path, save_url_to_local_work_dir)
+from qwen_agent.utils.tokenization_qwen import tokenizer
+from qwen_agent.utils.utils import (get_file_type, get_local_file_fingerprint, get_url_fingerprint, hash_sha256,
+                                    is_http_url, read_text_from_file, sanitize_chrome_file_path,
+                                    save_url_to_local_work_dir)
 
 
 def clean_paragraph(text):
@@ -26,6 +31,12 @@ def clean_paragraph(text):
 
 
 PARAGRAPH_SPLIT_SYMBOL = '\n'
+MIN_PDF_PAGES_PER_WORKER = 8  # Parse a pdf in parallel only if each worker gets enough pages
+DEFAULT_REVALIDATE_INTERVAL = 3600  # Seconds between two checks of whether an online doc has changed
+
+# The pools of the page-parallel pdf parsing, keyed by the number of processes
+_PDF_EXECUTORS_LOCK = threading.Lock()
+_PDF_EXECUTORS: Dict[int, ProcessPoolExecutor] = {}
 
 
 def parse_word(docx_path: str, extract_image: bool = False):
@@ -132,54 +143,130 @@ def parse_html_bs(path: str, extract_image: bool = False):
     return [{'page_num': 1, 'content': content, 'title': title}]
 
 
-def parse_pdf(pdf_path: str, extract_image: bool = False) -> List[dict]:
+def parse_pdf(pdf_path: str, extract_image: bool = False, max_workers: int = 1) -> List[dict]:
+    """Parse a pdf, splitting the pages across a process pool if max_workers > 1.
+
+    The pool starts the processes by spawn, which imports the main module again, so a script calling this with
+    max_workers > 1 must be guarded by `if __name__ == '__main__':`, otherwise the pool is broken.
+    """
+    return list(iter_parse_pdf(pdf_path, extract_image, max_workers=max_workers))
+
+
+def iter_parse_pdf(pdf_path: str, extract_image: bool = False, max_workers: int = 1) -> Iterator[dict]:
+    """Parse a pdf and yield the pages in page order, as soon as they are parsed.
+
+    The pages are parsed serially if there is only one CPU or too few pages for each process.
+    """
+    max_workers = min(max_workers, os.cpu_count() or 1)
+    num_pages = get_pdf_page_count(pdf_path) if max_workers > 1 else 0
+    if num_pages < max_workers * MIN_PDF_PAGES_PER_WORKER:
+        yield from iter_parse_pdf_pages(pdf_path, extract_image)
+        return
+    yield from _iter_parse_pdf_in_pool(pdf_path, extract_image, num_pages=num_pages, max_workers=max_workers)
+
+
+def _iter_parse_pdf_in_pool(pdf_path: str, extract_image: bool, num_pages: int, max_workers: int) -> Iterator[dict]:
+    # Submit contiguous page ranges, and yield the results in page order
+    range_size = math.ceil(num_pages / max_workers)
+    executor = _get_pdf_executor(max_workers)
+    futures = [
+        executor.submit(parse_pdf_pages, pdf_path, extract_image, list(range(start, min(start + range_size,
+                                                                                        num_pages))))
+        for start in range(0, num_pages, range_size)
+    ]
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def parse_pdf_pages(pdf_path: str, extract_image: bool = False, page_indexes: Optional[List[int]] = None) -> List[dict]:
+    """Parse the pages of a pdf, or all pages if page_indexes is None."""
+    return list(iter_parse_pdf_pages(pdf_path, extract_image, page_indexes))
+
+
+def iter_parse_pdf_pages(pdf_path: str,
+                         extract_image: bool = False,
+                         page_indexes: Optional[List[int]] = None) -> Iterator[dict]:
+    """Parse the pages of a pdf one by one, or all pages if page_indexes is None.
+
+    Only the layout of the current page is kept in memory. The pdf is opened at most once by pdfplumber for
+    extracting the tables of these pages.
+    """
     # Todo: header and footer
     from pdfminer.high_level import extract_pages
     from pdfminer.layout import LTImage, LTRect, LTTextContainer
 
-    doc = []
-    for i, page_layout in enumerate(extract_pages(pdf_path)):
-        page = {'page_num': page_layout.pageid, 'content': []}
-
-        elements = []
-        for element in page_layout:
-            elements.append(element)
-
-        # Init params for table
-        table_num = 0
-        tables = []
-
-        for element in elements:
-            if isinstance(element, LTRect):
-                if not tables:
-                    tables = extract_tables(pdf_path, i)
-                if table_num < len(tables):
-                    table_string = table_converter(tables[table_num])
-                    table_num += 1
-                    if table_string:
-                        page['content'].append({'table': table_string, 'obj': element})
-            elif isinstance(element, LTTextContainer):
-                # Delete line breaks in the same paragraph
-                text = element.get_text()
-                # Todo: Further analysis using font
-                font = get_font(element)
-                if text.strip():
-                    new_content_item = {'text': text, 'obj': element}
-                    if font:
-                        new_content_item['font-size'] = round(font[1])
-                        # new_content_item['font-name'] = font[0]
-                    page['content'].append(new_content_item)
-            elif extract_image and isinstance(element, LTImage):
-                # Todo: ocr
-                raise ValueError('Currently, extracting images is not supported!')
-            else:
-                pass
+    table_pdf = None
+    try:
+        for i, page_layout in enumerate(extract_pages(pdf_path, page_numbers=page_indexes)):
+            page_index = page_indexes[i] if page_indexes is not None else i
+            # The pageid of pdfminer counts from 1 among the extracted pages
+            page = {'page_num': page_index + 1, 'content': []}
+
+            elements = []
+            for element in page_layout:
+                elements.append(element)
+
+            # Init params for table
+            table_num = 0
+            tables = None
+
+            for element in elements:
+                if isinstance(element, LTRect):
+                    if tables is None:
+                        if table_pdf is None:
+                            import pdfplumber
+                            table_pdf = pdfplumber.open(pdf_path)
+                        tables = extract_tables_from_page(table_pdf, page_index)
+                    if table_num < len(tables):
+                        table_string = table_converter(tables[table_num])
+                        table_num += 1
+                        if table_string:
+                            page['content'].append({'table': table_string, 'obj': element})
+                elif isinstance(element, LTTextContainer):
+                    # Delete line breaks in the same paragraph
+                    text = element.get_text()
+                    # Todo: Further analysis using font
+                    font = get_font(element)
+                    if text.strip():
+                        new_content_item = {'text': text, 'obj': element}
+                        if font:
+                            new_content_item['font-size'] = round(font[1])
+                            # new_content_item['font-name'] = font[0]
+                        page['content'].append(new_content_item)
+                elif extract_image and isinstance(element, LTImage):
+                    # Todo: ocr
+                    raise ValueError('Currently, extracting images is not supported!')
+                else:
+                    pass
 
-        # merge elements
-        page['content'] = postprocess_page_content(page['content'])
-        doc.append(page)
+            # merge elements
+            page['content'] = postprocess_page_content(page['content'])
+            yield page
+    finally:
+        if table_pdf is not None:
+            table_pdf.close()
+
+
+def get_pdf_page_count(pdf_path: str) -> int:
+    from pdfminer.pdfpage import PDFPage
+    with open(pdf_path, 'rb') as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
 
-    return doc
+
+def _get_pdf_executor(max_workers: int) -> ProcessPoolExecutor:
+    with _PDF_EXECUTORS_LOCK:
+        executor = _PDF_EXECUTORS.get(max_workers)
+        if executor is None or getattr(executor, '_broken', False):
+            if executor is not None:
+                executor.shutdown(wait=False)
+            # Use spawn, because forking a process with running threads is unsafe
+            executor = _PDF_EXECUTORS[max_workers] = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return executor
 
 
 def postprocess_page_content(page_content: list) -> list:
@@ -240,9 +327,14 @@ def get_font(element):
 
 def extract_tables(pdf_path, page_num):
     import pdfplumber
-    pdf = pdfplumber.open(pdf_path)
+    with pdfplumber.open(pdf_path) as pdf:
+        return extract_tables_from_page(pdf, page_num)
+
+
+def extract_tables_from_page(pdf, page_num):
     table_page = pdf.pages[page_num]
     tables = table_page.extract_tables()
+    table_page.close()  # Release the cached objects of this page
     return tables
 
 
@@ -262,6 +354,48 @@ def table_converter(table):
 PARSER_SUPPORTED_FILE_TYPES = ['pdf', 'docx', 'pptx', 'txt', 'html']
 
 
+def parse_file(path: str, f_type: str, extract_image: bool = False, max_workers: int = 1) -> List[dict]:
+    """Parse a local file of a supported type, and count the tokens of each paragraph.
+
+    It is a module level function, so that it can be submitted to a process pool.
+    """
+    return list(iter_parse_file(path, f_type, extract_image, max_workers=max_workers))
+
+
+def iter_parse_file(path: str, f_type: str, extract_image: bool = False, max_workers: int = 1) -> Iterator[dict]:
+    """Same as `parse_file`, but yield the pages as soon as they are parsed.
+
+    Only pdf is parsed page by page, and the other types are yielded after the whole file is parsed.
+    """
+    if f_type == 'pdf':
+        pages = iter_parse_pdf(path, extract_image, max_workers=max_workers)
+    elif f_type == 'docx':
+        pages = parse_word(path, extract_image)
+    elif f_type == 'pptx':
+        pages = parse_ppt(path, extract_image)
+    elif f_type == 'txt':
+        pages = parse_txt(path)
+    elif f_type == 'html':
+        pages = parse_html_bs(path, extract_image)
+    else:
+        raise ValueError(
+            f'Failed: The current parser does not support this file type! Supported types: {"/".join(PARSER_SUPPORTED_FILE_TYPES)}'
+        )
+    for page in pages:
+        # Todo: More attribute types
+        paras = [para.get('text', para.get('table')) for para in page['content']]
+        for para, token_ids in zip(page['content'], tokenizer.encode_batch(paras)):
+            para['token'] = len(token_ids)
+        yield page
+
+
+def _same_fingerprint(fingerprint: dict, old_fingerprint: dict) -> bool:
+    keys = [k for k in fingerprint if k != 'checked_at']
+    if not any(fingerprint.get(k) for k in keys):
+        return True  # The server provides neither ETag nor Last-Modified, so a change can not be told
+    return all(fingerprint.get(k) == old_fingerprint.get(k) for k in keys)
+
+
 def get_plain_doc(doc: list):
     paras = []
     for page in doc:
@@ -287,12 +421,28 @@ class SimpleDocParser(BaseTool):
         self.data_root = self.cfg.get('path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
         self.extract_image = self.cfg.get('extract_image', False)
         self.structured_doc = self.cfg.get('structured_doc', False)
-
-        self.db = Storage({'storage_root_path': self.data_root})
-
-    def call(self, params: Union[str, dict], **kwargs) -> Union[str, list]:
+        # The number of processes for parsing the pages of one pdf in parallel. The processes are spawned, so the
+        # main module of the caller must be guarded by `if __name__ == '__main__':` if it is greater than 1.
+        self.max_workers = self.cfg.get('max_workers', 1)
+        self.keep_downloads = self.cfg.get('keep_downloads', False)
+        self.revalidate_interval = self.cfg.get('revalidate_interval', DEFAULT_REVALIDATE_INTERVAL)
+
+        self.db = get_cache_manager(
+            Storage({
+                'storage_root_path': self.data_root,
+                'storage_backend': self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+            }), self.cfg.get('cache_cfg'))
+
+    def call(self,
+             params: Union[str, dict],
+             parse_executor: Optional[Executor] = None,
+             **kwargs) -> Union[str, list]:
         """Parse pdf by url, and return the formatted content.
 
+        Args:
+            params: The url of the doc.
+            parse_executor: If provided, the parsing of the downloaded file is run in this executor.
+
         Returns:
             Extracted doc as plain text or the following list format:
               [
@@ -315,53 +465,138 @@ class SimpleDocParser(BaseTool):
         cached_name_ori = f'{hash_sha256(path)}_ori'
         try:
             # Directly load the parsed doc
-            parsed_file = json5.loads(self.db.get(cached_name_ori))
+            parsed_file = json.loads(self.db.get(cached_name_ori))
+            if not self.check_cache(path):
+                raise KeyNotExistsError(f'{cached_name_ori} is stale')
             logger.info(f'Read parsed {path} from cache.')
         except KeyNotExistsError:
             logger.info(f'Start parsing {path}...')
             time1 = time.time()
 
-            f_type = get_file_type(path)
-            if f_type in PARSER_SUPPORTED_FILE_TYPES:
-                if path.startswith('https://') or path.startswith('http://') or re.match(
-                        r'^[A-Za-z]:\\', path) or re.match(r'^[A-Za-z]:/', path):
-                    path = path
+            url = path
+            fingerprint = self._get_fingerprint(url)
+            try:
+                path, f_type = self._get_local_file(path)
+                if parse_executor is None:
+                    parsed_file = parse_file(path, f_type, self.extract_image, max_workers=self.max_workers)
                 else:
-                    parsed_url = urllib.parse.urlparse(path)
-                    path = urllib.parse.unquote(parsed_url.path)
-                    path = sanitize_chrome_file_path(path)
-
-            os.makedirs(self.data_root, exist_ok=True)
-            if is_http_url(path):
-                # download online url
-                tmp_file_root = os.path.join(self.data_root, hash_sha256(path))
-                os.makedirs(tmp_file_root, exist_ok=True)
-                path = save_url_to_local_work_dir(path, tmp_file_root)
-
-            if f_type == 'pdf':
-                parsed_file = parse_pdf(path, self.extract_image)
-            elif f_type == 'docx':
-                parsed_file = parse_word(path, self.extract_image)
-            elif f_type == 'pptx':
-                parsed_file = parse_ppt(path, self.extract_image)
-            elif f_type == 'txt':
-                parsed_file = parse_txt(path)
-            elif f_type == 'html':
-                parsed_file = parse_html_bs(path, self.extract_image)
-            else:
-                raise ValueError(
-                    f'Failed: The current parser does not support this file type! Supported types: {"/".join(PARSER_SUPPORTED_FILE_TYPES)}'
-                )
-            for page in parsed_file:
-                for para in page['content']:
-                    # Todo: More attribute types
-                    para['token'] = count_tokens(para.get('text', para.get('table')))
+                    # Run the CPU-bound parsing in the given executor, such as a process pool.
+                    # Do not split the pages again inside the executor.
+                    try:
+                        parsed_file = parse_executor.submit(parse_file, path, f_type, self.extract_image).result()
+                    except BrokenExecutor:
+                        logger.warning(f'The parse executor is broken. Parse {path} in the current process.')
+                        parsed_file = parse_file(path, f_type, self.extract_image)
+            finally:
+                self._remove_download(url)
             time2 = time.time()
             logger.info(f'Finished parsing {path}. Time spent: {time2 - time1} seconds.')
             # Cache the parsing doc
             self.db.put(cached_name_ori, json.dumps(parsed_file, ensure_ascii=False, indent=2))
+            self._put_fingerprint(url, fingerprint)
 
         if not self.structured_doc:
             return get_plain_doc(parsed_file)
         else:
             return parsed_file
+
+    def iter_call(self, params: Union[str, dict], **kwargs) -> Iterator[dict]:
+        """Parse the doc by url, and yield the structured pages (see `call`) as soon as they are parsed.
+
+        The parsed doc is cached after the last page, and an interrupted parsing is not cached.
+        """
+        params = self._verify_json_format_args(params)
+        path = params['url']
+        cached_name_ori = f'{hash_sha256(path)}_ori'
+        try:
+            parsed_file = json.loads(self.db.get(cached_name_ori))
+            if self.check_cache(path):
+                logger.info(f'Read parsed {path} from cache.')
+                yield from parsed_file
+                return
+        except KeyNotExistsError:
+            pass
+
+        logger.info(f'Start parsing {path} page by page...')
+        time1 = time.time()
+        fingerprint = self._get_fingerprint(path)
+        # Only keep the serialized pages for the cache, instead of the parsed objects
+        serialized_pages = []
+        try:
+            local_path, f_type = self._get_local_file(path)
+            for page in iter_parse_file(local_path, f_type, self.extract_image, max_workers=self.max_workers):
+                serialized_pages.append(json.dumps(page, ensure_ascii=False))
+                yield page
+        finally:
+            self._remove_download(path)
+        time2 = time.time()
+        logger.info(f'Finished parsing {path}. Time spent: {time2 - time1} seconds.')
+        self.db.put(cached_name_ori, '[' + ','.join(serialized_pages) + ']')
+        self._put_fingerprint(path, fingerprint)
+
+    def check_cache(self, url: str) -> bool:
+        """Check if the doc has not changed since it was parsed, and delete the stale parsed doc if it has changed.
+
+        A local file is checked by its mtime and size, and an online file is checked by a conditional GET at most
+        once every `revalidate_interval` seconds. If the doc can not be checked, such as a deleted local file or a
+        network error, the cached doc is regarded as fresh.
+        """
+        cached_name_fingerprint = f'{hash_sha256(url)}_fingerprint'
+        try:
+            old_fingerprint = json.loads(self.db.get(cached_name_fingerprint))
+        except KeyNotExistsError:
+            old_fingerprint = None
+        if is_http_url(url) and old_fingerprint and time.time() - old_fingerprint.get('checked_at',
+                                                                                      0) < self.revalidate_interval:
+            return True
+
+        fingerprint = self._get_fingerprint(url, old_fingerprint)
+        if fingerprint is None or old_fingerprint is None or _same_fingerprint(fingerprint, old_fingerprint):
+            # Also record the fingerprint of the docs parsed before the fingerprints were introduced
+            self._put_fingerprint(url, fingerprint or old_fingerprint)
+            return True
+
+        logger.info(f'{url} has changed since it was parsed.')
+        self.db.delete(f'{hash_sha256(url)}_ori')
+        self.db.delete(cached_name_fingerprint)
+        return False
+
+    def _get_fingerprint(self, url: str, old_fingerprint: Optional[dict] = None) -> Optional[dict]:
+        if is_http_url(url):
+            return get_url_fingerprint(url, old_fingerprint)
+        return get_local_file_fingerprint(self._get_path(url))
+
+    def _put_fingerprint(self, url: str, fingerprint: Optional[dict]):
+        if fingerprint is None and not is_http_url(url):
+            return
+        # The time of the last check is recorded even if it fails, so that an unreachable url is not checked again
+        # until the next revalidation
+        self.db.put(f'{hash_sha256(url)}_fingerprint', json.dumps({**(fingerprint or {}), 'checked_at': time.time()}))
+
+    def _get_local_file(self, path: str) -> Tuple[str, str]:
+        """Get the local path and the file type of the doc, downloading it if it is an online url."""
+        f_type = get_file_type(path)
+        if f_type in PARSER_SUPPORTED_FILE_TYPES:
+            path = self._get_path(path)
+
+        os.makedirs(self.data_root, exist_ok=True)
+        if is_http_url(path):
+            # download online url
+            tmp_file_root = os.path.join(self.data_root, hash_sha256(path))
+            os.makedirs(tmp_file_root, exist_ok=True)
+            path = save_url_to_local_work_dir(path, tmp_file_root)
+        return path, f_type
+
+    @staticmethod
+    def _get_path(path: str) -> str:
+        if path.startswith('https://') or path.startswith('http://') or re.match(
+                r'^[A-Za-z]:\\', path) or re.match(r'^[A-Za-z]:/', path):
+            return path
+        parsed_url = urllib.parse.urlparse(path)
+        path = urllib.parse.unquote(parsed_url.path)
+        return sanitize_chrome_file_path(path)
+
+    def _remove_download(self, url: str):
+        # The url is downloaded again on every parsing, so the copy is useless once the parsed doc is cached
+        if is_http_url(url) and not self.keep_downloads:
+            shutil.rmtree(os.path.join(self.data_root, hash_sha256(url)), ignore_errors=True)
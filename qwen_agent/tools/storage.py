@@ -1,15 +1,257 @@
 import os
-from typing import Dict, Optional, Union
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-from qwen_agent.settings import DEFAULT_WORKSPACE
+from qwen_agent.settings import DEFAULT_STORAGE_BACKEND, DEFAULT_WORKSPACE
 from qwen_agent.tools.base import BaseTool, register_tool
-from qwen_agent.utils.utils import read_text_from_file, save_text_to_file
+from qwen_agent.utils.utils import read_text_from_file
+
+STORAGE_BACKEND_REGISTRY = {}
 
 
 class KeyNotExistsError(ValueError):
     pass
 
 
+def register_storage_backend(backend_type):
+
+    def decorator(cls):
+        STORAGE_BACKEND_REGISTRY[backend_type] = cls
+        return cls
+
+    return decorator
+
+
+class BaseStorageBackend(ABC):
+    """A key-value store of strings under a root directory, where the keys are like relative file paths."""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @abstractmethod
+    def put(self, key: str, value: str):
+        """Atomically save the value, so that a reader never sees a partially written value."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, key: str) -> str:
+        """Get the value, and raise KeyNotExistsError if the key does not exist."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str) -> bool:
+        """Delete the key, and return False if it does not exist."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_keys(self, prefix: str = '') -> List[str]:
+        """List the keys starting with the prefix in lexicographic order, without reading the values."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_entries(self, prefix: str = '') -> List[Tuple[str, int, float]]:
+        """List (key, size in bytes, last access time) of the keys starting with the prefix, without the values."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def touch(self, key: str):
+        """Update the last access time of the key."""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.get(key)
+        except KeyNotExistsError:
+            return False
+        return True
+
+    def scan(self, prefix: str = '') -> Iterator[Tuple[str, str]]:
+        """Iterate the key-value pairs of the keys starting with the prefix."""
+        for key in self.list_keys(prefix):
+            try:
+                yield key, self.get(key)
+            except KeyNotExistsError:
+                continue  # Deleted by another process after listing
+
+
+@register_storage_backend('file')
+class FileStorageBackend(BaseStorageBackend):
+    """One file for one key value pair."""
+
+    def put(self, key: str, value: str):
+        path = os.path.join(self.root, key)
+        path_dir = os.path.dirname(path)
+        if path_dir:
+            os.makedirs(path_dir, exist_ok=True)
+
+        # Write to a temporary file in the same directory and rename it, which is atomic on the same filesystem
+        fd, tmp_path = tempfile.mkstemp(dir=path_dir or None, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, key: str) -> str:
+        path = os.path.join(self.root, key)
+        if not os.path.isfile(path):
+            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
+        try:
+            return read_text_from_file(path)
+        except FileNotFoundError:
+            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(os.path.join(self.root, key))
+        except (FileNotFoundError, IsADirectoryError):
+            return False
+        return True
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(os.path.join(self.root, key))
+
+    def list_keys(self, prefix: str = '') -> List[str]:
+        return sorted(self._walk(prefix))
+
+    def list_entries(self, prefix: str = '') -> List[Tuple[str, int, float]]:
+        # The modification time is used as the last access time, because atime is not updated on most mounts
+        entries = []
+        for key in self._walk(prefix):
+            try:
+                stat = os.stat(os.path.join(self.root, key))
+            except FileNotFoundError:
+                continue
+            entries.append((key, stat.st_size, stat.st_mtime))
+        return sorted(entries)
+
+    def touch(self, key: str):
+        try:
+            os.utime(os.path.join(self.root, key))
+        except FileNotFoundError:
+            pass
+
+    def _walk(self, prefix: str) -> Iterator[str]:
+        # Only walk the deepest directory covering the prefix
+        prefix_dir = prefix[:prefix.rfind('/') + 1]
+        start = os.path.join(self.root, prefix_dir)
+        for root, dirs, files in os.walk(start):
+            rel_root = os.path.relpath(root, self.root).replace(os.sep, '/')
+            rel_root = '' if rel_root == '.' else f'{rel_root}/'
+            for file in files:
+                key = rel_root + file
+                if key.startswith(prefix) and not file.startswith('.tmp_'):
+                    yield key
+
+
+@register_storage_backend('sqlite')
+class SQLiteStorageBackend(BaseStorageBackend):
+    """All key value pairs in one SQLite database in WAL mode.
+
+    Each thread of each process uses its own connection, so it is safe to be shared by threads and by the
+    processes of a server. The readers are not blocked by a writer in WAL mode, and the writers wait for each other
+    up to `busy_timeout` seconds.
+    """
+
+    def __init__(self, root: str, busy_timeout: float = 30.0):
+        super().__init__(root)
+        self.db_path = os.path.join(self.root, 'storage.sqlite3')
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._connect()
+        # In one write transaction, so that the processes opening the same database do not migrate it twice
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT NOT NULL UNIQUE, value TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, atime REAL NOT NULL)')
+            self._migrate(conn)
+            # Covers the queries of the cache manager, which then do not read the values
+            conn.execute('CREATE INDEX IF NOT EXISTS kv_entries ON kv (key, size, atime)')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        # The databases created before the cache manager have no size or access time of the values
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(kv)')}
+        if 'size' not in columns:
+            conn.execute('ALTER TABLE kv ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+            conn.execute('UPDATE kv SET size = length(CAST(value AS BLOB))')
+        if 'atime' not in columns:
+            conn.execute('ALTER TABLE kv ADD COLUMN atime REAL NOT NULL DEFAULT 0')
+            conn.execute('UPDATE kv SET atime = ?', (time.time(),))
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection can not be used across fork, so reconnect in a new process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, key: str, value: str):
+        self._connect().execute(
+            'INSERT INTO kv (key, value, size, atime) VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET '
+            'value = excluded.value, size = excluded.size, atime = excluded.atime',
+            (key, value, len(value.encode('utf-8')), time.time()))
+
+    def get(self, key: str) -> str:
+        row = self._connect().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
+        return row[0]
+
+    def delete(self, key: str) -> bool:
+        return self._connect().execute('DELETE FROM kv WHERE key = ?', (key,)).rowcount > 0
+
+    def exists(self, key: str) -> bool:
+        return self._connect().execute('SELECT 1 FROM kv WHERE key = ?', (key,)).fetchone() is not None
+
+    def list_keys(self, prefix: str = '') -> List[str]:
+        # A range query on the unique index of the keys, which does not read the values
+        sql, args = self._prefix_condition(prefix)
+        return [row[0] for row in self._connect().execute(f'SELECT key FROM kv {sql} ORDER BY key', args)]
+
+    def list_entries(self, prefix: str = '') -> List[Tuple[str, int, float]]:
+        sql, args = self._prefix_condition(prefix)
+        return self._connect().execute(f'SELECT key, size, atime FROM kv {sql} ORDER BY key', args).fetchall()
+
+    def touch(self, key: str):
+        self._connect().execute('UPDATE kv SET atime = ? WHERE key = ?', (time.time(), key))
+
+    def scan(self, prefix: str = '') -> Iterator[Tuple[str, str]]:
+        sql, args = self._prefix_condition(prefix)
+        rows = self._connect().execute(f'SELECT key, value FROM kv {sql} ORDER BY key', args).fetchall()
+        yield from rows
+
+    @staticmethod
+    def _prefix_condition(prefix: str) -> Tuple[str, tuple]:
+        if not prefix:
+            return '', ()
+        # The smallest string greater than all strings starting with the prefix
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return 'WHERE key >= ? AND key < ?', (prefix, upper)
+
+
+def get_storage_backend(backend_type: str, root: str) -> BaseStorageBackend:
+    if backend_type not in STORAGE_BACKEND_REGISTRY:
+        raise ValueError(f'Please set storage_backend from {str(STORAGE_BACKEND_REGISTRY.keys())}')
+    return STORAGE_BACKEND_REGISTRY[backend_type](root)
+
+
 @register_tool('storage')
 class Storage(BaseTool):
     """
@@ -35,7 +277,11 @@ class Storage(BaseTool):
     def __init__(self, cfg: Optional[Dict] = None):
         super().__init__(cfg)
         self.root = self.cfg.get('storage_root_path', os.path.join(DEFAULT_WORKSPACE, 'tools', self.name))
-        os.makedirs(self.root, exist_ok=True)
+        self.backend_type = self.cfg.get('storage_backend', DEFAULT_STORAGE_BACKEND)
+        self.backend = get_storage_backend(self.backend_type, self.root)
+        # The backends of the other paths are created once, so that the sqlite connections are reused
+        self._backends: Dict[Tuple[str, str], BaseStorageBackend] = {(self.backend_type, self.root): self.backend}
+        self._backends_lock = threading.Lock()
 
     def call(self, params: Union[str, dict], **kwargs) -> str:
         params = self._verify_json_format_args(params)
@@ -54,49 +300,42 @@ class Storage(BaseTool):
         else:
             return self.scan(key)
 
-    def put(self, key: str, value: str, path: Optional[str] = None) -> str:
-        path = path or self.root
+    def _get_backend(self, path: Optional[str] = None) -> BaseStorageBackend:
+        if path is None or path == self.root:
+            return self.backend
+        with self._backends_lock:
+            if (self.backend_type, path) not in self._backends:
+                self._backends[(self.backend_type, path)] = get_storage_backend(self.backend_type, path)
+            return self._backends[(self.backend_type, path)]
 
-        # one file for one key value pair
-        path = os.path.join(path, key)
-
-        path_dir = path[:path.rfind('/') + 1]
-        if path_dir:
-            os.makedirs(path_dir, exist_ok=True)
-
-        save_text_to_file(path, value)
+    def put(self, key: str, value: str, path: Optional[str] = None) -> str:
+        self._get_backend(path).put(key, value)
         return f'Successfully saved {key}.'
 
     def get(self, key: str, path: Optional[str] = None) -> str:
-        path = path or self.root
-        if not os.path.exists(os.path.join(path, key)):
-            raise KeyNotExistsError(f'Get Failed: {key} does not exist')
-        return read_text_from_file(os.path.join(path, key))
+        return self._get_backend(path).get(key)
 
     def delete(self, key, path: Optional[str] = None) -> str:
-        path = path or self.root
-        path = os.path.join(path, key)
-        if os.path.exists(path):
-            os.remove(path)
+        if self._get_backend(path).delete(key):
             return f'Successfully deleted {key}'
         else:
             return f'Delete Failed: {key} does not exist'
 
+    def list_keys(self, prefix: str = '', path: Optional[str] = None) -> List[str]:
+        """List the keys starting with the prefix, without reading the values."""
+        return self._get_backend(path).list_keys(prefix)
+
     def scan(self, key: str, path: Optional[str] = None) -> str:
-        path = path or self.root
-        path = os.path.join(path, key)
-        if os.path.exists(path):
-            if not os.path.isdir(path):
-                return 'Scan Failed: The scan operation requires passing in a folder path as the key.'
-            # All key-value pairs
-            kvs = {}
-            for root, dirs, files in os.walk(path):
-                for file in files:
-                    k = os.path.join(root, file)[len(path):]
-                    if not k.startswith('/'):
-                        k = '/' + k
-                    v = read_text_from_file(os.path.join(root, file))
-                    kvs[k] = v
+        backend = self._get_backend(path)
+        folder = key.rstrip('/')
+        prefix = f'{folder}/' if folder else ''
+        # All key-value pairs
+        kvs = {f'/{k[len(prefix):]}': v for k, v in backend.scan(prefix)}
+        if kvs:
             return '\n'.join([f'{k}: {v}' for k, v in kvs.items()])
+        elif folder and backend.exists(folder):
+            return 'Scan Failed: The scan operation requires passing in a folder path as the key.'
+        elif not folder or os.path.isdir(os.path.join(backend.root, folder)):
+            return ''  # An empty folder
         else:
             return f'Scan Failed: {key} does not exist.'
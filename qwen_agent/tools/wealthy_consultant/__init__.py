@@ -1,9 +1,13 @@
-from .get_product_info import GetProductInfo
-from .faq import GetFAQ
-from .recommend import Recommend
+from qwen_agent.utils.utils import lazy_module_attrs
+
+__getattr__, __dir__ = lazy_module_attrs(__name__, {
+    'GetFAQ': '.faq',
+    'GetProductInfo': '.get_product_info',
+    'Recommend': '.recommend',
+})
 
 __all__ = [
     'GetProductInfo',
     'GetFAQ',
     'Recommend'
-]
\ No newline at end of file
+]
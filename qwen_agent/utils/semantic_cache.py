@@ -0,0 +1,186 @@
+import copy
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from qwen_agent.llm.schema import Message
+from qwen_agent.log import logger
+from qwen_agent.tools.search_tools.embedding_store import BaseEmbedding, get_embedding
+from qwen_agent.utils.utils import hash_sha256
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.92  # The minimum cosine similarity of two questions to share the answer
+DEFAULT_MAX_ENTRIES = 1000
+MAX_RECENT_VECTORS = 64  # The vectors of the recent lookups, which are reused when the answers are added
+
+TRAILING_PUNCTUATION_RE = re.compile(r'[\s?？!！.。,，~～]+$')
+
+
+def normalize_query(query: str) -> str:
+    """Normalize the full-width characters, the case, the spaces and the trailing punctuation of a question."""
+    query = unicodedata.normalize('NFKC', query).lower()
+    query = ' '.join(query.split())
+    return TRAILING_PUNCTUATION_RE.sub('', query)
+
+
+class _Partition:
+    """The vectors of the questions with the same context, searched by inner product."""
+
+    def __init__(self, dim: int):
+        try:
+            import faiss
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        except ModuleNotFoundError:
+            # Brute-force search with NumPy
+            self.index = None
+            self.vectors = np.zeros((0, dim), dtype=np.float32)
+            self.ids = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.ids) if self.index is None else self.index.ntotal
+
+    def add(self, entry_id: int, vector: np.ndarray):
+        if self.index is None:
+            self.vectors = np.vstack([self.vectors, vector.reshape(1, -1)])
+            self.ids = np.append(self.ids, entry_id)
+        else:
+            self.index.add_with_ids(vector.reshape(1, -1), np.asarray([entry_id], dtype=np.int64))
+
+    def remove(self, entry_id: int):
+        if self.index is None:
+            keep = (self.ids != entry_id)
+            self.vectors, self.ids = self.vectors[keep], self.ids[keep]
+        else:
+            self.index.remove_ids(np.asarray([entry_id], dtype=np.int64))
+
+    def search(self, vector: np.ndarray) -> Tuple[float, int]:
+        """Return the score and the id of the most similar vector."""
+        if not len(self):
+            return float('-inf'), -1
+        if self.index is None:
+            scores = self.vectors @ vector
+            i = int(np.argmax(scores))
+            return float(scores[i]), int(self.ids[i])
+        scores, ids = self.index.search(vector.reshape(1, -1), 1)
+        return float(scores[0][0]), int(ids[0][0])
+
+
+class SemanticCache:
+    """A cache of the final responses of an agent, looked up by the similarity of the user questions.
+
+    The normalized last user question is embedded and searched among the past questions with the same context
+    fingerprint, e.g., the same agent, system message and files. If the cosine similarity is above the threshold,
+    the stored response is returned. The least recently hit entries are evicted beyond `max_entries`.
+    """
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        """Initialize the cache.
+
+        Args:
+            cfg: The config of the cache, such as:
+              {
+                'embedding': {'embedding_type': 'sentence_transformer',
+                              'model': 'qwen_agent/agents/resource/acge_text_embedding'},
+                'threshold': 0.92,
+                'max_entries': 1000,
+                'ttl': 24 * 3600,
+              }
+              where the embedding is an embedding config or object, see tools/search_tools/embedding_store.py.
+        """
+        cfg = cfg or {}
+        self.embedding: BaseEmbedding = get_embedding(cfg.get('embedding'))
+        self.threshold: float = cfg.get('threshold', DEFAULT_SIMILARITY_THRESHOLD)
+        self.max_entries: int = cfg.get('max_entries', DEFAULT_MAX_ENTRIES)
+        self.ttl: Optional[float] = cfg.get('ttl')
+
+        self._lock = threading.Lock()
+        # entry id -> (fingerprint, response, creation time), in the order of the last hit
+        self._entries: 'OrderedDict[int, Tuple[str, List[Message], float]]' = OrderedDict()
+        self._partitions: Dict[str, _Partition] = {}
+        self._next_id = 0
+        self._recent_vectors: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, query: str, context: str = '') -> Optional[List[Message]]:
+        """Get the response of the most similar past question with the same context, or None if not found."""
+        query = normalize_query(query)
+        if not query:
+            return None
+        vector = self._embed(query)
+        fingerprint = hash_sha256(context)
+        response = None
+        with self._lock:
+            partition = self._partitions.get(fingerprint)
+            if partition is not None:
+                score, entry_id = partition.search(vector)
+                if score >= self.threshold:
+                    _, response, created = self._entries[entry_id]
+                    if self.ttl and time.time() - created > self.ttl:
+                        self._remove(entry_id)
+                        response = None
+                    else:
+                        self._entries.move_to_end(entry_id)
+            self._counters['misses' if response is None else 'hits'] += 1
+        if response is not None:
+            logger.info(f'Semantic cache hit for the question: {query}')
+            response = copy.deepcopy(response)
+        return response
+
+    def put(self, query: str, response: List[Message], context: str = ''):
+        query = normalize_query(query)
+        if not query or not response:
+            return
+        vector = self._embed(query)
+        fingerprint = hash_sha256(context)
+        with self._lock:
+            partition = self._partitions.get(fingerprint)
+            if partition is None:
+                partition = _Partition(dim=vector.shape[0])
+                self._partitions[fingerprint] = partition
+            entry_id = self._next_id
+            self._next_id += 1
+            partition.add(entry_id, vector)
+            self._entries[entry_id] = (fingerprint, copy.deepcopy(response), time.time())
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def _remove(self, entry_id: int):
+        fingerprint, _, _ = self._entries.pop(entry_id)
+        partition = self._partitions[fingerprint]
+        partition.remove(entry_id)
+        if not len(partition):
+            del self._partitions[fingerprint]
+
+    def _embed(self, query: str) -> np.ndarray:
+        with self._lock:
+            vector = self._recent_vectors.get(query)
+        if vector is None:
+            vector = np.asarray(self.embedding.embed_query(query), dtype=np.float32)
+            # Normalized so that the inner product is the cosine similarity
+            vector = vector / max(float(np.linalg.norm(vector)), 1e-12)
+            with self._lock:
+                self._recent_vectors[query] = vector
+                while len(self._recent_vectors) > MAX_RECENT_VECTORS:
+                    self._recent_vectors.popitem(last=False)
+        return vector
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['misses']
+            return {
+                **self._counters,
+                'hit_rate': (self._counters['hits'] / lookups) if lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+
+def get_semantic_cache(cfg: Optional[Union[Dict, SemanticCache]]) -> Optional[SemanticCache]:
+    if cfg is None or isinstance(cfg, SemanticCache):
+        return cfg
+    return SemanticCache(cfg)
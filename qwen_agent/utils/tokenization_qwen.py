@@ -1,13 +1,20 @@
 """Tokenization classes for QWen."""
 
 import base64
+import functools
+import hashlib
+import marshal
+import os
+import threading
 import unicodedata
+from collections import OrderedDict
 from pathlib import Path
-from typing import Collection, Dict, List, Set, Union
+from typing import Collection, Dict, List, Optional, Set, Union
 
 import tiktoken
 
 from qwen_agent.log import logger
+from qwen_agent.settings import DEFAULT_CACHE_DIR
 
 VOCAB_FILES_NAMES = {'vocab_file': 'qwen.tiktoken'}
 
@@ -30,6 +37,9 @@ SPECIAL_TOKENS = tuple(enumerate(
     start=SPECIAL_START_ID,
 ))
 SPECIAL_TOKENS_SET = set(t for i, t in SPECIAL_TOKENS)
+SPECIAL_TOKEN_PREFIX = '<|'  # A text without it can not contain any special token
+
+TOKEN_COUNT_CACHE_SIZE = 8192  # The number of the token counts memoized by count_tokens_cached
 
 
 def _load_tiktoken_bpe(tiktoken_bpe_file: str) -> Dict[bytes, int]:
@@ -40,6 +50,34 @@ def _load_tiktoken_bpe(tiktoken_bpe_file: str) -> Dict[bytes, int]:
     }
 
 
+def _load_tiktoken_bpe_cached(tiktoken_bpe_file: str) -> Dict[bytes, int]:
+    """Load the decoded vocab from the binary cache in DEFAULT_CACHE_DIR, or decode it and write the cache."""
+    stat = os.stat(tiktoken_bpe_file)
+    key = f'{os.path.abspath(tiktoken_bpe_file)}:{stat.st_size}:{stat.st_mtime_ns}:{marshal.version}'
+    key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    cache_file = os.path.join(DEFAULT_CACHE_DIR, f'{Path(tiktoken_bpe_file).name}.{key[:16]}.marshal')
+    try:
+        with open(cache_file, 'rb') as f:
+            ranks = marshal.loads(f.read())
+        if isinstance(ranks, dict):
+            return ranks
+    except FileNotFoundError:
+        pass
+    except Exception as ex:
+        logger.warning(f'Failed to load the vocab cache {cache_file}: {type(ex).__name__}: {ex}')
+
+    ranks = _load_tiktoken_bpe(tiktoken_bpe_file)
+    try:
+        os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(marshal.dumps(ranks))
+        os.replace(tmp_file, cache_file)  # Atomic, so a concurrent process never reads a partial cache
+    except OSError as ex:
+        logger.warning(f'Failed to write the vocab cache {cache_file}: {type(ex).__name__}: {ex}')
+    return ranks
+
+
 class QWenTokenizer:
     """QWen tokenizer."""
 
@@ -54,13 +92,14 @@ class QWenTokenizer:
     ):
         if not vocab_file:
             vocab_file = VOCAB_FILES_NAMES['vocab_file']
+        self.vocab_file = vocab_file
         self._decode_use_source_tokenizer = False
 
         # how to handle errors in decoding UTF-8 byte sequences
         # use ignore if you are in streaming inference
         self.errors = errors
 
-        self.mergeable_ranks = _load_tiktoken_bpe(vocab_file)  # type: Dict[bytes, int]
+        self.mergeable_ranks = _load_tiktoken_bpe_cached(vocab_file)  # type: Dict[bytes, int]
         self.special_tokens = {token: index for index, token in SPECIAL_TOKENS}
 
         # try load extra vocab from file
@@ -77,41 +116,48 @@ class QWenTokenizer:
                 self.mergeable_ranks[token] = index
             # the index may be sparse after this, but don't worry tiktoken.Encoding will handle this
 
-        enc = tiktoken.Encoding(
-            'Qwen',
-            pat_str=PAT_STR,
-            mergeable_ranks=self.mergeable_ranks,
-            special_tokens=self.special_tokens,
-        )
+        enc = self._build_encoding()
         assert len(self.mergeable_ranks) + len(
             self.special_tokens
         ) == enc.n_vocab, f'{len(self.mergeable_ranks) + len(self.special_tokens)} != {enc.n_vocab} in encoding'
-
-        self.decoder = {v: k for k, v in self.mergeable_ranks.items()}  # type: dict[int, bytes|str]
-        self.decoder.update({v: k for k, v in self.special_tokens.items()})
-
         self.tokenizer = enc  # type: tiktoken.Encoding
 
         self.eod_id = self.tokenizer.eot_token
         self.im_start_id = self.special_tokens[IMSTART]
         self.im_end_id = self.special_tokens[IMEND]
 
+    def _build_encoding(self) -> tiktoken.Encoding:
+        return tiktoken.Encoding(
+            'Qwen',
+            pat_str=PAT_STR,
+            mergeable_ranks=self.mergeable_ranks,
+            special_tokens=self.special_tokens,
+        )
+
+    @functools.cached_property
+    def decoder(self) -> Dict[int, Union[bytes, str]]:
+        # Only needed by tokenize, which is not used on the hot paths
+        decoder = {v: k for k, v in self.mergeable_ranks.items()}
+        decoder.update({v: k for k, v in self.special_tokens.items()})
+        return decoder
+
+    def __reduce_ex__(self, protocol):
+        if self is _TOKENIZER:
+            # The shared tokenizer is pickled by reference, e.g., when sent to the workers of a process pool
+            return get_tokenizer, ()
+        return super().__reduce_ex__(protocol)
+
     def __getstate__(self):
         # for pickle lovers
         state = self.__dict__.copy()
         del state['tokenizer']
+        state.pop('decoder', None)
         return state
 
     def __setstate__(self, state):
         # tokenizer is not python native; don't pass it; rebuild it
         self.__dict__.update(state)
-        enc = tiktoken.Encoding(
-            'Qwen',
-            pat_str=PAT_STR,
-            mergeable_ranks=self.mergeable_ranks,
-            special_tokens=self.special_tokens,
-        )
-        self.tokenizer = enc
+        self.tokenizer = self._build_encoding()
 
     def __len__(self) -> int:
         return self.tokenizer.n_vocab
@@ -171,21 +217,21 @@ class QWenTokenizer:
         """
         Converts a sequence of tokens in a single string.
         """
-        text = ''
-        temp = b''
+        parts = []
+        temp = bytearray()
         for t in tokens:
             if isinstance(t, str):
                 if temp:
-                    text += temp.decode('utf-8', errors=self.errors)
-                    temp = b''
-                text += t
+                    parts.append(temp.decode('utf-8', errors=self.errors))
+                    temp = bytearray()
+                parts.append(t)
             elif isinstance(t, bytes):
                 temp += t
             else:
                 raise TypeError('token should only be of type types or str')
         if temp:
-            text += temp.decode('utf-8', errors=self.errors)
-        return text
+            parts.append(temp.decode('utf-8', errors=self.errors))
+        return ''.join(parts)
 
     @property
     def vocab_size(self):
@@ -205,19 +251,105 @@ class QWenTokenizer:
         return self.tokenizer.decode(token_ids, errors=errors or self.errors)
 
     def encode(self, text: str) -> List[int]:
-        return self.convert_tokens_to_ids(self.tokenize(text))
+        # The same as self.convert_tokens_to_ids(self.tokenize(text)), without the detour through the tokens
+        return self._encode(unicodedata.normalize('NFC', text))
+
+    def encode_batch(self, texts: List[str], num_threads: int = 8) -> List[List[int]]:
+        """Encode the texts in the threads of tiktoken, which release the GIL while encoding."""
+        texts = [unicodedata.normalize('NFC', text) for text in texts]
+        num_threads = min(num_threads, os.cpu_count() or 1)
+        if len(texts) <= 1 or num_threads <= 1:
+            # The threads only add overhead without another cpu
+            return [self._encode(text) for text in texts]
+        if any(SPECIAL_TOKEN_PREFIX in text for text in texts):
+            return self.tokenizer.encode_batch(texts,
+                                               num_threads=num_threads,
+                                               allowed_special='all',
+                                               disallowed_special=())
+        return self.tokenizer.encode_ordinary_batch(texts, num_threads=num_threads)
+
+    def _encode(self, text: str) -> List[int]:
+        if SPECIAL_TOKEN_PREFIX in text:
+            return self.tokenizer.encode(text, allowed_special='all', disallowed_special=())
+        # Much faster for the short texts, since the set of the special tokens is not passed to tiktoken
+        return self.tokenizer.encode_ordinary(text)
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
 
     def count_tokens(self, text: str) -> int:
-        return len(self.tokenize(text))
+        return self.count(text)
+
+    def truncate_ids(self, token_ids: List[int], max_token: int, start_token: int = 0) -> str:
+        """Decode the max_token ids from start_token, where only the kept ids are decoded."""
+        return self.tokenizer.decode(token_ids[start_token:start_token + max_token], errors=self.errors)
 
     def truncate(self, text: str, max_token: int, start_token: int = 0) -> str:
-        token_list = self.tokenize(text)
-        token_list = token_list[start_token:min(len(token_list), start_token + max_token)]
-        return self.convert_tokens_to_string(token_list)
+        return self.truncate_ids(self.encode(text), max_token=max_token, start_token=start_token)
+
+
+# The tokenizer shared in a process, which is built on first use since loading the vocab takes a while
+_TOKENIZER: Optional[QWenTokenizer] = None
+_TOKENIZER_LOCK = threading.Lock()
+
+
+def get_tokenizer() -> QWenTokenizer:
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        with _TOKENIZER_LOCK:
+            if _TOKENIZER is None:
+                _TOKENIZER = QWenTokenizer(Path(__file__).resolve().parent / 'qwen.tiktoken')
+    return _TOKENIZER
+
+
+def _reset_tokenizer_lock_in_child():
+    # The lock may be held by another thread of the parent when forking. A tokenizer built before forking is
+    # inherited by the child without being loaded again.
+    global _TOKENIZER_LOCK
+    _TOKENIZER_LOCK = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_tokenizer_lock_in_child)
+
+
+class _LazyTokenizer:
+    """A proxy of the shared tokenizer, so that `from qwen_agent.utils.tokenization_qwen import tokenizer` does not
+    load the vocab at import time."""
+
+    def __getattr__(self, name: str):
+        return getattr(get_tokenizer(), name)
+
+    def __len__(self) -> int:
+        return len(get_tokenizer())
+
+    def __reduce__(self):
+        return 'tokenizer'
 
 
-tokenizer = QWenTokenizer(Path(__file__).resolve().parent / 'qwen.tiktoken')
+tokenizer = _LazyTokenizer()
 
 
 def count_tokens(text: str) -> int:
-    return tokenizer.count_tokens(text)
+    return tokenizer.count(text)
+
+
+# The LRU cache of the token counts, keyed by the hash of the texts so that the texts are not kept
+_TOKEN_COUNTS: 'OrderedDict[bytes, int]' = OrderedDict()
+_TOKEN_COUNTS_LOCK = threading.Lock()
+
+
+def count_tokens_cached(text: str) -> int:
+    """Count the tokens of a text that is counted again and again, e.g., the history messages of a conversation."""
+    key = hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+    with _TOKEN_COUNTS_LOCK:
+        num_tokens = _TOKEN_COUNTS.get(key)
+        if num_tokens is not None:
+            _TOKEN_COUNTS.move_to_end(key)
+            return num_tokens
+    num_tokens = tokenizer.count(text)
+    with _TOKEN_COUNTS_LOCK:
+        _TOKEN_COUNTS[key] = num_tokens
+        while len(_TOKEN_COUNTS) > TOKEN_COUNT_CACHE_SIZE:
+            _TOKEN_COUNTS.popitem(last=False)
+    return num_tokens
@@ -1,5 +1,6 @@
 import copy
 import hashlib
+import importlib
 import os
 import re
 import shutil
@@ -9,15 +10,93 @@ import sys
 import time
 import traceback
 import urllib.parse
-from typing import Any, List, Literal, Optional, Tuple, Union
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Union
 
 import json5
 import requests
 
+from qwen_agent.llm.compact import CompactContentItem, CompactMessage
 from qwen_agent.llm.schema import ASSISTANT, FUNCTION, SYSTEM, USER, ContentItem, Message
 from qwen_agent.log import logger
 
 
+class LazyRegistry(MutableMapping):
+    """A registry of the classes by name, where a built-in class is registered by importing its module on first lookup.
+
+    All the names, including the built-in ones not imported yet, are seen by `in`, `len`, `keys` and the iteration,
+    which do not import any module. The lookups, including `values` and `items`, import the modules of the classes.
+    """
+
+    def __init__(self, lazy_modules: Dict[str, str]):
+        self.lazy_modules = dict(lazy_modules)  # The name of the class -> the module registering it
+        self._registered: Dict[str, type] = {}
+
+    def __getitem__(self, name: str):
+        if name not in self._registered and name in self.lazy_modules:
+            importlib.import_module(self.lazy_modules[name])
+        return self._registered[name]
+
+    def __setitem__(self, name: str, cls: type):
+        self._registered[name] = cls
+
+    def __delitem__(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self._registered.pop(name, None)
+        self.lazy_modules.pop(name, None)
+
+    def __contains__(self, name) -> bool:
+        return name in self._registered or name in self.lazy_modules
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self.keys())})'
+
+    def keys(self):
+        return dict.fromkeys([*self._registered, *self.lazy_modules]).keys()
+
+    def is_registered(self, name: str) -> bool:
+        """Whether the class has been registered, i.e., it is not waiting to be imported."""
+        return name in self._registered
+
+    def is_builtin(self, name: str, cls: type) -> bool:
+        return self.lazy_modules.get(name) == cls.__module__
+
+
+def lazy_module_attrs(module_name: str,
+                      lazy_attrs: Dict[str, Union[str, Tuple[str, str]]]) -> Tuple[Callable, Callable]:
+    """Make the `__getattr__` and `__dir__` of a package, which import its attributes on first access.
+
+    Args:
+        module_name: The `__name__` of the package.
+        lazy_attrs: The name of the attribute -> the module defining it, or (the module, the name in the module),
+          where the module can be relative to the package.
+
+    Returns:
+        The functions to be assigned to `__getattr__` and `__dir__` of the package.
+    """
+    lazy_attrs = {name: (src, name) if isinstance(src, str) else src for name, src in lazy_attrs.items()}
+
+    def __getattr__(name: str):
+        if name in lazy_attrs:
+            module, attr = lazy_attrs[name]
+            value = getattr(importlib.import_module(module, module_name), attr)
+            setattr(sys.modules[module_name], name, value)
+            return value
+        raise AttributeError(f'module {module_name!r} has no attribute {name!r}')
+
+    def __dir__():
+        return sorted(set(vars(sys.modules[module_name])) | set(lazy_attrs))
+
+    return __getattr__, __dir__
+
+
 def append_signal_handler(sig, handler):
     """
     Installs a new signal handler while preserving any existing handler.
@@ -201,6 +280,42 @@ def get_content_type_by_head_request(path: str) -> str:
         return 'unk'
 
 
+def get_local_file_fingerprint(path: str) -> Optional[dict]:
+    """The modification time and size of a local file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def get_url_fingerprint(url: str, fingerprint: Optional[dict] = None, timeout: float = 10) -> Optional[dict]:
+    """Get the ETag and Last-Modified of a url by a conditional GET, without downloading the content.
+
+    Args:
+        url: The http(s) url.
+        fingerprint: The fingerprint got before, which is sent as If-None-Match and If-Modified-Since.
+
+    Returns:
+        The same fingerprint if the content is not modified, or the new fingerprint. None if the request fails.
+    """
+    headers = {}
+    if fingerprint:
+        if fingerprint.get('etag'):
+            headers['If-None-Match'] = fingerprint['etag']
+        if fingerprint.get('last_modified'):
+            headers['If-Modified-Since'] = fingerprint['last_modified']
+    try:
+        with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304:
+                return fingerprint
+            if response.status_code != 200:
+                return None
+            return {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    except requests.RequestException:
+        return None
+
+
 def get_file_type(path: str) -> Literal['pdf', 'docx', 'pptx', 'txt', 'html', 'unk']:
     f_type = get_basename_from_url(path).split('.')[-1].lower()
     if f_type in ['pdf', 'docx', 'pptx']:
@@ -259,16 +374,21 @@ def format_as_multimodal_message(
     lang: Literal['auto', 'en', 'zh'] = 'auto',
 ) -> Message:
     assert msg.role in (USER, ASSISTANT, SYSTEM, FUNCTION)
+    # The compact messages inside the LLMs stay compact
+    if isinstance(msg, CompactMessage):
+        message_cls, content_item_cls = CompactMessage, CompactContentItem
+    else:
+        message_cls, content_item_cls = Message, ContentItem
     content: List[ContentItem] = []
     if isinstance(msg.content, str):  # if text content
         if msg.content:
-            content = [ContentItem(text=msg.content)]
+            content = [content_item_cls(text=msg.content)]
     elif isinstance(msg.content, list):  # if multimodal content
         files = []
         for item in msg.content:
             k, v = item.get_type_and_value()
             if k == 'text':
-                content.append(ContentItem(text=v))
+                content.append(content_item_cls(text=v))
             if k == 'image':
                 content.append(item)
             if k in ('file', 'image'):
@@ -304,10 +424,10 @@ def format_as_multimodal_message(
                     upload_info_already_added = True
 
             if not upload_info_already_added:
-                content = [ContentItem(text=upload)] + content
+                content = [content_item_cls(text=upload)] + content
     else:
         raise TypeError
-    msg = Message(
+    msg = message_cls(
         role=msg.role,
         content=content,
         name=msg.name if msg.role == FUNCTION else None,
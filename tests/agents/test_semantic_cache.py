@@ -0,0 +1,97 @@
+import time
+from typing import Iterator, List
+
+import numpy as np
+
+from qwen_agent import Agent
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.tools.search_tools.embedding_store import BaseEmbedding
+from qwen_agent.utils.semantic_cache import SemanticCache, normalize_query
+
+
+class CharEmbedding(BaseEmbedding):
+    """A bag of characters, which is similar for the questions with small wording changes"""
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), 1024), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for c in text:
+                vectors[i, ord(c) % 1024] += 1
+        return vectors
+
+
+class CountingAgent(Agent):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.num_runs = 0
+
+    def _run(self, messages: List[Message], lang: str = 'en', **kwargs) -> Iterator[List[Message]]:
+        self.num_runs += 1
+        yield [Message(ASSISTANT, f'answer {self.num_runs}')]
+
+
+def test_normalize_query():
+    assert normalize_query('  赎回几天到账？？ ') == '赎回几天到账'
+    assert normalize_query('How  LONG does it take?') == 'how long does it take'
+
+
+def test_agent_semantic_cache():
+    agent = CountingAgent(name='consultant',
+                          semantic_cache={
+                              'embedding': CharEmbedding(),
+                              'threshold': 0.8,
+                              'max_entries': 2
+                          })
+
+    *_, last = agent.run([{'role': 'user', 'content': '基金赎回几天能到账'}])
+    assert last == [{'role': 'assistant', 'content': 'answer 1', 'name': 'consultant'}]
+    *_, last = agent.run([{'role': 'user', 'content': '基金赎回几天到账？'}])
+    assert last == [{'role': 'assistant', 'content': 'answer 1', 'name': 'consultant'}]
+    assert agent.num_runs == 1
+
+    # Not similar, or in another context
+    *_, last = agent.run([{'role': 'user', 'content': '什么是最大回撤'}])
+    assert last[-1]['content'] == 'answer 2'
+    *_, last = agent.run([{'role': 'user', 'content': '基金赎回几天能到账'}], lang='en')
+    assert last[-1]['content'] == 'answer 3'
+
+    # The least recently hit entry is evicted
+    *_, last = agent.run([{'role': 'user', 'content': '基金赎回几天能到账'}])
+    assert last[-1]['content'] == 'answer 4'
+    assert agent.num_runs == 4
+
+    stats = agent.semantic_cache.stats
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) == (1, 4, 2, 2)
+    assert stats['hit_rate'] == 0.2
+
+
+def test_agent_semantic_cache_context():
+    agent = CountingAgent(semantic_cache={'embedding': CharEmbedding(), 'threshold': 0.8})
+    question = {'role': 'user', 'content': '那它的费率是多少？'}
+    fund_a = [{'role': 'user', 'content': '介绍一下基金A'}, {'role': 'assistant', 'content': '基金A是一只债券基金。'}]
+    fund_b = [{'role': 'user', 'content': '介绍一下基金B'}, {'role': 'assistant', 'content': '基金B是一只股票基金。'}]
+
+    # The same question in different conversations
+    *_, last = agent.run(fund_a + [question])
+    assert last[-1]['content'] == 'answer 1'
+    *_, last = agent.run(fund_b + [question])
+    assert last[-1]['content'] == 'answer 2'
+    *_, last = agent.run(fund_a + [question])
+    assert last[-1]['content'] == 'answer 1'
+
+    # The same question with different external knowledge
+    *_, last = agent.run([question], knowledge='基金A的费率是0.8%')
+    assert last[-1]['content'] == 'answer 3'
+    *_, last = agent.run([question], knowledge='基金B的费率是1.5%')
+    assert last[-1]['content'] == 'answer 4'
+    assert agent.num_runs == 4
+
+
+def test_semantic_cache_ttl():
+    cache = SemanticCache({'embedding': CharEmbedding(), 'ttl': 0.1})
+    cache.put('赎回几天到账', [Message(ASSISTANT, 'T+1')])
+    assert cache.get('赎回几天到账')[0].content == 'T+1'
+    time.sleep(0.2)
+    assert cache.get('赎回几天到账') is None
+    assert cache.stats['entries'] == 0
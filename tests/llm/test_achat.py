@@ -0,0 +1,64 @@
+import asyncio
+from typing import Dict, Iterator, List, Optional
+
+from qwen_agent.llm.base import ModelServiceError
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+class ScriptedChatModel(BaseTextChatModel):
+    """Reply with a fixed text, after failing the first `num_failures` requests"""
+
+    def __init__(self, reply: str, num_failures: int = 0, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.reply = reply
+        self.num_failures = num_failures
+        self.num_requests = 0
+
+    def _check_failure(self):
+        self.num_requests += 1
+        if self.num_requests <= self.num_failures:
+            raise ModelServiceError(code='500', message='Service unavailable')
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        self._check_failure()
+        for i in range(1, len(self.reply) + 1):
+            yield [Message(ASSISTANT, self.reply[:i])]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        self._check_failure()
+        return [Message(ASSISTANT, self.reply)]
+
+
+async def _achat(llm, stream: bool, **kwargs):
+    if stream:
+        return [rsp async for rsp in await llm.achat(stream=True, **kwargs)]
+    return await llm.achat(stream=False, **kwargs)
+
+
+def test_achat_same_as_chat():
+    messages = [{'role': 'user', 'content': 'hello'}]
+    llm = ScriptedChatModel('Hi there.Observation: ignored', cfg={'generate_cfg': {'stop': ['Observation:']}})
+    for stream in [True, False]:
+        expected = llm.chat(messages=messages, stream=stream)
+        if stream:
+            expected = list(expected)
+        assert asyncio.run(_achat(llm, stream=stream, messages=messages)) == expected
+    assert expected[-1]['content'] == 'Hi there.'
+
+
+def test_achat_with_functions():
+    functions = [{'name': 'image_gen', 'description': 'AI painting', 'parameters': {}}]
+    messages = [Message('user', 'draw a cat')]
+    llm = ScriptedChatModel('✿FUNCTION✿: image_gen\n✿ARGS✿: {"prompt": "cat"}')
+    rsp = asyncio.run(_achat(llm, stream=False, messages=messages, functions=functions))
+    assert rsp == llm.chat(messages=messages, functions=functions, stream=False)
+    assert rsp[-1].function_call.name == 'image_gen'
+
+
+def test_achat_retry():
+    messages = [{'role': 'user', 'content': 'hello'}]
+    llm = ScriptedChatModel('Hi', num_failures=1, cfg={'generate_cfg': {'max_retries': 1}})
+    rsp = asyncio.run(_achat(llm, stream=True, messages=messages))
+    assert rsp[-1][-1]['content'] == 'Hi'
+    assert llm.num_requests == 2
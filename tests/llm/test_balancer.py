@@ -0,0 +1,173 @@
+import asyncio
+import time
+from typing import Dict, Iterator, List, Optional
+
+from qwen_agent.llm import get_chat_model
+from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+@register_llm('test_replica')
+class ReplicaChatModel(BaseTextChatModel):
+    """Reply with the model server, or fail if the model server is down"""
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.model_server = cfg['model_server']
+
+    def _reply(self) -> str:
+        if self.model_server.startswith('down'):
+            raise ModelServiceError(code='503', message='Service Unavailable')
+        if self.model_server.startswith('slow'):
+            time.sleep(1)
+        return f'from {self.model_server}'
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        yield [Message(ASSISTANT, self._reply())]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, self._reply())]
+
+
+def test_balancer_least_outstanding():
+    llm = get_chat_model({'model_type': 'test_replica', 'model_server': ['a', 'b']})
+    messages = [{'role': 'user', 'content': 'hi'}]
+    replies = [llm.chat(messages, stream=False)[-1]['content'] for _ in range(4)]
+    assert replies == ['from a', 'from b', 'from a', 'from b']
+
+    # The endpoint with an outstanding stream is avoided
+    stream = llm.chat(messages, stream=True)
+    assert next(stream)[-1]['content'] == 'from a'
+    assert [llm.chat(messages, stream=False)[-1]['content'] for _ in range(2)] == ['from b', 'from b']
+    assert list(stream) == []
+    stats = llm.endpoint_stats
+    assert [(s['requests'], s['outstanding'], s['errors']) for s in stats] == [(3, 0, 0), (4, 0, 0)]
+    assert all(s['ewma_latency'] is not None for s in stats)
+
+
+def test_balancer_failover():
+    llm = get_chat_model({
+        'model': 'test',
+        'model_type': 'test_replica',
+        'endpoints': [
+            {
+                'model_server': 'down'
+            },
+            {
+                'model_server': 'b'
+            },
+            {
+                'name': 'fallback',
+                'model_server': 'c',
+                'fallback': True
+            },
+        ],
+        'balancer': {
+            'max_failures': 2,
+            'ejection_time': 60
+        },
+    })
+    messages = [{'role': 'user', 'content': 'hi'}]
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'from b'
+    assert list(llm.chat(messages, stream=True))[-1][-1]['content'] == 'from b'
+    assert asyncio.run(llm.achat(messages, stream=False))[-1]['content'] == 'from b'
+
+    # Ejected after 2 consecutive failures
+    stats = {s['name']: s for s in llm.endpoint_stats}
+    assert (stats['test@down']['errors'], stats['test@down']['healthy']) == (2, False)
+    assert stats['test@b']['requests'] == 3
+    assert stats['fallback']['requests'] == 0
+
+    # The fallback endpoint is used if no other endpoint is healthy
+    llm.balancer.endpoints[1].ejected_until = float('inf')
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'from c'
+
+
+def test_balancer_hedging():
+    llm = get_chat_model({
+        'model_type': 'test_replica',
+        'model_server': ['slow', 'b'],
+        'hedging': {
+            'initial_delay': 0.1,
+            'max_extra_load': 1.0
+        }
+    })
+    start = time.time()
+    # The duplicate of the slow request is sent to another endpoint
+    assert llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)[-1]['content'] == 'from b'
+    assert time.time() - start < 0.5
+    assert all(ep.llm.hedging is None for ep in llm.balancer.endpoints)
+
+
+def test_balancer_model_service_hooks():
+    llm = get_chat_model({'model_type': 'test_replica', 'model_server': ['a', 'b']})
+    messages = [Message('user', 'hi')]
+    # The hooks are delegated to the model of the selected endpoint
+    assert llm._chat_no_stream(messages, generate_cfg={})[-1].content == 'from a'
+    assert list(llm._chat_stream(messages, delta_stream=False, generate_cfg={}))[-1][-1].content == 'from b'
+    assert [(s['requests'], s['outstanding']) for s in llm.endpoint_stats] == [(1, 0), (1, 0)]
+
+
+def test_balancer_response_cache():
+    llm = get_chat_model({
+        'model_type': 'test_replica',
+        'model_server': ['a', 'b'],
+        'generate_cfg': {
+            'temperature': 0
+        },
+        'response_cache': {
+            'backend': 'memory'
+        }
+    })
+    assert all(ep.llm.response_cache is None for ep in llm.balancer.endpoints)
+    messages = [{'role': 'user', 'content': 'hi, cache'}]
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'from a'
+    # The response from one endpoint is reused without sending the request to another one
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'from a'
+    assert list(llm.chat(messages, stream=True))[-1][-1]['content'] == 'from a'
+    assert asyncio.run(llm.achat(messages, stream=False))[-1]['content'] == 'from a'
+    assert [s['requests'] for s in llm.endpoint_stats] == [1, 0]
+
+    other = [Message('user', 'hi, stream')]
+    assert list(llm.chat(other, stream=True))[-1][-1].content == 'from b'
+    assert llm.chat(other, stream=False)[-1].content == 'from b'
+    assert [s['requests'] for s in llm.endpoint_stats] == [1, 1]
+
+
+def test_balancer_rate_limit_and_hedging():
+
+    def _get_llm(model_servers: List[str]):
+        return get_chat_model({
+            'model_type': 'test_replica',
+            'model_server': model_servers,
+            'rate_limit': {
+                'requests_per_minute': 60
+            },
+            'hedging': {
+                'initial_delay': 0.1,
+                'max_extra_load': 1.0
+            }
+        })
+
+    def _drain(endpoint):
+        while endpoint.rate_limiter.try_acquire():
+            pass
+
+    messages = [{'role': 'user', 'content': 'hi'}]
+    llm = _get_llm(['a-queued', 'b-queued'])
+    assert all(ep.llm.rate_limiter is None for ep in llm.balancer.endpoints)
+    for endpoint in llm.balancer.endpoints:
+        _drain(endpoint)
+    # The time waiting to be admitted does not trigger the hedging
+    start = time.time()
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'from a-queued'
+    assert time.time() - start > 0.5
+    assert llm.hedging.stats['hedged'] == 0
+
+    # The duplicate is not sent if the limiter of its endpoint can not admit it at once
+    llm = _get_llm(['slow-limited', 'b-limited'])
+    _drain(llm.balancer.endpoints[1])
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'from slow-limited'
+    assert llm.hedging.stats['hedged'] == 0
+    assert [s['outstanding'] for s in llm.endpoint_stats] == [0, 0]
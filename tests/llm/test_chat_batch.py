@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from qwen_agent.llm.base import ModelServiceError
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+class ConcurrencyChatModel(BaseTextChatModel):
+    """Echo the query after a while and record the max number of concurrent requests, or fail on the query 'fail'"""
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.lock = threading.Lock()
+        self.num_running = 0
+        self.max_running = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        raise NotImplementedError
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        with self.lock:
+            self.num_running += 1
+            self.max_running = max(self.max_running, self.num_running)
+        time.sleep(0.05)
+        with self.lock:
+            self.num_running -= 1
+        if messages[-1].content == 'fail':
+            raise ModelServiceError(code='500', message='Internal Server Error')
+        return [Message(ASSISTANT, messages[-1].content)]
+
+
+def test_chat_batch():
+    llm = ConcurrencyChatModel()
+    queries = [str(i) for i in range(10)] + ['fail']
+    responses = llm.chat_batch([[{'role': 'user', 'content': q}] for q in queries], max_concurrency=4)
+    assert [rsp[-1]['content'] for rsp in responses[:-1]] == queries[:-1]
+    assert isinstance(responses[-1], ModelServiceError)
+    assert llm.max_running == 4
+
+    llm = ConcurrencyChatModel()
+    responses = asyncio.run(llm.achat_batch([[{'role': 'user', 'content': q}] for q in queries], max_concurrency=3))
+    assert [rsp[-1]['content'] for rsp in responses[:-1]] == queries[:-1]
+    assert isinstance(responses[-1], ModelServiceError)
+    assert llm.max_running == 3
@@ -0,0 +1,137 @@
+import copy
+from typing import Iterator, List
+
+import pytest
+
+from qwen_agent.llm.compact import CompactMessage, to_compact_message, to_pydantic_message
+from qwen_agent.llm.schema import ASSISTANT, ContentItem, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+from qwen_agent.utils.utils import extract_text_from_message, format_as_multimodal_message
+
+MESSAGES = [
+    {
+        'role': 'system',
+        'content': 'You are a helpful assistant.'
+    },
+    {
+        'role': 'user',
+        'content': [{
+            'text': '这份报告说了什么？'
+        }, {
+            'file': 'https://example.com/report.pdf'
+        }, {
+            'image': '/tmp/chart.png'
+        }]
+    },
+    {
+        'role': 'assistant',
+        'content': '',
+        'function_call': {
+            'name': 'doc_parser',
+            'arguments': '{"url": "report.pdf"}'
+        }
+    },
+    {
+        'role': 'function',
+        'name': 'doc_parser',
+        'content': 'The revenue grew by 10%.'
+    },
+    {
+        'role': 'assistant',
+        'content': None
+    },
+]
+
+
+class EchoChatModel(BaseTextChatModel):
+    """Reply with the last input message, and record the messages sent to the model service"""
+
+    def __init__(self):
+        super().__init__({'model': 'echo'})
+        self.received = None
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        yield self._chat_no_stream(messages, generate_cfg=generate_cfg)
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        # The full interface of the pydantic models is available to the custom models
+        assert all(isinstance(msg, Message) for msg in messages)
+        assert [msg.model_copy(deep=True) for msg in messages] == messages
+        [msg.model_dump_json() for msg in messages]
+        self.received = messages
+        return [Message(ASSISTANT, messages[-1].content)]
+
+
+@pytest.mark.parametrize('msg', MESSAGES)
+def test_compact_message_interface(msg):
+    expected = Message(**msg)
+    compact = to_compact_message(msg)
+    assert compact.model_dump() == expected.model_dump()
+    assert str(compact) == str(expected)
+    assert compact == expected
+    assert to_compact_message(expected).model_dump() == expected.model_dump()
+    assert to_pydantic_message(compact).model_dump() == expected.model_dump()
+    assert copy.deepcopy(compact) == compact
+
+    for add_upload_info in (True, False):
+        formatted = format_as_multimodal_message(compact, add_upload_info=add_upload_info)
+        assert isinstance(formatted, CompactMessage)
+        assert formatted.model_dump() == format_as_multimodal_message(expected, add_upload_info).model_dump()
+        text = extract_text_from_message(compact, add_upload_info=add_upload_info)
+        assert text == extract_text_from_message(expected, add_upload_info=add_upload_info)
+    if isinstance(expected.content, list):
+        for item, expected_item in zip(compact.content, expected.content):
+            assert item.get_type_and_value() == expected_item.get_type_and_value()
+
+
+@pytest.mark.parametrize('msg', [
+    {
+        'role': 'robot',
+        'content': 'hi'
+    },
+    {
+        'role': 'user',
+        'content': [{
+            'text': 'hi',
+            'image': 'a.png'
+        }]
+    },
+    {
+        'role': 'user',
+        'content': [{}]
+    },
+])
+def test_compact_message_validation(msg):
+    with pytest.raises(ValueError):
+        Message(**msg)
+    with pytest.raises(ValueError):
+        to_compact_message(msg)
+
+
+def test_compact_message_unknown_field():
+    with pytest.raises(TypeError):
+        CompactMessage(role='user', content='hi', reasoning_content='')
+
+
+def test_chat_with_compact_messages():
+    llm = EchoChatModel()
+    inputs = [Message(**msg) for msg in MESSAGES[:2]]
+    snapshot = [msg.model_dump() for msg in inputs]
+
+    output = llm.chat(inputs, stream=False)
+    # The messages are compact between the boundaries, and the model service and the caller get the public type
+    assert [type(msg) for msg in output] == [Message]
+    assert output[0].content.startswith('（上传了 [文件](report.pdf) ![图片](chart.png)）\n\n这份报告说了什么？')
+    assert llm.chat(MESSAGES[:2], stream=False) == [output[0].model_dump()]
+    # The inputs are not modified
+    assert [msg.model_dump() for msg in inputs] == snapshot
+
+
+def test_chat_with_functions_and_compact_messages():
+    llm = EchoChatModel()
+    functions = [{'name': 'doc_parser', 'description': 'Parse a doc', 'parameters': {}}]
+    output = llm.chat(MESSAGES[:4] + [{'role': 'user', 'content': 'thanks'}], functions=functions, stream=False)
+    assert output[-1]['role'] == ASSISTANT
+    assert all(type(msg) is Message for msg in llm.received)
+    for msg in llm.received:
+        assert isinstance(msg.content, str) or all(type(item) is ContentItem for item in msg.content)
@@ -0,0 +1,79 @@
+import asyncio
+from typing import Dict, Iterator, List, Optional
+
+import pytest
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+FUNCTIONS = [{
+    'name': 'get_weather',
+    'description': 'Get the weather of a city',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'city': {
+                'type': 'string'
+            }
+        },
+        'required': ['city'],
+    },
+}]
+
+
+class ChunkedChatModel(BaseTextChatModel):
+    """Stream a fixed text in chunks, and record how many chunks are generated"""
+
+    def __init__(self, chunks: List[str], cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.chunks = chunks
+        self.num_generated = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        full_response = ''
+        for chunk in self.chunks:
+            self.num_generated += 1
+            full_response += chunk
+            yield [Message(ASSISTANT, chunk if delta_stream else full_response)]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, ''.join(self.chunks))]
+
+
+async def _achat_delta_stream(llm, **kwargs):
+    return [rsp async for rsp in await llm.achat(stream=True, delta_stream=True, **kwargs)]
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_fncall_delta_stream(use_async):
+    chunks = [
+        ': I will check', ' the weather', '.\n✿', 'FUNCTION✿: get_', 'weather\n✿AR', 'GS✿: {"city": ', '"Beijing"}',
+        '\n✿RES', 'ULT✿: sunny', '\n✿RETURN✿: It is sunny.'
+    ]
+    messages = [{'role': 'user', 'content': 'How is the weather in Beijing?'}]
+    llm = ChunkedChatModel(chunks)
+    if use_async:
+        responses = asyncio.run(_achat_delta_stream(llm, messages=messages, functions=FUNCTIONS))
+    else:
+        responses = list(llm.chat(messages, functions=FUNCTIONS, stream=True, delta_stream=True))
+
+    # The text before the function call is streamed, holding back the special token that may be incomplete
+    assert [rsp[-1]['content'] for rsp in responses[:-1]] == ['I will check', ' the weather', '.']
+    # The function call is returned once when its arguments are closed, and the generation stops at the stop word
+    assert responses[-1] == [{
+        'role': 'assistant',
+        'content': '',
+        'function_call': {
+            'name': 'get_weather',
+            'arguments': '{"city": "Beijing"}'
+        }
+    }]
+    assert llm.num_generated == 9
+    assert responses[-1] == ChunkedChatModel(chunks).chat(messages, functions=FUNCTIONS, stream=False)[-1:]
+
+
+def test_fncall_delta_stream_without_fncall():
+    chunks = ['\n\nIt is', ' sunny ', '✿RET', 'URN✿']
+    llm = ChunkedChatModel(chunks)
+    responses = list(llm.chat([{'role': 'user', 'content': 'hi'}], functions=FUNCTIONS, stream=True, delta_stream=True))
+    assert [rsp[-1]['content'] for rsp in responses] == ['It is', ' sunny']
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from typing import Dict, Iterator, List, Optional
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+class SlowFirstChatModel(BaseTextChatModel):
+    """The first request is slow, and the others are fast"""
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.num_requests = 0
+        self.num_cancelled = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        raise NotImplementedError
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        self.num_requests += 1
+        i = self.num_requests
+        if i == 1:
+            time.sleep(1)
+        return [Message(ASSISTANT, f'reply {i}')]
+
+    async def _achat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        self.num_requests += 1
+        i = self.num_requests
+        try:
+            if i == 1:
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            self.num_cancelled += 1
+            raise
+        return [Message(ASSISTANT, f'reply {i}')]
+
+
+def test_hedging():
+    llm = SlowFirstChatModel({'hedging': {'initial_delay': 0.1, 'max_extra_load': 0.5}})
+    messages = [{'role': 'user', 'content': 'hi'}]
+    start = time.time()
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'reply 2'
+    assert time.time() - start < 0.5
+    assert llm.hedging.stats['hedged'] == llm.hedging.stats['hedge_wins'] == 1
+
+    # Not hedged beyond the extra load
+    llm.num_requests = 0
+    start = time.time()
+    assert llm.chat(messages, stream=False)[-1]['content'] == 'reply 1'
+    assert time.time() - start > 0.9
+    assert llm.hedging.stats['hedged'] == 1
+
+
+def test_ahedging():
+    llm = SlowFirstChatModel({'hedging': {'initial_delay': 0.1, 'max_extra_load': 1.0}})
+    messages = [{'role': 'user', 'content': 'hi'}]
+
+    async def _achat():
+        rsp = await llm.achat(messages, stream=False)
+        await asyncio.sleep(0)  # Let the loser handle the cancellation
+        return rsp
+
+    start = time.time()
+    assert asyncio.run(_achat())[-1]['content'] == 'reply 2'
+    assert time.time() - start < 0.5
+    # The loser is cancelled
+    assert llm.num_cancelled == 1
+
+
+def test_hedging_with_rate_limit():
+    llm = SlowFirstChatModel({
+        'model': 'slow_first',
+        'hedging': {
+            'initial_delay': 0.1,
+            'max_extra_load': 1.0
+        },
+        'rate_limit': {
+            'requests_per_minute': 60
+        }
+    })
+    llm.num_requests = 1  # All the requests are fast
+    for _ in range(60):
+        llm.rate_limiter.acquire()
+    # The request waits about 1s to be admitted, which is neither hedged nor sampled as the latency
+    assert llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)[-1]['content'] == 'reply 2'
+    assert llm.hedging.stats['hedged'] == 0
+    assert max(llm.hedging._latencies) < 0.5
@@ -1,8 +1,11 @@
 import os
 
+import openai
 import pytest
 
 from qwen_agent.llm import get_chat_model
+from qwen_agent.llm import oai
+from qwen_agent.llm.oai import get_openai_client, get_openai_client_stats
 from qwen_agent.llm.schema import Message
 
 functions = [{
@@ -51,3 +54,44 @@ def test_llm_oai(functions, stream, delta_stream):
         assert response[-1].function_call.name == 'image_gen'
     else:
         assert response[-1].function_call is None
+
+
+def test_oai_client_pool():
+    llm_cfg = {
+        'model': 'Qwen',
+        'model_server': 'http://127.0.0.1:7905/v1',
+        'api_key': 'none',
+        'generate_cfg': {
+            'max_connections': 8,
+            'top_p': 0.8
+        }
+    }
+    llm = get_chat_model(llm_cfg)
+    assert 'max_connections' not in llm.generate_cfg and llm.generate_cfg['top_p'] == 0.8
+
+    api_kwargs = {'base_url': 'http://127.0.0.1:7905/v1', 'api_key': 'none'}
+    client = get_openai_client(api_kwargs, {'max_connections': 8})
+    assert get_openai_client(dict(api_kwargs), {'max_connections': 8}) is client
+    assert get_openai_client(api_kwargs, {'max_connections': 16}) is not client
+    assert get_openai_client({**api_kwargs, 'api_key': 'other'}, {'max_connections': 8}) is not client
+
+    stats = [s for s in get_openai_client_stats() if s['base_url'] == api_kwargs['base_url']]
+    assert sorted(s['max_connections'] for s in stats) == [8, 8, 16]
+    assert all(s['connections'] == 0 for s in stats)
+
+    # Only the requests sent are counted, not the lookups of the clients
+    num_requests = sum(s['requests'] for s in stats)
+    with pytest.raises(openai.APIConnectionError):
+        client.with_options(max_retries=0).models.list()
+    stats = [s for s in get_openai_client_stats() if s['base_url'] == api_kwargs['base_url']]
+    assert sum(s['requests'] for s in stats) == num_requests + 1
+
+
+def test_oai_client_stats_without_httpx_internals(monkeypatch):
+    api_kwargs = {'base_url': 'http://127.0.0.1:7906/v1', 'api_key': 'none'}
+    get_openai_client(api_kwargs)
+    pooled = [pooled for key, pooled in oai._CLIENTS.items() if key[0] == api_kwargs['base_url']][0]
+    monkeypatch.delattr(pooled.transport, '_pool')
+    stats = [s for s in get_openai_client_stats() if s['base_url'] == api_kwargs['base_url']]
+    assert stats[0]['connections'] is None and stats[0]['idle_connections'] is None
+    assert stats[0]['requests'] == 0
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import time
+from typing import Iterator, List
+
+from qwen_agent.llm.rate_limiter import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RateLimiter
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+class EchoChatModel(BaseTextChatModel):
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        yield [Message(ASSISTANT, messages[-1].content)]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, messages[-1].content)]
+
+
+def test_rate_limiter_tokens_per_minute():
+    limiter = RateLimiter(tokens_per_minute=600)  # 10 tokens per second
+    start = time.time()
+    limiter.acquire(tokens=600)
+    assert time.time() - start < 0.1
+    limiter.acquire(tokens=5)
+    assert 0.4 < time.time() - start < 0.7
+    asyncio.run(limiter.aacquire(tokens=5))
+    assert 0.9 < time.time() - start < 1.2
+    # Not admitted without waiting
+    assert not limiter.try_acquire(tokens=5)
+    assert limiter.try_acquire(tokens=0) and limiter.stats['admitted'] == 4
+
+
+def test_rate_limiter_priority():
+    limiter = RateLimiter(requests_per_minute=600)  # 10 requests per second
+    for _ in range(600):
+        limiter.acquire()
+    admitted = []
+
+    def _acquire(name: str, priority: int):
+        limiter.acquire(priority=priority)
+        admitted.append(name)
+
+    threads = [threading.Thread(target=_acquire, args=(f'background_{i}', PRIORITY_BACKGROUND)) for i in range(2)]
+    for t in threads:
+        t.start()
+    time.sleep(0.02)
+
+    async def _aacquire():
+        await limiter.aacquire(priority=PRIORITY_INTERACTIVE)
+        admitted.append('interactive')
+
+    assert limiter.queue_depth == 2
+    asyncio.run(_aacquire())
+    for t in threads:
+        t.join()
+    # The interactive request arrives later but is admitted first
+    assert admitted[0] == 'interactive'
+    assert sorted(admitted[1:]) == ['background_0', 'background_1']
+    assert limiter.queue_depth == 0
+
+
+def test_llm_rate_limit():
+    cfg = {'model': 'echo', 'rate_limit': {'requests_per_minute': 60, 'tokens_per_minute': 6000}}
+    llm = EchoChatModel(cfg)
+    assert llm.rate_limiter is EchoChatModel(cfg).rate_limiter  # Shared by the models in a process
+    # The same model on another model server has its own limit
+    assert llm.rate_limiter is not EchoChatModel({**cfg, 'model_server': 'http://10.0.0.1:8000/v1'}).rate_limiter
+    messages = [{'role': 'user', 'content': 'hello ' * 100}]
+    llm.chat(messages, stream=False)
+    list(llm.chat(messages, stream=True, extra_generate_cfg={'priority': PRIORITY_BACKGROUND}))
+    stats = llm.rate_limiter.stats
+    assert stats['admitted'] == 2
+    assert 6000 - 2 * 100 > stats['available_tokens'] > 6000 - 2 * 150
@@ -0,0 +1,103 @@
+import asyncio
+import time
+from typing import Dict, Iterator, List, Optional
+
+import pytest
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+class CountingChatModel(BaseTextChatModel):
+    """Reply with the number of requests so far"""
+
+    def __init__(self, cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.num_requests = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        self.num_requests += 1
+        yield [Message(ASSISTANT, 'reply ')]
+        yield [Message(ASSISTANT, f'reply {self.num_requests}')]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        self.num_requests += 1
+        return [Message(ASSISTANT, f'reply {self.num_requests}')]
+
+
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+def test_response_cache(backend, tmp_path):
+    response_cache = {'backend': backend, 'ttl': 3600}
+    if backend != 'memory':
+        response_cache['path'] = str(tmp_path)
+    llm = CountingChatModel({'model': 'test', 'generate_cfg': {'temperature': 0}, 'response_cache': response_cache})
+    messages = [{'role': 'user', 'content': 'hello'}]
+
+    assert llm.chat(messages, stream=False) == [{'role': 'assistant', 'content': 'reply 1'}]
+    assert llm.chat(messages, stream=False) == [{'role': 'assistant', 'content': 'reply 1'}]
+    # Replayed as a stream
+    assert list(llm.chat(messages, stream=True)) == [[{'role': 'assistant', 'content': 'reply 1'}]]
+    assert asyncio.run(llm.achat(messages, stream=False)) == [{'role': 'assistant', 'content': 'reply 1'}]
+    assert llm.num_requests == 1
+
+    # Another request, whose complete stream is cached
+    messages = [{'role': 'user', 'content': 'hi'}]
+    assert list(llm.chat(messages, stream=True))[-1] == [{'role': 'assistant', 'content': 'reply 2'}]
+    assert llm.chat(messages, stream=False) == [{'role': 'assistant', 'content': 'reply 2'}]
+    assert llm.num_requests == 2
+
+    # Not cached when sampling without a seed
+    for _ in range(2):
+        llm.chat(messages, stream=False, extra_generate_cfg={'temperature': 0.7})
+    assert llm.num_requests == 4
+    assert llm.chat(messages, stream=False, extra_generate_cfg={'temperature': 0.7, 'seed': 1}) == [{
+        'role': 'assistant',
+        'content': 'reply 5'
+    }]
+    assert llm.response_cache.stats == {'hits': 4, 'misses': 3}
+
+
+def test_response_cache_default_sampling():
+    # The default of the model service is sampling
+    llm = CountingChatModel({'model': 'test', 'response_cache': {'backend': 'memory'}})
+    messages = [{'role': 'user', 'content': 'hello'}]
+    assert llm.chat(messages, stream=False) != llm.chat(messages, stream=False)
+    assert llm.response_cache.stats == {'hits': 0, 'misses': 0}
+
+
+def test_response_cache_max_entries(tmp_path):
+    # max_entries only bounds the memory cache
+    llm = CountingChatModel({
+        'model': 'test',
+        'generate_cfg': {
+            'seed': 1
+        },
+        'response_cache': {
+            'backend': 'sqlite',
+            'path': str(tmp_path),
+            'max_entries': 16
+        }
+    })
+    messages = [{'role': 'user', 'content': 'hello'}]
+    assert llm.chat(messages, stream=False) == llm.chat(messages, stream=False)
+    assert llm.num_requests == 1
+
+
+def test_response_cache_ttl():
+    llm = CountingChatModel({
+        'model': 'test',
+        'generate_cfg': {
+            'temperature': 0
+        },
+        'response_cache': {
+            'backend': 'memory',
+            'ttl': 0.1
+        }
+    })
+    messages = [{'role': 'user', 'content': 'hello'}]
+    llm.chat(messages, stream=False)
+    llm.chat(messages, stream=False)
+    assert llm.num_requests == 1
+    time.sleep(0.2)
+    llm.chat(messages, stream=False)
+    assert llm.num_requests == 2
@@ -0,0 +1,60 @@
+from typing import Dict, Iterator, List, Optional
+
+import pytest
+
+from qwen_agent.llm.schema import ASSISTANT, Message
+from qwen_agent.llm.stop_words import StopWordsMatcher
+from qwen_agent.llm.text_base import BaseTextChatModel
+
+
+class ChunkedChatModel(BaseTextChatModel):
+    """Stream a fixed text in chunks, and record how many chunks are generated"""
+
+    def __init__(self, chunks: List[str], cfg: Optional[Dict] = None):
+        super().__init__(cfg)
+        self.chunks = chunks
+        self.num_generated = 0
+
+    def _chat_stream(self, messages: List[Message], delta_stream: bool, generate_cfg: dict) -> Iterator[List[Message]]:
+        full_response = ''
+        for chunk in self.chunks:
+            self.num_generated += 1
+            full_response += chunk
+            yield [Message(ASSISTANT, chunk if delta_stream else full_response)]
+
+    def _chat_no_stream(self, messages: List[Message], generate_cfg: dict) -> List[Message]:
+        return [Message(ASSISTANT, ''.join(self.chunks))]
+
+
+def test_stop_words_matcher():
+    matcher = StopWordsMatcher(('Observation:', 'serve'))
+    assert matcher.scan('Observatory')[0] is None
+    assert matcher.scan('I observe it')[0] == 4
+    # Resume from the state of the text scanned before
+    pos, state = matcher.scan('Answer. Observa')
+    assert pos is None and matcher.depth(state) == len('Observa')
+    assert matcher.scan('Answer. Observation: x', start=len('Answer. Observa'), state=state)[0] == 8
+    assert matcher.scan('tion: Observe', state=state)[0] == -7
+
+
+@pytest.mark.parametrize('delta_stream', [True, False])
+def test_stream_stop_words(delta_stream):
+    chunks = ['Thought: look it up.', ' Observ', 'ation: ', 'the result', ' never used', ' at all']
+    llm = ChunkedChatModel(chunks, {'generate_cfg': {'stop': ['Observation:']}})
+    responses = list(llm.chat([{'role': 'user', 'content': 'hi'}], stream=True, delta_stream=delta_stream))
+    if delta_stream:
+        text = ''.join(rsp[-1]['content'] for rsp in responses)
+    else:
+        text = responses[-1][-1]['content']
+    assert text == 'Thought: look it up. '
+    # The generation is stopped right after the stop word
+    assert llm.num_generated == 3
+
+
+def test_delta_stream_without_stop_words():
+    chunks = ['Observ', 'ing the ', 'sky', '. Observation']
+    llm = ChunkedChatModel(chunks, {'generate_cfg': {'stop': ['Observation:']}})
+    responses = list(llm.chat([{'role': 'user', 'content': 'hi'}], stream=True, delta_stream=True))
+    # The text that may begin a stop word is held back, and the trailing partial stop word is removed
+    assert [rsp[-1]['content'] for rsp in responses] == ['', 'Observing the ', 'sky', '. ']
+    assert llm.chat([{'role': 'user', 'content': 'hi'}], stream=False)[-1]['content'] == 'Observing the sky. '
@@ -0,0 +1,20 @@
+from qwen_agent.llm.base import _truncate_input_messages_roughly
+from qwen_agent.llm.schema import ASSISTANT, SYSTEM, USER, Message
+from qwen_agent.utils.tokenization_qwen import count_tokens_cached, tokenizer
+
+
+def test_count_tokens_cached():
+    text = 'The history messages are counted again and again. 历史消息被反复计数。'
+    assert tokenizer.count_tokens(text) == len(tokenizer.tokenize(text))
+    assert count_tokens_cached(text) == count_tokens_cached(text) == tokenizer.count_tokens(text)
+
+
+def test_truncate_input_messages():
+    messages = [Message(SYSTEM, 'system')]
+    for i in range(10):
+        messages += [Message(USER, f'question {i} ' + 'x ' * 50), Message(ASSISTANT, f'answer {i} ' + 'y ' * 50)]
+    truncated, num_tokens = _truncate_input_messages_roughly(messages, max_tokens=500)
+    # The system message and the latest turns within the limit
+    assert [m.content.split()[1] for m in truncated[1:]] == ['6', '6', '7', '7', '8', '8', '9', '9']
+    assert truncated[0].content == 'system'
+    assert num_tokens == sum(tokenizer.count_tokens(m.content.strip()) for m in truncated) <= 500
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET = 1.5  # Seconds, which was 2.4 when every agent, tool and model was imported eagerly
+HEAVY_MODULES = ['dashscope', 'faiss', 'jupyter_client', 'matplotlib', 'openai', 'pandas', 'PIL']
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(code: str) -> str:
+    env = {**os.environ, 'PYTHONPATH': REPO_ROOT}
+    res = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+    return res.stdout.strip()
+
+
+def test_import_time():
+    code = ('import sys, time\n'
+            'start = time.perf_counter()\n'
+            'from qwen_agent.agents import Assistant\n'
+            'print(time.perf_counter() - start)\n'
+            f'print([m for m in {HEAVY_MODULES!r} if m in sys.modules])\n')
+    elapsed = min(float(_run(code).split('\n')[0]) for _ in range(2))
+    assert elapsed < IMPORT_TIME_BUDGET
+    assert _run(code).split('\n')[1] == '[]'
+
+
+def test_lazy_registry():
+    code = ('import sys\n'
+            'from qwen_agent.llm.base import LLM_REGISTRY\n'
+            'from qwen_agent.tools import TOOL_REGISTRY\n'
+            'assert "code_interpreter" in TOOL_REGISTRY and "oai" in LLM_REGISTRY\n'
+            'assert "code_interpreter" in TOOL_REGISTRY.keys() and "matplotlib" not in sys.modules\n'
+            'assert TOOL_REGISTRY["code_interpreter"].name == "code_interpreter"\n'
+            'assert LLM_REGISTRY.get("oai").__name__ == "TextChatAtOAI"\n'
+            'assert TOOL_REGISTRY.get("unknown") is None\n'
+            'assert len(TOOL_REGISTRY) == len(list(TOOL_REGISTRY)) == len(TOOL_REGISTRY.keys()) == 16\n'
+            'assert "matplotlib" not in sys.modules\n'
+            'assert dict(LLM_REGISTRY.items()) == {name: LLM_REGISTRY[name] for name in LLM_REGISTRY}\n'
+            'print("ok")\n')
+    assert _run(code) == 'ok'
+
+
+def test_lazy_attrs():
+    # The lazy attributes of the tools package are the classes of the built-in tools
+    code = ('import qwen_agent.tools as tools\n'
+            'from qwen_agent.tools.base import TOOL_REGISTRY\n'
+            'assert sorted(set(tools.__all__) - {"BaseTool", "TOOL_REGISTRY"}) == '
+            'sorted(cls.__name__ for cls in TOOL_REGISTRY.values())\n'
+            'assert "DocParser" in dir(tools) and tools.DocParser is TOOL_REGISTRY["doc_parser"]\n'
+            'print("ok")\n')
+    assert _run(code) == 'ok'
+
+
+def test_overwrite_builtin_tool():
+    # A built-in tool overwritten before its module is imported is kept
+    code = ('from qwen_agent.tools.base import BaseTool, register_tool, TOOL_REGISTRY\n'
+            '@register_tool("web_extractor", allow_overwrite=True)\n'
+            'class MyWebExtractor(BaseTool):\n'
+            '    def call(self, params, **kwargs):\n'
+            '        return ""\n'
+            'from qwen_agent.tools import WebExtractor\n'
+            'assert TOOL_REGISTRY["web_extractor"] is MyWebExtractor\n'
+            'print("ok")\n')
+    assert _run(code) == 'ok'
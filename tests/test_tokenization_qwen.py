@@ -0,0 +1,49 @@
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+from qwen_agent.utils.tokenization_qwen import QWenTokenizer, get_tokenizer, tokenizer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('text', ['', 'hello world', '你好，世界。' * 20, 'café <|im_end|> 😀', '<|extra_3|>'])
+def test_id_level_apis(text):
+    tokens = tokenizer.tokenize(text)
+    assert tokenizer.encode(text) == tokenizer.convert_tokens_to_ids(tokens)
+    assert tokenizer.count(text) == len(tokens)
+    for max_token, start_token in [(0, 0), (1, 0), (3, 2), (1000, 0)]:
+        assert tokenizer.truncate(text, max_token=max_token, start_token=start_token) == \
+            tokenizer.convert_tokens_to_string(tokens[start_token:start_token + max_token])
+
+
+def test_encode_batch():
+    texts = ['hello world', '你好，世界。' * 20, 'a<|im_end|>b', '']
+    assert tokenizer.encode_batch(texts) == [tokenizer.encode(x) for x in texts]
+    assert tokenizer.encode_batch(texts, num_threads=1) == [tokenizer.encode(x) for x in texts]
+
+
+def test_lazy_tokenizer_and_vocab_cache(tmp_path):
+    code = ('from qwen_agent.utils import tokenization_qwen as t\n'
+            'assert t._TOKENIZER is None\n'
+            'print(t.count_tokens("hello world"))\n')
+    env = {**os.environ, 'QWEN_AGENT_CACHE_DIR': str(tmp_path), 'PYTHONPATH': REPO_ROOT}
+    for _ in range(2):  # Write the vocab cache, and then read it
+        res = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+        assert res.returncode == 0, res.stderr
+        assert res.stdout.strip() == '2'
+        assert len(os.listdir(tmp_path)) == 1
+    assert 'Failed' not in res.stderr
+
+
+def test_pickle_tokenizer():
+    # The shared tokenizer is pickled by reference
+    assert len(pickle.dumps(tokenizer)) < 100
+    assert pickle.loads(pickle.dumps(get_tokenizer())) is get_tokenizer()
+
+    other = pickle.loads(pickle.dumps(QWenTokenizer(get_tokenizer().vocab_file)))
+    assert other is not get_tokenizer()
+    assert other.tokenize('hello world') == tokenizer.tokenize('hello world')
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from qwen_agent.tools.search_tools.bm25_index import BM25Index, build_doc_postings
+
+DOC1 = [['transformer', 'attention', 'encoder'], ['attention', 'decoder'], ['bleu', 'wmt', 'bleu']]
+DOC2 = [['gpu', 'train', 'day'], ['attention', 'gpu'], []]
+
+
+def test_bm25_index_same_as_rank_bm25():
+    rank_bm25 = pytest.importorskip('rank_bm25')
+    index = BM25Index()
+    index.add_document('doc1', build_doc_postings(DOC1))
+    index.add_document('doc2', build_doc_postings(DOC2))
+
+    query = ['attention', 'gpu', 'bleu', 'unknown']
+    scores = index.get_scores(query)
+    expected = rank_bm25.BM25Okapi(DOC1 + DOC2).get_scores(query)
+    assert np.allclose(np.concatenate([scores['doc1'], scores['doc2']]), expected)
+
+
+def test_bm25_index_incremental_update():
+    index = BM25Index()
+    index.add_document('doc1', build_doc_postings(DOC1))
+    index.add_document('doc2', build_doc_postings(DOC2))
+    index.remove_document('doc2')
+
+    fresh = BM25Index()
+    fresh.add_document('doc1', build_doc_postings(DOC1))
+
+    query = ['attention', 'bleu']
+    assert list(index.get_scores(query).keys()) == ['doc1']
+    assert np.allclose(index.get_scores(query)['doc1'], fresh.get_scores(query)['doc1'])
+
+
+def test_bm25_index_append_chunks():
+    index = BM25Index()
+    index.add_document('doc1', build_doc_postings(DOC1[:1]))
+    index.add_document('doc2', build_doc_postings(DOC2))
+    index.append_chunks('doc1', DOC1[1:])
+    index.rename_document('doc1', 'doc1_full')
+
+    fresh = BM25Index()
+    fresh.add_document('doc1_full', build_doc_postings(DOC1))
+    fresh.add_document('doc2', build_doc_postings(DOC2))
+
+    query = ['attention', 'gpu', 'bleu']
+    scores, expected = index.get_scores(query), fresh.get_scores(query)
+    assert scores.keys() == expected.keys()
+    for doc_id in expected:
+        assert np.allclose(scores[doc_id], expected[doc_id])
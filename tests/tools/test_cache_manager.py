@@ -0,0 +1,36 @@
+import time
+
+import pytest
+
+from qwen_agent.tools.cache_manager import CacheManager
+from qwen_agent.tools.storage import KeyNotExistsError, Storage
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_cache_manager_lru_eviction(backend, tmp_path):
+    storage = Storage({'storage_root_path': str(tmp_path), 'storage_backend': backend})
+    cache = CacheManager(storage, max_bytes=350, touch_interval=0)
+    for i in range(3):
+        cache.put(f'key{i}', 'x' * 100)
+        time.sleep(0.01)
+    cache.get('key0')  # key1 becomes the least recently used
+    time.sleep(0.01)
+
+    cache.put('key3', 'x' * 100)
+    assert cache.list_keys() == ['key0', 'key2', 'key3']
+    with pytest.raises(KeyNotExistsError):
+        cache.get('key1')
+    assert cache.stats == {'hits': 1, 'misses': 1, 'evictions': 1, 'bytes': 300}
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_cache_manager_ttl(backend, tmp_path):
+    storage = Storage({'storage_root_path': str(tmp_path), 'storage_backend': backend})
+    cache = CacheManager(storage, ttl=0.05, touch_interval=0)
+    cache.put('old', 'value')
+    time.sleep(0.1)
+    cache.put('new', 'value')
+
+    assert cache.compact() == 1
+    assert cache.list_keys() == ['new']
+    assert cache.stats['evictions'] == 1
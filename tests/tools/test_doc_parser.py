@@ -1,4 +1,6 @@
 from qwen_agent.tools import DocParser
+from qwen_agent.tools.doc_parser import Chunk, add_keywords_to_chunks, get_chunk_keywords
+from qwen_agent.tools.search_tools.keyword_search import split_text_into_keywords
 
 
 def test_doc_parser():
@@ -7,5 +9,44 @@ def test_doc_parser():
     print(res)
 
 
+def test_doc_parser_iter_call(tmp_path):
+    doc_path = tmp_path / 'doc.txt'
+    doc_path.write_text('\n'.join(f'This is the paragraph {i} of a long document about transformers.' for i in range(200)))
+
+    cfg = {'max_ref_token': 200, 'parser_page_size': 100, 'stream_chunk_interval': 2}
+    records = list(DocParser({'path': str(tmp_path / 'stream'), **cfg}).iter_call({'url': str(doc_path)}))
+    expected = DocParser({'path': str(tmp_path / 'call'), **cfg}).call({'url': str(doc_path)})
+
+    assert len(records) > 1
+    for partial in records[:-1]:
+        assert partial['raw'] == expected['raw'][:len(partial['raw'])]
+        # The partial records are identified as the growing versions of the final record
+        assert partial['fingerprint'] == records[-1]['fingerprint']
+    assert {**records[-1], 'fingerprint': None} == {**expected, 'fingerprint': None}
+
+
+def test_doc_parser_reparse_changed_file(tmp_path):
+    doc_path = tmp_path / 'doc.txt'
+    doc_path.write_text('\n'.join(['The first version.'] * 100))
+    tool = DocParser({'path': str(tmp_path / 'doc_parser'), 'max_ref_token': 100, 'parser_page_size': 100})
+    assert 'first' in tool.call({'url': str(doc_path)})['raw'][0]['content']
+    assert tool.get_cached_record(str(doc_path)) is not None
+
+    doc_path.write_text('\n'.join(['The second version of the doc.'] * 100))
+    assert tool.get_cached_record(str(doc_path)) is None
+    assert 'second' in tool.call({'url': str(doc_path)})['raw'][0]['content']
+
+
+def test_chunk_keywords():
+    text = 'The attention mechanism lets transformers model long documents.'
+    chunks = add_keywords_to_chunks([Chunk(text, {}, 10), Chunk(text, {}, 10, keywords=['cached'])])
+    assert chunks[0].keywords == split_text_into_keywords(text)
+    # The keywords computed before are kept
+    assert chunks[1].keywords == ['cached']
+    assert get_chunk_keywords(chunks[1]) == ['cached']
+    # A chunk from a cache written before the keywords were stored is segmented on the fly
+    assert get_chunk_keywords(Chunk(text, {}, 10)) == split_text_into_keywords(text)
+
+
 if __name__ == '__main__':
     test_doc_parser()
@@ -0,0 +1,13 @@
+from qwen_agent.tools.extract_doc_vocabulary import ExtractDocVocabulary
+
+
+def test_extract_doc_vocabulary(tmp_path):
+    doc_path = tmp_path / 'doc.txt'
+    doc_path.write_text('Transformers are neural networks that use attention.\n'
+                        'The attention mechanism lets transformers model long documents.\n'
+                        'Retrieval augmented generation combines retrieval with generation.\n')
+    tool = ExtractDocVocabulary({'path': str(tmp_path / 'vocabulary')})
+    # The same vocabulary as extracted from the whole doc before the keywords were cached in the chunks
+    assert tool.call({'files': [str(doc_path)]}) == (
+        'retriev, transform, attent, attention., augment, combin, documents., generat, generation., let, long, mechan, '
+        'model, network, neural, use')
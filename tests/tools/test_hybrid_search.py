@@ -1,20 +1,56 @@
+import time
+
+import pytest
+
 from qwen_agent.tools import HybridSearch
+from qwen_agent.tools.base import TOOL_REGISTRY, register_tool
+from qwen_agent.tools.search_tools.base_search import BaseSearch
+
+DOC = ('主要序列转导模型基于复杂的循环或卷积神经网络，包括编码器和解码器。性能最好的模型还通过注意力机制连接编码器和解码器。'
+       '我们提出了一种新的简单网络架构——Transformer，它完全基于注意力机制，完全不需要递归和卷积。对两个机器翻译任务的实验表明，'
+       '这些模型在质量上非常出色，同时具有更高的并行性，并且需要的训练时间显着减少。'
+       '我们的模型在 WMT 2014 英语到德语翻译任务中取得了 28.4 BLEU，比现有的最佳结果（包括集成）提高了 2 BLEU 以上。'
+       '在 WMT 2014 英法翻译任务中，我们的模型在 8 个 GPU 上训练 3.5 天后，建立了新的单模型最先进 BLEU 分数 41.0，'
+       '这只是最佳模型训练成本的一小部分文献中的模型。')
 
 
 def test_hybrid_search():
     tool = HybridSearch()
-    doc = ('主要序列转导模型基于复杂的循环或卷积神经网络，包括编码器和解码器。性能最好的模型还通过注意力机制连接编码器和解码器。'
-           '我们提出了一种新的简单网络架构——Transformer，它完全基于注意力机制，完全不需要递归和卷积。对两个机器翻译任务的实验表明，'
-           '这些模型在质量上非常出色，同时具有更高的并行性，并且需要的训练时间显着减少。'
-           '我们的模型在 WMT 2014 英语到德语翻译任务中取得了 28.4 BLEU，比现有的最佳结果（包括集成）提高了 2 BLEU 以上。'
-           '在 WMT 2014 英法翻译任务中，我们的模型在 8 个 GPU 上训练 3.5 天后，建立了新的单模型最先进 BLEU 分数 41.0，'
-           '这只是最佳模型训练成本的一小部分文献中的模型。')
-    res = tool.call({'query': '这个模型要训练多久？'}, docs=[doc], max_ref_token=100)
+    res = tool.call({'query': '这个模型要训练多久？'}, docs=[DOC], max_ref_token=100)
     print(res)
 
-    res = tool.call({'query': '这个模型要训练多久？'}, docs=[doc.split('。')], max_ref_token=100)
+    res = tool.call({'query': '这个模型要训练多久？'}, docs=[DOC.split('。')], max_ref_token=100)
     print(res)
 
 
+class SlowSearch(BaseSearch):
+
+    def sort_by_scores(self, query, docs, **kwargs):
+        time.sleep(2)
+        return [(doc.url, 0, 1.0) for doc in docs]
+
+
+@pytest.fixture
+def slow_search():
+    register_tool('slow_search_for_test')(SlowSearch)
+    yield
+    TOOL_REGISTRY.pop('slow_search_for_test')
+
+
+def test_hybrid_search_timeout(slow_search):
+    tool = HybridSearch({
+        'rag_searchers': ['keyword_search', 'slow_search_for_test', 'slow_search_for_test', 'slow_search_for_test'],
+        'searcher_timeout': 0.5
+    })
+    docs, _ = tool.format_docs([DOC.split('。')])
+    start_time = time.time()
+    chunk_and_score = tool.sort_by_scores('这个模型要训练多久？', docs=docs)
+    # The timeout is a deadline of all the sub-searchers instead of each one
+    assert time.time() - start_time < 1.2
+    assert len(chunk_and_score) == len(docs[0].raw)
+    # The pool of the sub-searchers is shared instead of created for every instance
+    assert HybridSearch().executor is HybridSearch().executor
+
+
 if __name__ == '__main__':
     test_hybrid_search()
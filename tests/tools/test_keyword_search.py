@@ -1,4 +1,9 @@
+import numpy as np
+import pytest
+
 from qwen_agent.tools import KeywordSearch
+from qwen_agent.tools.doc_parser import Record
+from qwen_agent.tools.search_tools import keyword_search
 
 
 def test_keyword_search():
@@ -16,5 +21,42 @@ def test_keyword_search():
     print(res)
 
 
+def _make_record(url: str, topic: str, num_chunks: int) -> Record:
+    tool = KeywordSearch()
+    doc, _ = tool.format_docs([[f'第{i}段讨论了{topic}的训练和推理。' for i in range(num_chunks)]])
+    return Record(url=url, raw=doc[0].raw, title='', fingerprint=f'{url}_fingerprint')
+
+
+def test_keyword_search_index_by_fingerprint(tmp_path, monkeypatch):
+    tool = KeywordSearch({'index_path': str(tmp_path)})
+    doc_a, doc_b = _make_record('a', 'transformer', 4), _make_record('b', 'retrieval', 4)
+    expected_a = KeywordSearch({'index_path': str(tmp_path / 'fresh')}).sort_by_scores('训练', docs=[doc_a])
+
+    # The sessions querying different docs do not evict the postings of each other
+    tool.sort_by_scores('训练', docs=[doc_a])
+    tool.sort_by_scores('训练', docs=[doc_b])
+
+    def _fail(*args, **kwargs):
+        raise AssertionError('The postings are rebuilt')
+
+    monkeypatch.setattr(keyword_search, 'build_doc_postings', _fail)
+    monkeypatch.setattr(tool.db, 'get', _fail)
+    monkeypatch.setattr(keyword_search, 'hash_sha256', _fail)
+    # Only the docs of the query are scored
+    assert tool.sort_by_scores('训练', docs=[doc_a]) == expected_a
+
+
+def test_keyword_search_growing_doc(tmp_path):
+    tool = KeywordSearch({'index_path': str(tmp_path)})
+    full = _make_record('a', 'transformer', 6)
+    partial = Record(url='a', raw=full.raw[:2], title='', fingerprint=full.fingerprint)
+    tool.sort_by_scores('训练', docs=[partial])
+    scores = tool.sort_by_scores('训练', docs=[full])
+
+    expected = KeywordSearch({'index_path': str(tmp_path / 'fresh')}).sort_by_scores('训练', docs=[full])
+    assert [item[:2] for item in scores] == [item[:2] for item in expected]
+    assert np.allclose([item[2] for item in scores], [item[2] for item in expected])
+
+
 if __name__ == '__main__':
     test_keyword_search()
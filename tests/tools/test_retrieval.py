@@ -0,0 +1,139 @@
+import threading
+import time
+
+import pytest
+
+from qwen_agent.tools import Retrieval
+from qwen_agent.tools.doc_parser import DocParser
+from qwen_agent.tools.retrieval import _INFLIGHT_PARSING, _PARSE_EXECUTORS, _PARTIAL_RECORDS
+from qwen_agent.tools.search_tools.bm25_index import BM25Index
+
+
+def _write_doc(path, topic: str) -> str:
+    path.write_text('\n'.join(f'第{i}段：这是一篇关于{topic}的文档，讨论了{topic}的原理和应用。' for i in range(50)))
+    return str(path)
+
+
+@pytest.fixture
+def blocked_parsing(monkeypatch):
+    """Block DocParser.call and DocParser.iter_call until the event is set, and record the urls parsed"""
+    release = threading.Event()
+    parsed = []
+    call, iter_call = DocParser.call, DocParser.iter_call
+
+    def _blocked_call(self, params, **kwargs):
+        parsed.append(params['url'])
+        release.wait(10)
+        return call(self, params, **kwargs)
+
+    def _blocked_iter_call(self, params, **kwargs):
+        parsed.append(params['url'])
+        release.wait(10)
+        yield from iter_call(self, params, **kwargs)
+
+    monkeypatch.setattr(DocParser, 'call', _blocked_call)
+    monkeypatch.setattr(DocParser, 'iter_call', _blocked_iter_call)
+    yield release, parsed
+    release.set()
+
+
+def test_inflight_parsing_dedup(tmp_path, blocked_parsing):
+    release, parsed = blocked_parsing
+    doc = _write_doc(tmp_path / 'doc.txt', 'transformer')
+    # Two sessions ask for the same file while it is being parsed
+    future = Retrieval({'rag_searchers': ['keyword_search']})._submit_parsing(doc)
+    assert Retrieval({'rag_searchers': ['keyword_search']})._submit_parsing(doc) is future
+    release.set()
+    assert 'transformer' in future.result()['raw'][0]['content']
+    assert parsed == [doc]
+    assert not any(doc in key for key in _INFLIGHT_PARSING)
+
+
+def test_parse_files_in_threads_by_default(tmp_path):
+    docs = [_write_doc(tmp_path / f'doc_{i}.txt', topic) for i, topic in enumerate(['transformer', 'retrieval'])]
+    num_executors = len(_PARSE_EXECUTORS)
+    records = Retrieval({'rag_searchers': ['keyword_search']})._parse_files(docs)
+    assert [rec['url'] for rec in records] == docs
+    # The process pool, which re-imports the main module in spawn, is opt-in
+    assert len(_PARSE_EXECUTORS) == num_executors
+
+
+def test_parse_files_in_process_pool(tmp_path):
+    docs = [_write_doc(tmp_path / f'doc_{i}.txt', topic) for i, topic in enumerate(['transformer', 'retrieval'])]
+    tool = Retrieval({'rag_searchers': ['keyword_search'], 'max_parse_workers': 2})
+    records = tool._parse_files(docs)
+    assert 2 in _PARSE_EXECUTORS
+
+    expected = [DocParser({'path': str(tmp_path / 'serial')}).call({'url': doc}) for doc in docs]
+    assert [{**rec, 'fingerprint': None} for rec in records] == [{**rec, 'fingerprint': None} for rec in expected]
+    expected = records
+    # The chunked docs are read back from the json cache
+    assert [tool.doc_parse.get_cached_record(doc) for doc in docs] == expected
+
+
+def test_parse_timeout(tmp_path, blocked_parsing):
+    release, _ = blocked_parsing
+    cached_doc = _write_doc(tmp_path / 'cached.txt', 'transformer')
+    slow_doc = _write_doc(tmp_path / 'slow.txt', 'retrieval')
+    tool = Retrieval({'rag_searchers': ['keyword_search'], 'parse_timeout': 0.2})
+    release.set()
+    tool._parse_files([cached_doc])
+    release.clear()
+
+    # The cached doc is returned without waiting for the slow doc, which goes on being parsed
+    start_time = time.time()
+    records = tool._parse_files([cached_doc, slow_doc])
+    assert time.time() - start_time < 2
+    assert [rec['url'] for rec in records] == [cached_doc]
+    release.set()
+    time.sleep(0.5)
+    assert [rec['url'] for rec in tool._parse_files([cached_doc, slow_doc])] == [cached_doc, slow_doc]
+
+
+def test_search_partial_records(tmp_path, monkeypatch):
+    doc = str(tmp_path / 'long.txt')
+    (tmp_path / 'long.txt').write_text('\n'.join(
+        f'This is the paragraph {i} of a long document about transformers.' for i in range(200)))
+    # Block the parsing after the first partial record
+    release = threading.Event()
+    iter_call = DocParser.iter_call
+
+    def _slow_iter_call(self, params, **kwargs):
+        for i, record in enumerate(iter_call(self, params, **kwargs)):
+            yield record
+            if i == 0:
+                release.wait(10)
+
+    monkeypatch.setattr(DocParser, 'iter_call', _slow_iter_call)
+    appended = []
+    append_chunks = BM25Index.append_chunks
+
+    def _append_chunks(self, doc_id, tokenized_chunks):
+        appended.append(len(tokenized_chunks))
+        append_chunks(self, doc_id, tokenized_chunks)
+
+    monkeypatch.setattr(BM25Index, 'append_chunks', _append_chunks)
+
+    tool = Retrieval({
+        'rag_searchers': ['keyword_search'],
+        'max_ref_token': 200,
+        'parser_page_size': 100,
+        'parse_timeout': 0.5
+    })
+    tool.doc_parse.stream_chunk_interval = 4
+    expected = DocParser({
+        'path': str(tmp_path / 'call'),
+        'max_ref_token': 200,
+        'parser_page_size': 100
+    }).call({'url': doc})
+
+    # The front chunks are searched while the rest of the doc is being parsed
+    assert tool.call({'query': 'transformers', 'files': [doc]})
+    partial = _PARTIAL_RECORDS[tool._get_parsing_key(doc)]
+    assert partial['raw'] == expected['raw'][:4]
+
+    # The bm25 index of the front chunks is extended with the rest chunks instead of being rebuilt
+    release.set()
+    tool._submit_parsing(doc).result()
+    assert tool.call({'query': 'transformers', 'files': [doc]})
+    assert appended == [len(expected['raw']) - 4]
@@ -1,4 +1,11 @@
+import os
+
+import pytest
+
 from qwen_agent.tools import SimpleDocParser
+from qwen_agent.tools.simple_doc_parser import _iter_parse_pdf_in_pool, get_pdf_page_count, parse_pdf
+
+RESOURCE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'examples', 'resource')
 
 
 def test_simple_doc_parser():
@@ -7,5 +14,15 @@ def test_simple_doc_parser():
     print(res)
 
 
+@pytest.mark.parametrize('name', ['doc.pdf', 'growing_girl.pdf'])
+def test_parse_pdf_in_parallel(name):
+    pdf_path = os.path.join(RESOURCE_DIR, name)
+    serial = parse_pdf(pdf_path)
+    assert parse_pdf(pdf_path, max_workers=2) == serial
+    # Run the process pool even if the pdf is too short or there is only one CPU
+    num_pages = get_pdf_page_count(pdf_path)
+    assert list(_iter_parse_pdf_in_pool(pdf_path, False, num_pages=num_pages, max_workers=2)) == serial
+
+
 if __name__ == '__main__':
     test_simple_doc_parser()
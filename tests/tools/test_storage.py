@@ -0,0 +1,45 @@
+import sqlite3
+
+import pytest
+
+from qwen_agent.tools.storage import KeyNotExistsError, Storage
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_storage_backend(backend, tmp_path):
+    tool = Storage({'storage_root_path': str(tmp_path), 'storage_backend': backend})
+    tool.call({'operate': 'put', 'key': '345/456/11', 'value': 'hello'})
+    tool.call({'operate': 'put', 'key': '/345/456/12', 'value': 'world'})
+    tool.put('345/4567', 'other')
+    tool.put('345/456/12', 'world!')
+
+    assert tool.list_keys('345/456') == ['345/456/11', '345/456/12', '345/4567']
+    assert tool.list_keys('345/456/') == ['345/456/11', '345/456/12']
+    assert tool.call({'operate': 'scan', 'key': '/345/456'}) == '/11: hello\n/12: world!'
+    assert tool.call({'operate': 'get', 'key': '345/456/12'}) == 'world!'
+
+    assert tool.delete('345/456/11') == 'Successfully deleted 345/456/11'
+    assert tool.delete('345/456/11') == 'Delete Failed: 345/456/11 does not exist'
+    with pytest.raises(KeyNotExistsError):
+        tool.get('345/456/11')
+
+    # The backend of another path is created once
+    other_path = str(tmp_path / 'other')
+    tool.put('key', 'value', path=other_path)
+    assert tool.get('key', path=other_path) == 'value'
+    assert tool._get_backend(other_path) is tool._get_backend(other_path)
+
+
+def test_sqlite_storage_migration(tmp_path):
+    # A database created before the sizes and access times of the values were stored
+    with sqlite3.connect(str(tmp_path / 'storage.sqlite3')) as conn:
+        conn.execute('CREATE TABLE kv (key TEXT NOT NULL UNIQUE, value TEXT NOT NULL)')
+        conn.execute('INSERT INTO kv (key, value) VALUES (?, ?)', ('doc/1', '你好'))
+    conn.close()
+
+    tool = Storage({'storage_root_path': str(tmp_path), 'storage_backend': 'sqlite'})
+    assert tool.get('doc/1') == '你好'
+    tool.put('doc/2', 'hello')
+    assert [entry[:2] for entry in tool.backend.list_entries('doc/')] == [('doc/1', 6), ('doc/2', 5)]
+    # Opening the migrated database again does not migrate it twice
+    assert Storage({'storage_root_path': str(tmp_path), 'storage_backend': 'sqlite'}).get('doc/2') == 'hello'
@@ -1,20 +1,68 @@
+import numpy as np
+
 from qwen_agent.tools import VectorSearch
+from qwen_agent.tools.search_tools.embedding_store import BaseEmbedding, EmbeddingStore
+
+DOC = ('主要序列转导模型基于复杂的循环或卷积神经网络，包括编码器和解码器。性能最好的模型还通过注意力机制连接编码器和解码器。'
+       '我们提出了一种新的简单网络架构——Transformer，它完全基于注意力机制，完全不需要递归和卷积。对两个机器翻译任务的实验表明，'
+       '这些模型在质量上非常出色，同时具有更高的并行性，并且需要的训练时间显着减少。'
+       '我们的模型在 WMT 2014 英语到德语翻译任务中取得了 28.4 BLEU，比现有的最佳结果（包括集成）提高了 2 BLEU 以上。'
+       '在 WMT 2014 英法翻译任务中，我们的模型在 8 个 GPU 上训练 3.5 天后，建立了新的单模型最先进 BLEU 分数 41.0，'
+       '这只是最佳模型训练成本的一小部分文献中的模型。')
 
 
 def test_vector_search():
     tool = VectorSearch()
-    doc = ('主要序列转导模型基于复杂的循环或卷积神经网络，包括编码器和解码器。性能最好的模型还通过注意力机制连接编码器和解码器。'
-           '我们提出了一种新的简单网络架构——Transformer，它完全基于注意力机制，完全不需要递归和卷积。对两个机器翻译任务的实验表明，'
-           '这些模型在质量上非常出色，同时具有更高的并行性，并且需要的训练时间显着减少。'
-           '我们的模型在 WMT 2014 英语到德语翻译任务中取得了 28.4 BLEU，比现有的最佳结果（包括集成）提高了 2 BLEU 以上。'
-           '在 WMT 2014 英法翻译任务中，我们的模型在 8 个 GPU 上训练 3.5 天后，建立了新的单模型最先进 BLEU 分数 41.0，'
-           '这只是最佳模型训练成本的一小部分文献中的模型。')
-    res = tool.call({'query': '这个模型要训练多久？'}, docs=[doc], max_ref_token=100)
+    res = tool.call({'query': '这个模型要训练多久？'}, docs=[DOC], max_ref_token=100)
     print(res)
 
-    res = tool.call({'query': '这个模型要训练多久？'}, docs=[doc.split('。')], max_ref_token=100)
+    res = tool.call({'query': '这个模型要训练多久？'}, docs=[DOC.split('。')], max_ref_token=100)
     print(res)
 
 
+class CharEmbedding(BaseEmbedding):
+
+    def __init__(self):
+        super().__init__({'model': 'char'})
+        self.num_embedded = 0
+
+    def embed_documents(self, texts):
+        self.num_embedded += len(texts)
+        return np.asarray([[t.count(c) for c in '训练GPU模型'] for t in texts], dtype=np.float32)
+
+
+def test_vector_search_embedding_cache(tmp_path):
+    embedding = CharEmbedding()
+    tool = VectorSearch({'embedding': embedding, 'path': str(tmp_path)})
+    res = tool.call({'query': '训练 GPU'}, docs=[DOC.split('。')], max_ref_token=100)
+    assert res
+    num_embedded = embedding.num_embedded
+
+    # The chunks and the query are embedded only once
+    tool.call({'query': '训练 GPU'}, docs=[DOC.split('。')], max_ref_token=100)
+    assert embedding.num_embedded == num_embedded
+
+    # The vectors are persisted on disk
+    new_tool = VectorSearch({'embedding': embedding, 'path': str(tmp_path)})
+    assert new_tool.call({'query': '训练 GPU'}, docs=[DOC.split('。')], max_ref_token=100) == res
+    assert embedding.num_embedded == num_embedded
+
+    # The searchers of the same files share one store
+    assert new_tool.store is tool.store
+
+
+def test_embedding_store_shared_files(tmp_path):
+    # Two stores of the same files, such as in two processes
+    store_a = EmbeddingStore(str(tmp_path), CharEmbedding())
+    store_b = EmbeddingStore(str(tmp_path), CharEmbedding())
+    expected_a = store_a.get_embeddings(['训练训练'])
+    expected_b = store_b.get_embeddings(['GPU'])
+    assert store_a.get_embeddings(['GPU', '训练训练', '模型']).tolist() == [
+        expected_b[0].tolist(), expected_a[0].tolist(), [0, 0, 0, 0, 0, 1, 1]
+    ]
+    assert store_b.get_embeddings(['训练训练']).tolist() == expected_a.tolist()
+    assert len(EmbeddingStore(str(tmp_path), CharEmbedding())) == 3
+
+
 if __name__ == '__main__':
     test_vector_search()